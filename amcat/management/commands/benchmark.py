@@ -0,0 +1,312 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Benchmarks of the import, indexing and deduplication code, comparing the current implementation
+with the one it replaced. Benchmarks that write to the database do so in a transaction that
+is rolled back.
+
+Usage: python manage.py benchmark [name ...]
+"""
+
+from __future__ import print_function, unicode_literals
+
+from collections import namedtuple
+from itertools import islice
+from tempfile import NamedTemporaryFile
+import csv
+import datetime
+import json
+import random
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+Doc = namedtuple("Doc", ["id", "headline", "text"])
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _rolled_back(func):
+    """Call func in a transaction that is rolled back afterwards, and return its result"""
+    from django.db import transaction
+    result = []
+    try:
+        with transaction.atomic():
+            result.append(func())
+            raise _Rollback()
+    except _Rollback:
+        pass
+    return result[0]
+
+
+def _get_project():
+    from amcat.models import Project
+    project = Project.objects.order_by("id").first()
+    if project is None:
+        raise CommandError("This benchmark needs a project in the database")
+    return project
+
+
+def _timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def _mutate(text, n, chars="abcde "):
+    """Randomly insert, delete or replace n characters"""
+    text = list(text)
+    for _ in range(n):
+        i = random.randint(0, len(text))
+        op = random.choice(["insert", "delete", "replace"])
+        if op == "insert" or not text:
+            text.insert(i, random.choice(chars))
+        elif op == "delete":
+            del text[min(i, len(text) - 1)]
+        else:
+            text[min(i, len(text) - 1)] = random.choice(chars)
+    return "".join(text)
+
+
+###########################################################################
+#                         E L A S T I C S E A R C H                       #
+###########################################################################
+
+def benchmark_client_latency(n=200):
+    """Request latency of a new client per ES object versus the shared client"""
+    from django.conf import settings
+    from elasticsearch import Elasticsearch
+    from amcat.tools.amcates import ES
+    hosts = [{"host": settings.ES_HOST, "port": settings.ES_PORT}]
+
+    def latency(get_client):
+        _, seconds = _timed(lambda: [get_client().count(index=settings.ES_INDEX) for _ in range(n)])
+        return seconds / n * 1000
+
+    old = latency(lambda: Elasticsearch(hosts=hosts, timeout=settings.ES_TIMEOUT))
+    new = latency(lambda: ES().es)
+    return "{n} count requests: {new:.2f}ms per request, previously {old:.2f}ms".format(**locals())
+
+
+###########################################################################
+#                            A R T I C L E S                              #
+###########################################################################
+
+def benchmark_article_insert(n=2000):
+    """Insert articles one by one versus in batches"""
+    from amcat.models import Article, Medium
+    from amcat.models.article import _save_articles, _bulk_save_articles
+
+    def insert(save):
+        project, medium = _get_project(), Medium.get_or_create("benchmark")
+        articles = [Article(project=project, medium=medium, date="2001-01-01", headline="test",
+                            text="article {}".format(i), length=2) for i in range(n)]
+        _, seconds = _timed(lambda: list(save(articles, [])))
+        return n / seconds
+
+    old = _rolled_back(lambda: insert(_save_articles))
+    new = _rolled_back(lambda: insert(_bulk_save_articles))
+    return "Inserted {n} articles: {new:.0f} articles/sec, previously {old:.0f} articles/sec".format(**locals())
+
+
+def _legacy_normalize(article):
+    """Compute the length and es dict of an article as done before amcat.tools.normalize"""
+    import re
+    from django.conf import settings
+    from amcat.tools import amcates
+    from amcat.tools.djangotoolkit import get_model_field
+    from amcat.tools.normalize import WORD_RE
+
+    article.length = sum(len(re.sub(WORD_RE, ' ', getattr(article, f) or "").split())
+                         for f in ("text", "headline", "byline"))
+    article_dict = {}
+    for field_name in amcates.ARTICLE_FIELDS:
+        value = get_model_field(article, field_name)
+        if field_name in amcates.ARTICLE_CLEAN_FIELDS and value is not None:
+            value = amcates._clean_re.sub(' ', value)
+        article_dict[amcates.ARTICLE_FIELD_MAP.get(field_name, field_name)] = value
+    date = article_dict["date"]
+    article_dict["date"] = datetime.datetime(date.year, date.month, date.day).isoformat()
+    article_dict["uuid"] = str(article_dict["uuid"])
+    article_dict["sets"] = None
+    get_hash = amcates._get_legacy_hash if settings.ES_USE_LEGACY_HASH_FUNCTION else amcates._get_hash
+    article_dict["hash"] = get_hash(article_dict)
+    return article_dict
+
+
+def benchmark_normalize(narticles=20, nwords=50000):
+    """Compute the length and es dict of large articles"""
+    from amcat.models import Article, Medium
+    from amcat.tools.normalize import normalize_articles
+    random.seed(1)
+    words = "de het een van en in is dat op te Nederland Leden minister voorzitter.".split()
+    document = lambda n: " ".join(random.choice(words) for _ in range(n))
+    medium = Medium(id=1, name="benchmark")
+    articles = [Article(id=i, medium=medium, date=datetime.date(2001, 1, 1), headline=document(10),
+                        text=document(nwords)) for i in range(narticles)]
+
+    _, old = _timed(lambda: [_legacy_normalize(a) for a in articles])
+    for a in articles:
+        a.length = None
+    _, new = _timed(normalize_articles, articles)
+    return "Normalized {narticles} articles of {nwords} words: {new:.2f}s, previously {old:.2f}s".format(**locals())
+
+
+###########################################################################
+#                           C S V   I M P O R T                           #
+###########################################################################
+
+def _legacy_convert(options, row):
+    """Convert a csv row to article fields as CSV.parse_document did before RowConverter"""
+    from amcat.scripts.article_upload.csv_import import FIELDS, PARSERS, is_nullable
+    kargs = dict(metastring={})
+    csvfields = [(fieldname, options[fieldname]) for fieldname in FIELDS if options[fieldname]]
+    for fieldname, csvfield in csvfields:
+        val = row[csvfield]
+        if fieldname == 'date' and isinstance(val, datetime.datetime):
+            pass
+        elif val.strip():
+            if fieldname in PARSERS:
+                val = PARSERS[fieldname](val)
+        elif is_nullable(fieldname):
+            val = None
+        else:
+            val = val.strip()
+        kargs[fieldname] = val
+    csvfields = [tup[1] for tup in csvfields]
+    for key, value in row.items():
+        if key not in csvfields:
+            kargs["metastring"][key] = value
+    kargs["metastring"] = json.dumps(kargs["metastring"])
+    return kargs
+
+
+def _write_csv(f, n):
+    """Write a csv file with n rows of synthetic articles"""
+    random.seed(1)
+    words = "de het een van en in is dat op te Nederland Leden minister voorzitter".split()
+    w = csv.writer(f)
+    w.writerow(["kop", "datum", "tekst", "pagina", "bron", "auteur"])
+    for i in range(n):
+        date = datetime.datetime(2000, 1, 1) + datetime.timedelta(minutes=random.randint(0, 10 ** 7))
+        w.writerow([" ".join(random.sample(words, 5)), date.isoformat(), " ".join(random.sample(words, 12)),
+                    random.choice(["", str(random.randint(1, 40))]), "medium {}".format(i % 10),
+                    random.choice(words)])
+    f.flush()
+
+
+def benchmark_csv_convert(n=1000000, nlegacy=10000):
+    """Convert the rows of a large csv file to article fields (only nlegacy rows with the previous code)"""
+    from amcat.scripts.article_upload.csv_import import FIELDS, RowConverter
+    from amcat.scripts.article_upload.fileupload import namedtuples_from_reader
+    options = dict({field: None for field in FIELDS}, headline="kop", date="datum", text="tekst",
+                   pagenr="pagina", medium="bron", byline="auteur")
+
+    def legacy_convert_all(rows):
+        for row in islice(rows, nlegacy):
+            _legacy_convert(options, row)
+
+    def convert_all(rows):
+        converter = None
+        for row in rows:
+            if converter is None:
+                converter = RowConverter(options, row.column_names)
+            converter.convert(row)
+
+    def convert(f):
+        _, old = _timed(legacy_convert_all, namedtuples_from_reader(csv.reader(open(f.name)), encoding="utf-8"))
+        _, new = _timed(convert_all, namedtuples_from_reader(csv.reader(open(f.name)), encoding="utf-8"))
+        return nlegacy / old, n / new
+
+    with NamedTemporaryFile(suffix=".csv") as f:
+        _write_csv(f, n)
+        old, new = _rolled_back(lambda: convert(f))
+    return "Converted {n} csv rows: {new:.0f} rows/sec, previously {old:.0f} rows/sec".format(**locals())
+
+
+###########################################################################
+#                  F U Z Z Y   D E D U P L I C A T I O N                  #
+###########################################################################
+
+def _pairwise_fuzzy_dedup(arts, ratios):
+    """Deduplication as done by Deduplicate.fuzzy_dedup before FuzzyDeduplicator"""
+    import Levenshtein
+
+    def is_fuzzy_dupe(a, b):
+        for field, ratio in ratios.items():
+            if Levenshtein.ratio(getattr(a, field), getattr(b, field)) < ratio:
+                return False
+        return True
+    arts = sorted(arts, key=lambda a: a.id)
+    while len(arts) > 1:
+        a = arts.pop(0)
+        dupes = [b for b in arts if is_fuzzy_dupe(a, b)]
+        if dupes:
+            arts = [b for b in arts if b not in dupes]
+            yield a, dupes
+
+
+def _wire_stories(nstories, ncopies, nwords):
+    """Create ncopies slightly edited copies of nstories synthetic stories of up to nwords words"""
+    words = [_mutate("", random.randint(2, 10), chars="abcdefghijklmnoprstuvwz") for _ in range(20000)]
+    stories = [" ".join(random.choice(words) for _ in range(random.randint(nwords // 4, nwords)))
+               for _ in range(nstories)]
+    return [Doc(i, "headline", _mutate(stories[i % nstories], random.randint(0, 20)))
+            for i in range(nstories * ncopies)]
+
+
+def benchmark_fuzzy_dedup(nstories=200, ncopies=5, nwords=300):
+    """Deduplicate wire stories by text, pairwise and with FuzzyDeduplicator (with and without LSH)"""
+    from amcat.tools.fuzzydedup import FuzzyDeduplicator
+    random.seed(1)
+    docs = _wire_stories(nstories, ncopies, nwords)
+    ratios = {"text": .8}
+
+    old, old_time = _timed(lambda: list(_pairwise_fuzzy_dedup(docs, ratios)))
+    new, new_time = _timed(lambda: list(FuzzyDeduplicator(ratios).deduplicate(docs)))
+    lsh, lsh_time = _timed(lambda: list(FuzzyDeduplicator(ratios, use_lsh=True).deduplicate(docs)))
+    return ("Deduplicated {} articles: {:.2f}s, with lsh {:.2f}s ({} of {} duplicates found), previously {:.2f}s"
+            .format(len(docs), new_time, lsh_time, sum(len(d) for (a, d) in lsh), sum(len(d) for (a, d) in new),
+                    old_time))
+
+
+BENCHMARKS = {
+    "article_insert": benchmark_article_insert,
+    "client_latency": benchmark_client_latency,
+    "csv_convert": benchmark_csv_convert,
+    "normalize": benchmark_normalize,
+    "fuzzy_dedup": benchmark_fuzzy_dedup,
+}
+
+
+class Command(BaseCommand):
+    help = 'Run the given (or all) benchmarks: {}'.format(", ".join(sorted(BENCHMARKS)))
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmarks", nargs="*", help="names of the benchmarks to run")
+
+    def handle(self, *args, **options):
+        names = options["benchmarks"] or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: {name}".format(**locals()))
+        for name in names:
+            print("{}: {}".format(name, BENCHMARKS[name]()))
@@ -0,0 +1,47 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+from __future__ import print_function
+
+from django.core.management import BaseCommand
+
+from amcat.models import Article
+from amcat.tools import amcates
+from amcat.tools.duplicates import HashIndex
+from amcat.tools.toolkit import splitlist
+
+
+GROUP_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = 'Store the hashes of all articles in the index in the articles_hashes table (see ES_HASH_INDEX).'
+
+    def handle(self, *args, **options):
+        es = amcates.ES()
+        index = HashIndex()
+
+        results = es.query_iter(fields=["hash"], score=False, size=GROUP_SIZE)
+        print("Storing hashes of {} articles".format(results.total))
+        for i, batch in enumerate(splitlist(results, itemsperbatch=GROUP_SIZE)):
+            # Articles might be in the index but no longer in the database
+            ids = set(Article.exists([r.id for r in batch]))
+            index.add({r.hash: r.id for r in batch if r.id in ids})
+            print("{} of {}".format(min((i + 1) * GROUP_SIZE, results.total), results.total))
+
+        print("Done.")
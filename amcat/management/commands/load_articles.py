@@ -0,0 +1,55 @@
+from __future__ import print_function, unicode_literals
+
+import datetime
+import io
+import json
+
+from django.core.management import BaseCommand, CommandError
+
+from amcat.models import Article, ArticleSet, Medium
+from amcat.tools.copyloader import CopyLoader, COPY_BATCH_SIZE
+from amcat.tools.toolkit import read_date
+
+
+class Command(BaseCommand):
+    help = ('Load articles from files with one json object per line into an articleset using '
+            'COPY. Objects contain article fields, with medium given as name (created if needed).')
+
+    def add_arguments(self, parser):
+        parser.add_argument("articleset", type=int, help="id of the articleset to load into")
+        parser.add_argument("files", nargs="+", help="json lines file(s) with articles")
+        parser.add_argument("--batch-size", type=int, default=COPY_BATCH_SIZE)
+        parser.add_argument("--no-check-duplicate", action="store_false", dest="check_duplicate",
+                            help="do not skip articles that are already in the index")
+
+    def get_articles(self, files, project):
+        media = {}
+        for fn in files:
+            with io.open(fn, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    fields = json.loads(line)
+                    medium = fields.pop("medium", None)
+                    if medium is not None:
+                        if medium not in media:
+                            media[medium] = Medium.get_or_create(medium)
+                        fields["medium"] = media[medium]
+                    if "date" in fields:
+                        fields["date"] = read_date(fields["date"])
+                    yield Article(project=project, **fields)
+
+    def handle(self, *args, **options):
+        try:
+            aset = ArticleSet.objects.get(pk=options["articleset"])
+        except ArticleSet.DoesNotExist:
+            raise CommandError("Articleset {} does not exist".format(options["articleset"]))
+
+        loader = CopyLoader(batch_size=options["batch_size"], check_duplicate=options["check_duplicate"])
+        start = datetime.datetime.now()
+        result, errors = loader.load(self.get_articles(options["files"], aset.project), aset)
+        seconds = (datetime.datetime.now() - start).total_seconds()
+
+        for error in errors:
+            print("Error: {}".format(error))
+        print("Saved {} articles ({} errors) in {:.1f} seconds".format(len(result), len(errors), seconds))
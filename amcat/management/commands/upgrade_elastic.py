@@ -25,8 +25,8 @@ from amcat.management.commands.upgrade_hashes import GROUP_SIZE
 from django.core.management import BaseCommand
 from amcat.models import Article
 from amcat.tools import amcates
-from amcat.tools.amcates import get_article_dict
-from amcat.tools.toolkit import grouper
+from amcat.tools.amcates import get_article_dict, serialize
+from amcat.tools.toolkit import splitlist
 
 
 class Command(BaseCommand):
@@ -42,21 +42,19 @@ class Command(BaseCommand):
         print(narticles)
 
         then, now = datetime.datetime.now(), datetime.datetime.now()
-        for i, article_ids in enumerate(grouper(es.query_ids(), n=GROUP_SIZE)):
-            progress = (float(i * GROUP_SIZE) / float(narticles)) * 100
-            print("{} of {} ({:.2f}%)".format(i*GROUP_SIZE, narticles, progress))
-
-            articles = Article.objects.filter(id__in=article_ids).select_related("medium")
-            article_dicts = map(get_article_dict, articles)
-
-            for article_dict in article_dicts:
-                del article_dict["sets"]
-                del article_dict["hash"]
-
-            es.bulk_update_values({a["id"]: a for a in article_dicts})
-
-            then, now = now, datetime.datetime.now()
-            print("Articles per second: ", end="")
-            print(int(GROUP_SIZE / (now - then).total_seconds()))
+        with es.bulk_indexer() as indexer:
+            for i, article_ids in enumerate(splitlist(es.query_ids(), itemsperbatch=GROUP_SIZE)):
+                progress = (float(i * GROUP_SIZE) / float(narticles)) * 100
+                print("{} of {} ({:.2f}%)".format(i*GROUP_SIZE, narticles, progress))
+
+                articles = Article.objects.filter(id__in=article_ids).select_related("medium")
+                for article_dict in map(get_article_dict, articles):
+                    del article_dict["sets"]
+                    del article_dict["hash"]
+                    indexer.update(article_dict["id"], serialize({"doc": article_dict}))
+
+                then, now = now, datetime.datetime.now()
+                print("Articles per second: ", end="")
+                print(int(GROUP_SIZE / (now - then).total_seconds()))
 
         print("Done.")
@@ -46,7 +46,7 @@ class Command(BaseCommand):
             progress = (float(i * GROUP_SIZE) / float(narticles)) * 100
             print("{} of {} ({:.2f}%)".format(i*GROUP_SIZE, narticles, progress))
 
-            es_articles = es.query_all(filters={"ids": article_ids}, fields=HASH_FIELDS)
+            es_articles = es.query_iter(filters={"ids": article_ids}, fields=HASH_FIELDS)
             es.bulk_update_values({a.id: {"hash": _get_hash(a.to_dict())} for a in es_articles})
 
             then, now = now, datetime.datetime.now()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0005_code_label'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articleset',
+            name='index_synced_until',
+            field=models.DateTimeField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='articleset',
+            name='index_sync_checkpoint',
+            field=models.IntegerField(null=True),
+            preserve_default=True,
+        ),
+    ]
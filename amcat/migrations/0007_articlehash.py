@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0006_articleset_index_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleHash',
+            fields=[
+                ('hash', models.CharField(max_length=56, serialize=False, primary_key=True)),
+                ('article', models.ForeignKey(related_name='+', to='amcat.Article')),
+            ],
+            options={
+                'db_table': 'articles_hashes',
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('amcat', '0007_articlehash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='articleset',
+            name='deduplicate_checkpoint',
+            field=models.DateField(null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -38,6 +38,7 @@ from amcat.tools.djangotoolkit import bulk_insert_returning_ids
 
 from amcat.tools.model import AmcatModel, PostgresNativeUUIDField
 from amcat.tools import amcates
+from amcat.tools.normalize import word_len, normalize_article
 from amcat.models.authorisation import Role
 from amcat.models.medium import Medium
 from amcat.tools.toolkit import splitlist
@@ -46,28 +47,123 @@ from amcat.tools.tree import Tree
 
 log = logging.getLogger(__name__)
 
-import re
 
-WORD_RE = re.compile('[{L}{N}]+')  # {L} --> All (unicode) letters
-# {N} --> All numbers
 
+# Number of articles per INSERT in create_articles
+INSERT_BATCH_SIZE = 1000
 
-def word_len(txt):
-    """Count words in `txt`
+# Fields that have a NOT NULL constraint and are not filled in by Django on save
+REQUIRED_FIELDS = ("date", "headline", "text", "project_id", "medium_id")
 
-    @type txt: str or unicode"""
-    if not txt: return 0  # Safe handling of txt=None
-    return len(re.sub(WORD_RE, ' ', txt).split())
 
+def highlight_html(highlight, escape=True, keep_em=True):
+    """
+    Render a highlighted field by wrapping its hits in em tags
+
+    @param highlight: highlighted field as returned by ES.highlight_articles
+    @type highlight: amcates.Highlight
+
+    @param escape: escape html entities in result
+    @param keep_em: has no effect if escape is False. If False, the em tags are escaped as well.
+    """
+    pre, post = amcates.HIGHLIGHT_PRE_TAG, amcates.HIGHLIGHT_POST_TAG
+    if escape and not keep_em:
+        pre, post = escape_filter(pre), escape_filter(post)
+    esc = escape_filter if escape else (lambda s: s)
+
+    text, parts, end = highlight.text, [], 0
+    for offset, length in highlight.offsets:
+        parts += [esc(text[end:offset]), pre, esc(text[offset:offset + length]), post]
+        end = offset + length
+    parts.append(esc(text[end:]))
+    return "".join(parts)
+
+
+def check_article(article):
+    """
+    Check an unsaved article against the constraints of the articles table (not null, maximum
+    length), so a single invalid article does not make a whole insert batch fail.
+    @raises: ValidationError if the article cannot be saved
+    """
+    for attname in REQUIRED_FIELDS:
+        if getattr(article, attname) is None:
+            raise ValidationError("Article field {attname} cannot be null".format(**locals()))
 
-def unescape_em(txt):
+    for field in article._meta.fields:
+        if isinstance(field, models.CharField) and field.max_length:
+            value = getattr(article, field.attname)
+            if isinstance(value, basestring) and len(value) > field.max_length:
+                raise ValidationError("Article field {field.name} is longer than {field.max_length} characters"
+                                      .format(**locals()))
+
+
+def _get_insert_batches(articles, batch_size):
+    """
+    Split articles in batches that can be inserted at once. A new batch is started if an
+    article has a parent that has not been saved yet (so the batches should be inserted as
+    they are generated), or if it differs from the batch in having an id.
+    """
+    batch = []
+    for a in articles:
+        if batch and (len(batch) >= batch_size or (a.parent is not None and a.parent.id is None)
+                      or (a.id is None) != (batch[0].id is None)):
+            yield batch
+            batch = []
+        batch.append(a)
+    if batch:
+        yield batch
+
+
+def _save_articles(articles, errors):
+    """
+    Save the articles one by one, each in its own savepoint
+    @param errors: list to which the errors of articles that could not be saved are appended
+    @return: the articles that were saved
     """
-    @param txt: text to be unescaped
-    @type txt: unicode
+    for a in articles:
+        if a.parent:
+            a.parent_id = a.parent.id
+
+        sid = transaction.savepoint()
+        try:
+            a.save()
+            transaction.savepoint_commit(sid)
+        except (IntegrityError, ValidationError, DatabaseError) as e:
+            log.warning(str(e))
+            transaction.savepoint_rollback(sid)
+            errors.append(e)
+            continue
+        yield a
+
+
+def _bulk_save_articles(articles, errors, batch_size=INSERT_BATCH_SIZE):
     """
-    return (txt
-            .replace("&lt;em&gt;", "<em>")
-            .replace("&lt;/em&gt;", "</em>"))
+    Save the articles with a multi-row INSERT .. RETURNING per batch, setting their ids.
+    If a batch fails, only its articles are saved one by one to find the invalid ones.
+    @param errors: list to which the errors of articles that could not be saved are appended
+    @return: the articles that were saved
+    """
+    for batch in _get_insert_batches(articles, batch_size):
+        for a in batch:
+            if a.parent:
+                a.parent_id = a.parent.id
+
+        sid = transaction.savepoint()
+        try:
+            saved = bulk_insert_returning_ids(batch, include_pk=batch[0].id is not None)
+            transaction.savepoint_commit(sid)
+        except DatabaseError as e:
+            transaction.savepoint_rollback(sid)
+            log.warning("Could not insert batch of {} articles, saving them one by one: {}".format(len(batch), e))
+            for a in _save_articles(batch, errors):
+                yield a
+            continue
+
+        for a, saved_article in zip(batch, saved):
+            a.id = saved_article.id
+            a._state.adding = False
+            a._state.db = saved_article._state.db
+            yield a
 
 
 class ArticleTree(Tree):
@@ -156,26 +252,36 @@ class Article(AmcatModel):
         @type keep_em: bool
         """
         if self._highlighted: return
-        self._highlighted = True
+        highlights = amcates.ES().highlight_articles([self.id], query).get(self.id)
+        self._set_highlights(highlights, escape, keep_em)
+        return highlights
+
+    @classmethod
+    def highlight_articles(cls, articles, query, escape=True, keep_em=True):
+        """
+        Highlight a sequence of articles (e.g. a page of search results) like highlight(),
+        using a single elastic request.
+        """
+        articles = [a for a in articles if not a._highlighted]
+        highlights = amcates.ES().highlight_articles([a.id for a in articles], query)
+        for article in articles:
+            article._set_highlights(highlights.get(article.id), escape, keep_em)
 
-        highlighted = amcates.ES().highlight_article(self.id, query)
+    def _set_highlights(self, highlights, escape, keep_em):
+        self._highlighted = True
 
-        if not highlighted:
+        if not highlights:
             # No hits for this search query
             return
 
-        self.text = highlighted.get("text", self.text)
-        self.headline = highlighted.get("headline", self.headline)
-
-        if escape:
-            self.text = escape_filter(self.text)
-            self.headline = escape_filter(self.headline)
-
-            if keep_em:
-                self.text = unescape_em(self.text)
-                self.headline = unescape_em(self.headline)
-
-        return highlighted
+        for field in ("text", "headline"):
+            if field in highlights:
+                value = highlight_html(highlights[field], escape, keep_em)
+            elif escape:
+                value = escape_filter(getattr(self, field))
+            else:
+                continue
+            setattr(self, field, value)
 
     @property
     def children(self):
@@ -252,9 +358,6 @@ class Article(AmcatModel):
         """
         # TODO: test parent logic (esp. together with hash/dupes)
         es = amcates.ES()
-        for a in articles:
-            if a.length is None:
-                a.length = word_len(a.text) + word_len(a.headline) + word_len(a.byline)
         # existing / duplicate article ids to add to set
         add_to_set = set()
         # add dict (+hash) as property on articles so we know who is who
@@ -265,21 +368,19 @@ class Article(AmcatModel):
                 # article already exists, only add to set
                 add_to_set.add(a.id)
             else:
-                a.es_dict = amcates.get_article_dict(a, sets=sets)
+                normalize_article(a, sets=sets)
                 todo.append(a)
 
-        if check_duplicate:
-            hashes = [a.es_dict['hash'] for a in todo]
-            results = es.query_all(filters={'hashes': hashes}, fields=["hash", "sets"], score=False)
-            dupes = {r.hash: r for r in results}
-        else:
-            dupes = {}
+        from amcat.tools.duplicates import DuplicateFinder
+        finder = DuplicateFinder(es)
+        dupes = finder.find(a.es_dict['hash'] for a in todo) if check_duplicate else {}
 
         # add all non-dupes to the db, needed actions
         add_new_to_set = set()  # new article ids to add to set
         add_to_index = []  # es_dicts to add to index
         result = []  # return result
         errors = []  # return errors
+        new = []  # articles to save
         for a in todo:
             dupe = dupes.get(a.es_dict['hash'], None)
             a.duplicate = bool(dupe)
@@ -288,22 +389,20 @@ class Article(AmcatModel):
                 if articleset and not (dupe.sets and articleset.id in dupe.sets):
                     add_to_set.add(dupe.id)
             else:
-                if a.parent:
-                    a.parent_id = a.parent.id
-
-                sid = transaction.savepoint()
                 try:
-                    a.save()
-                    transaction.savepoint_commit(sid)
-                except (IntegrityError, ValidationError, DatabaseError) as e:
+                    check_article(a)
+                except ValidationError as e:
                     log.warning(str(e))
-                    transaction.savepoint_rollback(sid)
                     errors.append(e)
                     continue
-                result.append(a)
-                a.es_dict['id'] = a.pk
-                add_to_index.append(a.es_dict)
-                add_new_to_set.add(a.pk)
+                new.append(a)
+
+        for a in _bulk_save_articles(new, errors):
+            result.append(a)
+            a.es_dict['id'] = a.pk
+            add_to_index.append(a.es_dict)
+            add_new_to_set.add(a.pk)
+        finder.add(result)
 
         log.info("Considered {} articles: {} saved to db, {} new to add to index, {} existing/duplicates to add to set"
                  .format(len(articles), len(add_new_to_set), len(add_to_index), len(add_to_set)))
@@ -384,3 +483,16 @@ class Article(AmcatModel):
         return ArticleTree(self, [c.get_tree(include_parents=False) for c in children
                                   if c.id != self.id])
 
+
+
+class ArticleHash(models.Model):
+    """
+    Persistent hash -> article index used to recognize duplicates on import without
+    querying elastic, see amcat.tools.duplicates
+    """
+    hash = models.CharField(max_length=56, primary_key=True)
+    article = models.ForeignKey(Article, db_index=True, related_name="+")
+
+    class Meta():
+        db_table = 'articles_hashes'
+        app_label = 'amcat'
@@ -24,15 +24,16 @@ codingjobs.
 """
 
 from __future__ import unicode_literals, print_function, absolute_import
+import io
 import itertools
 import json
 import logging
 
 from django.db import models
-from django.db import connection
+from django.db import connection, transaction
 
 from amcat.models.medium import Medium
-from amcat.models.coding.codedarticle import CodedArticle
+from amcat.models.coding.codedarticle import CodedArticle, STATUS_NOTSTARTED
 from amcat.tools.model import AmcatModel
 from amcat.tools import amcates, toolkit
 from amcat.models.article import Article
@@ -42,6 +43,10 @@ from amcat.tools.amcates import ES
 log = logging.getLogger(__name__)
 stats_log = logging.getLogger("statistics:" + __name__)
 
+# Temporary table for the ids of the articles that are added to a set, see ArticleSet._insert_articles
+ADD_ARTICLES_TABLE = "articleset_add_articles"
+_add_articles_tables = itertools.count()
+
 
 def create_new_articleset(name, project):
     """Create a new articleset based on name. If articleset exists add postfix number to make articleset name unique."""
@@ -64,6 +69,13 @@ class ArticleSet(AmcatModel):
     provenance = models.TextField(null=True)
     featured = models.BooleanField(default=False)
 
+    # State of the synchronisation with the index, see amcates.ES.synchronize_articleset
+    index_synced_until = models.DateTimeField(null=True)
+    index_sync_checkpoint = models.IntegerField(null=True)
+
+    # Last date of an interrupted deduplication, see scripts.actions.deduplicate
+    deduplicate_checkpoint = models.DateField(null=True)
+
     class Meta():
         app_label = 'amcat'
         db_table = 'articlesets'
@@ -84,7 +96,7 @@ class ArticleSet(AmcatModel):
         from amcat.tools.amcates import ES
         return ES().count(filters={"sets": self.id})
 
-    def add_articles(self, articles, add_to_index=True, monitor=ProgressMonitor()):
+    def add_articles(self, articles, add_to_index=True, monitor=ProgressMonitor(), check_existing=True):
         """
         Add the given articles to this articleset. Implementation is exists of three parts:
 
@@ -92,30 +104,90 @@ class ArticleSet(AmcatModel):
           2. Adding CodedArticle objects
           3. Updating index
 
+        The first two parts are done in a single query, see _insert_articles.
+
         @param articles: articles to be removed
         @type articles: iterable with indexing of integers or Article objects
 
         @param add_to_index: notify elasticsearch of changes
         @type add_to_index: bool
+
+        @param check_existing: if False, the articles are not checked to exist and not to be in this
+                               set already, e.g. when adding a sample of another set to a new set
+        @type check_existing: bool
         """
         articles = {(art if type(art) is int else art.id) for art in articles}
-        to_add = articles - self.get_article_ids()
-        # Only use articles that exist
-        to_add = list(Article.exists(to_add))
 
-        monitor.update(10, "{n} articles need to be added".format(n=len(to_add)))
+        monitor.update(10, "Adding {n} articles to database".format(n=len(articles)))
+        to_add = self._insert_articles(articles, check_existing) if articles else []
+
+        monitor.update(30, "{n} articles added to set and codingjobs, adding to index".format(n=len(to_add)))
+        if add_to_index:
+            amcates.ES().add_to_set(self.id, to_add, monitor=monitor)
+
+    def _insert_articles(self, article_ids, check_existing=True):
+        """
+        Add the articles to this set and to the codingjobs of this set. On postgres, the ids are
+        copied to a temporary table, from which the articles that exist and are not in this set
+        yet are inserted, so the set does not need to be loaded into memory.
+        @return: the ids of the inserted articles
+        """
+        if connection.vendor != "postgresql":
+            return self._insert_articles_naive(article_ids, check_existing)
+
+        qn = connection.ops.quote_name
+        # add_articles can be called more than once in a transaction, so use a new table each time
+        ids = qn("{}_{}".format(ADD_ARTICLES_TABLE, next(_add_articles_tables)))
+        asa = ArticleSetArticle._meta
+        asa_table = qn(asa.db_table)
+        asa_set, asa_article = (qn(asa.get_field(f).column) for f in ("articleset", "article"))
+        articles, article_pk = qn(Article._meta.db_table), qn(Article._meta.pk.column)
+        ca = CodedArticle._meta
+        ca_table = qn(ca.db_table)
+        ca_job, ca_article, ca_status = (qn(ca.get_field(f).column) for f in ("codingjob", "article", "status"))
+        cj = self.codingjob_set.model._meta
+        cj_table, cj_pk, cj_set = qn(cj.db_table), qn(cj.pk.column), qn(cj.get_field("articleset").column)
+
+        conditions = ""
+        if check_existing:
+            conditions = ("WHERE EXISTS (SELECT 1 FROM {articles} a WHERE a.{article_pk} = i.id) "
+                          "AND NOT EXISTS (SELECT 1 FROM {asa_table} s WHERE s.{asa_set} = %s "
+                          "AND s.{asa_article} = i.id)").format(**locals())
+        sql = ("WITH inserted AS ("
+               "  INSERT INTO {asa_table} ({asa_set}, {asa_article}) SELECT %s, i.id FROM {ids} i {conditions}"
+               "  RETURNING {asa_article} AS id"
+               "), coded AS ("
+               "  INSERT INTO {ca_table} ({ca_job}, {ca_article}, {ca_status})"
+               "  SELECT j.{cj_pk}, inserted.id, %s FROM inserted, {cj_table} j WHERE j.{cj_set} = %s"
+               ") SELECT id FROM inserted").format(**locals())
+        params = [self.id] + ([self.id] if check_existing else []) + [STATUS_NOTSTARTED, self.id]
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("CREATE TEMPORARY TABLE {ids} (id integer PRIMARY KEY) ON COMMIT DROP".format(**locals()))
+            cursor.copy_expert("COPY {ids} (id) FROM STDIN".format(**locals()),
+                               io.BytesIO(b"".join(b"%d\n" % aid for aid in article_ids)))
+            cursor.execute("ANALYZE {ids}".format(**locals()))
+            cursor.execute(sql, params)
+            inserted = [aid for (aid,) in cursor.fetchall()]
+        return inserted
+
+    def _insert_articles_naive(self, article_ids, check_existing=True):
+        """Add the articles to this set and its codingjobs using the ORM, see _insert_articles"""
+        to_add = article_ids
+        if check_existing:
+            to_add = to_add - self.get_article_ids()
+            # Only use articles that exist
+            to_add = Article.exists(to_add)
+        to_add = list(to_add)
+
         ArticleSetArticle.objects.bulk_create(
             [ArticleSetArticle(articleset=self, article_id=artid) for artid in to_add],
             batch_size=100,
         )
-
-        monitor.update(20, "{n} articleset articles added to database, adding to codingjobs".format(n=len(to_add)))
         cjarts = [CodedArticle(codingjob=c, article_id=a) for c, a in itertools.product(self.codingjob_set.all(), to_add)]
         CodedArticle.objects.bulk_create(cjarts)
-
-        monitor.update(30, "{n} articles added to codingjobs, adding to index".format(n=len(cjarts)))
-        if add_to_index:
-            amcates.ES().add_to_set(self.id, to_add, monitor=monitor)
+        return to_add
 
     def add(self, *articles):
         """add(*a) is an alias for add_articles(a)"""
@@ -156,6 +228,27 @@ class ArticleSet(AmcatModel):
         cursor.close() # no idea if it's needed, but Martijn told me to do it
         return result
 
+    def iter_article_ids(self, after=None, inserted_since=None, batch_size=10000):
+        """
+        Yield the ids of the articles in this set in ascending order. Ids are fetched in
+        batches using keyset pagination, so memory use does not depend on the set size.
+
+        @param after: only yield ids greater than this article id
+        @param inserted_since: only yield articles with an insertdate on or after this datetime
+        """
+        articles = ArticleSetArticle.objects.filter(articleset=self)
+        if inserted_since is not None:
+            articles = articles.filter(article__insertdate__gte=inserted_since)
+
+        while True:
+            batch = articles if after is None else articles.filter(article_id__gt=after)
+            ids = list(batch.order_by("article_id").values_list("article_id", flat=True)[:batch_size])
+            for aid in ids:
+                yield aid
+            if len(ids) < batch_size:
+                return
+            after = ids[-1]
+
     def get_article_ids_from_elastic(self):
         """
         Return the sequence of ids of articles in this set. As opposed to get_article_ids, this
@@ -165,13 +258,13 @@ class ArticleSet(AmcatModel):
         """
         return set(ES().query_ids(filters={"sets" : [self.id]}))
 
-    def refresh_index(self, full_refresh=False):
+    def refresh_index(self, full_refresh=False, incremental=False):
         """
-        Make sure that the index for this set is up to date
+        Make sure that the index for this set is up to date. See
+        amcates.ES.synchronize_articleset for the meaning of the options.
         """
         from amcat.tools.amcates import ES
-        ES().check_index()
-        ES().synchronize_articleset(self, full_refresh=full_refresh)
+        ES().synchronize_articleset(self, full_refresh=full_refresh, incremental=incremental)
         self.save()
 
     def save(self, *args, **kargs):
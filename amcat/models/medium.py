@@ -18,7 +18,7 @@
 ###########################################################################
 from __future__ import unicode_literals, print_function, absolute_import
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.db.models.query import QuerySet, ValuesQuerySet
 from amcat.tools.amcates import ES
 
@@ -112,7 +112,14 @@ class Medium(AmcatModel):
         try:
             return cls.get_by_name(medium_name, ignore_case=False)
         except cls.DoesNotExist:
-            return cls.objects.create(name=medium_name)
+            pass
+
+        try:
+            with transaction.atomic():
+                return cls.objects.create(name=medium_name)
+        except IntegrityError:
+            # Created concurrently, e.g. by another upload worker process
+            return cls.objects.get(name=medium_name)
 
     class Meta():
         db_table = 'media'
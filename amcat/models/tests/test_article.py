@@ -20,6 +20,7 @@ from amcat.models import Article, word_len, ArticleTree
 from amcat.tools import amcattest
 from amcat.tools import amcates
 from amcat.tools.amcattest import create_test_article
+from amcat.tools.amcates import ES
 
 
 def _setup_highlighting():
@@ -66,6 +67,17 @@ class TestArticleHighlighting(amcattest.AmCATTestCase):
         self.assertEqual("<p>foo</p>", article.text)
         self.assertEqual("<p>bar</p>", article.headline)
 
+    @amcattest.use_elastic
+    def test_highlight_articles(self):
+        article = _setup_highlighting()
+        other = create_test_article(text="<p>bar</p>", headline="<b>foo</b>")
+        ES().flush()
+        Article.highlight_articles([article, other], "foo")
+        self.assertEqual("&lt;p&gt;<em>foo</em>&lt;/p&gt;", article.text)
+        self.assertEqual("&lt;p&gt;bar&lt;/p&gt;", other.text)
+        self.assertEqual("&lt;b&gt;<em>foo</em>&lt;/b&gt;", other.headline)
+        self.assertRaises(ValueError, other.save)
+
 
 class TestArticle(amcattest.AmCATTestCase):
     def test_save_trees(self):
@@ -174,6 +186,28 @@ class TestArticle(amcattest.AmCATTestCase):
         self.assertIn(a4.id, q(mediumid=art['medium']))
 
 
+    @amcattest.use_elastic
+    def test_create_batches(self):
+        """Are articles inserted in batches, and do invalid articles only fail themselves?"""
+        project, medium = amcattest.create_test_project(), amcattest.create_test_medium()
+        articles = [create_test_article(create=False, project=project, medium=medium, text=str(i))
+                    for i in range(20)]
+        with self.checkMaxQueries(5, "Creating 20 articles"):
+            result, errors = Article.create_articles(articles, check_duplicate=False, create_id=True)
+        self.assertEqual(len(result), 20)
+        self.assertEqual(errors, [])
+
+        # A duplicate uuid fails the batch, a missing headline is caught before inserting
+        existing = Article.objects.get(pk=articles[0].id)
+        articles = [create_test_article(create=False, project=project, medium=medium, text="new"),
+                    create_test_article(create=False, project=project, medium=medium, uuid=existing.uuid),
+                    create_test_article(create=False, project=project, medium=medium, headline=None)]
+        result, errors = Article.create_articles(articles, check_duplicate=False, create_id=True)
+        self.assertEqual(result, articles[:1])
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(Article.objects.filter(pk=articles[0].id).exists())
+        self.assertFalse(Article.objects.filter(pk=articles[1].id).exists())
+
     def test_unicode_word_len(self):
         """Does the word counter eat unicode??"""
         u = u'Kim says: \u07c4\u07d0\u07f0\u07cb\u07f9'
@@ -80,6 +80,28 @@ class TestArticleSet(amcattest.AmCATTestCase):
         self.assertEqual(4, cj.articleset.articles.all().count())
         self.assertEqual(4, CodedArticle.objects.filter(codingjob=cj).count())
 
+    @amcattest.use_elastic
+    def test_add_existing(self):
+        """Are only existing articles that are not in the set yet added, to the set, codingjobs and index?"""
+        cj = amcattest.create_test_job(2)
+        cj2 = amcattest.create_test_job(articleset=cj.articleset)
+        s = cj.articleset
+        old = list(s.articles.values_list("pk", flat=True))
+        new = [amcattest.create_test_article() for _x in range(3)]
+        missing = max(a.id for a in new) + 1000
+
+        s.add_articles(new[:2] + old + [missing])
+        s.add_articles([new[2].id, new[0].id])
+        ES().flush()
+
+        ids = set(old) | {a.id for a in new}
+        self.assertEqual(set(s.articles.values_list("pk", flat=True)), ids)
+        self.assertEqual(set(ES().query_ids(filters={"sets": s.id})), ids)
+        for job in (cj, cj2):
+            self.assertEqual(sorted(CodedArticle.objects.filter(codingjob=job).values_list("article_id", flat=True)),
+                             sorted(ids))
+            self.assertEqual({ca.status_id for ca in CodedArticle.objects.filter(codingjob=job)}, {0})
+
     @amcattest.use_elastic
     def test_get_mediums(self):
         aset = amcattest.create_test_set(0)
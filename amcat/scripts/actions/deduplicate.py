@@ -23,15 +23,23 @@ import logging; log = logging.getLogger(__name__)
 
 import collections
 import itertools
+from multiprocessing.pool import ThreadPool
 
 from django import forms
 from amcat.scripts.script import Script
 
 from amcat.models import ArticleSet
 from amcat.tools.amcates import ES
+from amcat.tools.fuzzydedup import FuzzyDeduplicator
 
 import Levenshtein
 
+# Number of dates that are deduplicated concurrently, unless given as option
+CONCURRENCY = 4
+
+# Number of duplicates that are removed from the set (and the index) at once
+REMOVE_BATCH_SIZE = 10000
+
 class Deduplicate(Script):
     """
     Deduplicate articles using two articlesets. For all duplicated articles the articles in
@@ -43,6 +51,14 @@ class Deduplicate(Script):
     A very simple algorithm based on article length is used to narrow the datasets Levenshtein
     has to consider. This speeds up the process significantly, but might incur some inaccuracy. To
     disable this bahaviour use 'skip simple'.
+
+    Fuzzy duplicates can also be found using [MinHash](https://en.wikipedia.org/wiki/MinHash)
+    signatures with 'use lsh': only articles with similar signatures are compared. This is much
+    faster on large sets with many similar articles, but might miss duplicates with a low similarity.
+
+    Dates are deduplicated concurrently, and duplicates are removed in large batches. After each
+    batch the last date that is done is stored on the set, so an interrupted deduplication can
+    be continued using 'resume'.
     """
 
     def __init__(self, *args, **kwargs):
@@ -69,6 +85,9 @@ class Deduplicate(Script):
 
         dry_run = forms.BooleanField(initial=False, required=False)
         skip_simple = forms.BooleanField(initial=False, required=False, help_text="Do not use an approximation of levenhstein ratio using article length (if using fuzzy text or headline")
+        concurrency = forms.IntegerField(required=False, min_value=1, help_text="Number of dates to deduplicate concurrently (default: {})".format(CONCURRENCY))
+        resume = forms.BooleanField(initial=False, required=False, help_text="Continue an interrupted deduplication, skipping the dates that were done")
+        use_lsh = forms.BooleanField(initial=False, required=False, help_text="Only compare articles with similar MinHash signatures (if using fuzzy text or headline). Much faster for large sets, but might miss duplicates with a low similarity")
 
 
     def get_matching(self, compare_with, article, ratio, prop):
@@ -122,24 +141,18 @@ class Deduplicate(Script):
             if compare_with:
                 yield (article, compare_with)
 
+    def get_fuzzy_fields(self):
+        """Get the fields that are compared fuzzily, with their minimal ratio"""
+        return {field: self.options[field+'_ratio'] / 100.
+                for field in ('headline', 'text') if self.options[field+'_ratio']}
+
     def is_fuzzy_dupe(self, a, b):
-        for field in 'headline', 'text':
-            ratio = self.options[field+'_ratio']
-            if ratio:
-                similarity =  Levenshtein.ratio(getattr(a, field), getattr(b, field))
-                if similarity < (ratio / 100.):
-                    return False
-        return True
-                
+        return FuzzyDeduplicator(self.get_fuzzy_fields()).is_duplicate(a, b)
+
     def fuzzy_dedup(self, arts):
         """Do fuzzy deduplication on the given articles"""
-        arts = sorted(arts, key=lambda a:a.id)
-        while len(arts) > 1:
-            a = arts.pop(0)
-            dupes = [b for b in arts if self.is_fuzzy_dupe(a,b)]
-            if dupes:
-                arts = [a for a in arts if a not in dupes]
-                yield a, dupes
+        deduplicator = FuzzyDeduplicator(self.get_fuzzy_fields(), use_lsh=self.options['use_lsh'])
+        return deduplicator.deduplicate(arts)
 
     def get_fields(self, ignore_fuzzy=False):
         """
@@ -157,12 +170,12 @@ class Deduplicate(Script):
                 yield f
 
     def get_duplicates(self, date):
-        fields = list(self.get_fields())
         compare_fields = list(self.get_fields(ignore_fuzzy=True))
+        fields = list(set(self.get_fields()) | set(compare_fields) | set(self.get_fuzzy_fields()))
 
         dupes = collections.defaultdict(set)
-        for a in ES().query_all(filters={"sets": self.options['articleset'],
-                                         "on_date": date}, fields=fields):
+        for a in ES().query_iter(filters={"sets": self.options['articleset'],
+                                          "on_date": date}, fields=fields):
             key = tuple(getattr(a, f) for f in compare_fields)
             dupes[key].add(a)
 
@@ -175,23 +188,61 @@ class Deduplicate(Script):
                     aids = sorted(a.id for a in arts)
                     yield aids[0], aids[1:]
                 
-    def _run(self, articleset, save_duplicates_to, dry_run, **kwargs):
+    def get_date_duplicates(self, date):
+        log.debug("Getting duplicates for {date}".format(**locals()))
+        return date, dict(self.get_duplicates(date))
+
+    def get_dates(self, articleset, resume):
+        dates = ES().list_dates(filters={"sets": articleset})
+        checkpoint = articleset.deduplicate_checkpoint
+        if resume and checkpoint is not None:
+            log.info("Resuming deduplication of set {articleset.id} after {checkpoint}".format(**locals()))
+            return [date for date in dates if date.date() > checkpoint]
+        return list(dates)
+
+    def _set_checkpoint(self, articleset, date):
+        ArticleSet.objects.filter(pk=articleset.pk).update(deduplicate_checkpoint=date)
+        articleset.deduplicate_checkpoint = date
+
+    def remove_duplicates(self, articleset, todelete, date):
+        """Remove the duplicates of all dates up to and including the given date"""
+        log.debug("Removing {} duplicates up to {date}".format(len(todelete), **locals()))
+        if not self.options['dry_run']:
+            articleset.remove_articles(todelete)
+            self._set_checkpoint(articleset, date)
+        if self.options['save_duplicates_to']:
+            if self._dupes_save_set is None:
+                self._dupes_save_set = ArticleSet.create_set(articleset.project, self.options['save_duplicates_to'])
+            self._dupes_save_set.add_articles(todelete)
+
+    def _run(self, articleset, dry_run, concurrency, resume, **kwargs):
         all_dupes = {}
-        dupes_save_set = None
+        self._dupes_save_set = None
         log.debug("Deduplicating {articleset.id}".format(**locals()))
-        for date in ES().list_dates(filters={"sets": articleset}):
-            log.debug("Getting duplicates for {date}".format(**locals()))
-            dupes = dict(self.get_duplicates(date))
-            if dupes:
+        dates = self.get_dates(articleset, resume)
+        if not (resume or dry_run):
+            self._set_checkpoint(articleset, None)
+
+        # Dates are deduplicated concurrently, but the results are handled in order, so after
+        # the duplicates are removed all dates up to the last removed date are done
+        pool = ThreadPool(concurrency or CONCURRENCY)
+        try:
+            todelete = []
+            for date, dupes in pool.imap(self.get_date_duplicates, dates):
                 all_dupes.update(dupes)
-                todelete = list(itertools.chain(*dupes.values()))
-                if not dry_run:
-                    articleset.remove_articles(todelete)
-                if save_duplicates_to:
-                    if dupes_save_set is None:
-                        dupes_save_set = ArticleSet.create_set(articleset.project, save_duplicates_to)
-                    dupes_save_set.add_articles(todelete)
-
+                todelete.extend(itertools.chain(*dupes.values()))
+                if len(todelete) >= REMOVE_BATCH_SIZE:
+                    self.remove_duplicates(articleset, todelete, date)
+                    todelete = []
+            if todelete:
+                self.remove_duplicates(articleset, todelete, date)
+        finally:
+            # imap queues all dates, so stop the remaining lookups if processing failed
+            pool.terminate()
+            pool.join()
+
+        if not dry_run:
+            self._set_checkpoint(articleset, None)
         log.debug("Deleted dupes for {} articles".format(len(all_dupes)))
         return all_dupes
 
@@ -27,14 +27,57 @@ from amcat.models import ArticleSet
 from hashlib import sha224 as hash_class
 from django import forms
 from amcat.tools import amcates
+from amcat.tools.toolkit import splitlist
+from operator import itemgetter
+import heapq
+import itertools
 import json
-import collections
+import tempfile
 
 FIELDS = ["text", "headline", "date", "creator", "medium", "byline", "section", "page", "addressee", "length"]
 
+# Number of (hash, id) pairs that are sorted in memory, see group_hashes
+RUN_SIZE = 1000000
+
+# Number of duplicates that are removed from the set at once
+REMOVE_BATCH_SIZE = 10000
+
+
+def _write_run(lines):
+    """Write the lines in sorted order to a temporary file"""
+    f = tempfile.TemporaryFile()
+    f.writelines(sorted(lines))
+    f.seek(0)
+    return f
+
+
+def group_hashes(pairs, run_size=RUN_SIZE):
+    """
+    Group (id, hash) pairs by hash, without keeping all pairs in memory: the pairs are
+    written to sorted runs of run_size pairs on disk, which are merged.
+    @return: a sequence of (hash, [ids]) pairs for the hashes with more than one id
+    """
+    runs = []
+    try:
+        for i, batch in enumerate(splitlist(pairs, itemsperbatch=run_size)):
+            logging.info("Collecting hashes, run {i}, n={n}".format(n=i * run_size + len(batch), **locals()))
+            runs.append(_write_run("{}\t{}\n".format(hash, id) for (id, hash) in batch))
+
+        lines = (line.rstrip("\n").split("\t") for line in heapq.merge(*runs))
+        for hash, group in itertools.groupby(lines, key=itemgetter(0)):
+            ids = [int(id) for (_, id) in group]
+            if len(ids) > 1:
+                yield hash, ids
+    finally:
+        for f in runs:
+            f.close()
+
 class DeduplicateSet(Script):
     """
     Deduplicate an articleset, optionally using a limited set of fields
+
+    The hashes of all articles are sorted on disk to find the duplicates, so memory use does
+    not depend on the size of the set.
     """
 
     class options_form(forms.Form):
@@ -66,37 +109,35 @@ class DeduplicateSet(Script):
                                      help_text="Prints all duplicates but doesn't remove them")
 
     def _run(self, articleset, save_duplicates_to, dry_run, **_):
-        hashes = collections.defaultdict(set)
-        for i, (id, h) in enumerate(self.get_hashes()):
-            if not i%100000:
-                logging.info("Collecting hashes, n={i}, |hashes|={n}".format(n=len(hashes), **locals()))
-            hashes[h].add(id)
-
-        hashes = {hash: ids for (hash, ids) in hashes.iteritems() if len(ids)>1}
-        logging.info("Duplicates founds for {} articles".format(len(hashes)))
-
-        to_remove = set()
-        logging.info("Iterating over hashes")
-        for i, (hash, ids) in enumerate(hashes.iteritems()):
-            if dry_run:
-                logging.info("Duplicates: {ids}".format(**locals()))
-            to_remove |= set(sorted(ids)[1:])
-            if not i % 100000:
-                logging.info("Iterating over hashes {i}/{n}, |to_remove|={m}".format(n=len(hashes), m=len(to_remove), **locals()))
-
-        n = len(to_remove)
-        if not to_remove:
-            logging.info("No duplicates found!")
-        else:
-            if dry_run:
-                logging.info("{n} duplicate articles found, run without dry_run to remove".format(**locals()))
-            else:
-                logging.info("Removing {n} articles from set".format(**locals()))
+        n = 0
+        dupes_article_set = None
+        logging.info("Iterating over duplicates")
+        for to_remove in splitlist(self.get_duplicates(), itemsperbatch=REMOVE_BATCH_SIZE):
+            n += len(to_remove)
+            if not dry_run:
+                logging.info("Removing {} articles from set, n={n}".format(len(to_remove), **locals()))
                 articleset.remove_articles(to_remove)
             if save_duplicates_to:
-                dupes_article_set = ArticleSet.create_set(articleset.project, save_duplicates_to, to_remove)
+                if dupes_article_set is None:
+                    dupes_article_set = ArticleSet.create_set(articleset.project, save_duplicates_to)
+                dupes_article_set.add_articles(to_remove)
+
+        if not n:
+            logging.info("No duplicates found!")
+        elif dry_run:
+            logging.info("{n} duplicate articles found, run without dry_run to remove".format(**locals()))
         return n, dry_run
 
+    def get_duplicates(self):
+        """Yield the ids of the articles that are duplicates of an article with a lower id"""
+        for i, (hash, ids) in enumerate(group_hashes(self.get_hashes())):
+            if self.options['dry_run']:
+                logging.info("Duplicates: {ids}".format(**locals()))
+            if not i % 100000:
+                logging.info("Iterating over hashes, i={i}".format(**locals()))
+            for id in sorted(ids)[1:]:
+                yield id
+
     def get_hashes(self):
         fields =  [f for f in FIELDS if not self.options.get("skip_{}".format(f))]
         if fields == FIELDS:
@@ -36,12 +36,13 @@ class RefreshIndex(Script):
     class options_form(forms.Form):
         articleset = forms.ModelChoiceField(queryset=ArticleSet.objects.all())
         full_refresh = forms.BooleanField(initial=False, required=False)
-        
+        incremental = forms.BooleanField(initial=False, required=False)
+
 
-                                        
-    def _run(self, articleset, full_refresh):
-        log.info("Refreshing {articleset}, full_refresh={full_refresh}".format(**locals()))
-        articleset.refresh_index(full_refresh=full_refresh)
+    def _run(self, articleset, full_refresh, incremental):
+        log.info("Refreshing {articleset}, full_refresh={full_refresh}, incremental={incremental}"
+                 .format(**locals()))
+        articleset.refresh_index(full_refresh=full_refresh, incremental=incremental)
         
 if __name__ == '__main__':
     from amcat.scripts.tools import cli
@@ -30,16 +30,29 @@ log = logging.getLogger(__name__)
 from django import forms
 
 from amcat.scripts.script import Script
-from amcat.models import ArticleSet
+from amcat.models import ArticleSet, ArticleSetArticle
+from amcat.tools import sampling
 
 PLUGINTYPE_PARSER = 1
 
 
 class SampleSet(Script):
+    """
+    Create a new set with a random sample of the articles in a set. The sample can be drawn
+    proportionally from each medium or date interval (stratify), and can be made reproducible
+    by giving a seed. See amcat.tools.sampling.
+    """
+
     class options_form(forms.Form):
         articleset = forms.ModelChoiceField(queryset=ArticleSet.objects.all())
         sample = forms.CharField(help_text="Sample in absolute number or percentage")
         target_articleset_name = forms.CharField(help_text="Name for the new articleset")
+        seed = forms.IntegerField(required=False, help_text="Random seed, use the same seed to draw the same sample")
+        stratify = forms.ChoiceField(choices=[("", "---")] + [(s, s) for s in sampling.STRATA], required=False,
+                                     help_text="Sample proportionally from each medium or date interval")
+        tablesample = forms.BooleanField(initial=False, required=False,
+                                         help_text="Sample a percentage using TABLESAMPLE. Much faster for "
+                                                   "large sets, but the sample size is approximate")
 
         def clean_sample(self):
             sample = self.cleaned_data["sample"]
@@ -54,22 +67,34 @@ class SampleSet(Script):
             self.cleaned_data["sample"] = result
             return result
 
-    def _run(self, articleset, sample, target_articleset_name):
-        log.info("Sampling {sample} from {articleset}".format(**locals()))
-        if not isinstance(sample, int):
-            n = articleset.articles.count()
-            sample = int(round(n * sample))
-            log.info("Sampling {sample} of {n} articles".format(**locals()))
+        def clean(self):
+            cleaned_data = super(SampleSet.options_form, self).clean()
+            if cleaned_data.get("tablesample"):
+                if isinstance(cleaned_data.get("sample"), int):
+                    raise forms.ValidationError("Only a percentage can be sampled using TABLESAMPLE")
+                if cleaned_data.get("stratify"):
+                    raise forms.ValidationError("Cannot stratify a sample using TABLESAMPLE")
+            return cleaned_data
 
-        selected = articleset.articles.order_by('?')[:sample]
-        ids = [x for (x,) in selected.values_list("pk")]
+    def _run(self, articleset, sample, target_articleset_name, seed, stratify, tablesample):
+        log.info("Sampling {sample} from {articleset}".format(**locals()))
+        if tablesample:
+            ids = sampling.tablesample_articleset(articleset, sample, seed)
+        else:
+            if not isinstance(sample, int):
+                n = ArticleSetArticle.objects.filter(articleset=articleset).count()
+                sample = int(round(n * sample))
+                log.info("Sampling {sample} of {n} articles".format(**locals()))
+            ids = sampling.sample_articleset(articleset, sample, seed, stratify)
 
         target_set = ArticleSet.objects.create(name=target_articleset_name, project=articleset.project)
         log.info(
             "Created set {target_set.id}:{target_set} in project {target_set.project_id}:{target_set.project}!".format(
                 **locals()))
 
-        target_set.add_articles(ids)
+        # Articles sampled from the database exist and the new set is empty, so there is nothing to
+        # check. Stratified samples come from the index, which might not match the database.
+        target_set.add_articles(ids, check_existing=bool(stratify))
 
         log.info("Done!")
 
@@ -1,3 +1,7 @@
+import datetime
+
+from amcat.models import ArticleSet
+from amcat.scripts.actions import deduplicate
 from amcat.scripts.actions.deduplicate import Deduplicate
 from amcat.tools import amcattest
 from amcat.tools.amcates import ES
@@ -75,4 +79,37 @@ class TestDedup(amcattest.AmCATTestCase):
         self.assertEqual(self.do_test(arts, ignore_medium=True), {1,2,3,4})
         self.assertEqual(self.do_test(arts, ignore_medium=True, headline_ratio=90), {1,2,4})
         self.assertEqual(self.do_test(arts, ignore_medium=True, headline_ratio=80), {1,4})
-        self.assertEqual(self.do_test(arts, ignore_medium=True, headline_ratio=50), {1})
\ No newline at end of file
+        self.assertEqual(self.do_test(arts, ignore_medium=True, headline_ratio=50), {1})
+
+    @amcattest.use_elastic
+    def test_resume(self):
+        class CrashingDeduplicate(Deduplicate):
+            def get_duplicates(self, date):
+                if date.day == 3:
+                    raise ValueError("Crash on {}".format(date))
+                return super(CrashingDeduplicate, self).get_duplicates(date)
+
+        s = amcattest.create_test_set()
+        m = amcattest.create_test_medium()
+        for i, date in enumerate(["2001-01-01", "2001-01-01", "2001-01-02", "2001-01-02",
+                                  "2001-01-03", "2001-01-03"], start=1):
+            amcattest.create_test_article(id=i, articleset=s, medium=m, date=date)
+        ES().flush()
+
+        # Duplicates are removed per batch, and the last date that is done is stored
+        batch_size, deduplicate.REMOVE_BATCH_SIZE = deduplicate.REMOVE_BATCH_SIZE, 1
+        try:
+            self.assertRaises(ValueError, CrashingDeduplicate(articleset=s.id, concurrency=2).run)
+        finally:
+            deduplicate.REMOVE_BATCH_SIZE = batch_size
+        ES().flush()
+        self.assertEqual(set(s.articles.values_list("pk", flat=True)), {1, 3, 5, 6})
+        self.assertEqual(ArticleSet.objects.get(pk=s.id).deduplicate_checkpoint, datetime.date(2001, 1, 2))
+
+        # Dates up to the checkpoint are skipped when resuming
+        amcattest.create_test_article(id=7, articleset=s, medium=m, date="2001-01-01")
+        ES().flush()
+        Deduplicate(articleset=s.id, resume=True).run()
+        ES().flush()
+        self.assertEqual(set(s.articles.values_list("pk", flat=True)), {1, 3, 5, 7})
+        self.assertIsNone(ArticleSet.objects.get(pk=s.id).deduplicate_checkpoint)
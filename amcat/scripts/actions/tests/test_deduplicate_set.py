@@ -0,0 +1,43 @@
+import random
+
+from amcat.scripts.actions import deduplicate_set
+from amcat.scripts.actions.deduplicate_set import DeduplicateSet, group_hashes
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+
+
+class TestDeduplicateSet(amcattest.AmCATTestCase):
+    def test_group_hashes(self):
+        random.seed(1)
+        pairs = [(id, "h{}".format(random.randint(0, 300))) for id in range(1000)]
+        random.shuffle(pairs)
+        expected = {}
+        for id, hash in pairs:
+            expected.setdefault(hash, []).append(id)
+        expected = {hash: sorted(ids) for (hash, ids) in expected.items() if len(ids) > 1}
+
+        groups = list(group_hashes(iter(pairs), run_size=77))
+        self.assertEqual([hash for (hash, _) in groups], sorted(expected))
+        self.assertEqual({hash: sorted(ids) for (hash, ids) in groups}, expected)
+        self.assertEqual(list(group_hashes(iter([]))), [])
+
+    @amcattest.use_elastic
+    def test_deduplicate(self):
+        s = amcattest.create_test_set()
+        m1, m2 = [amcattest.create_test_medium() for _x in range(2)]
+        for id, medium, pagenr in [(1, m1, 1), (2, m1, 1), (3, m1, 2), (4, m2, 1), (5, m2, 2)]:
+            amcattest.create_test_article(id=id, articleset=s, medium=medium, pagenr=pagenr)
+        ES().flush()
+
+        self.assertEqual(DeduplicateSet(articleset=s.id, dry_run=True).run(), (1, True))
+        self.assertEqual(set(s.articles.values_list("pk", flat=True)), {1, 2, 3, 4, 5})
+
+        batch_size, deduplicate_set.REMOVE_BATCH_SIZE = deduplicate_set.REMOVE_BATCH_SIZE, 1
+        try:
+            self.assertEqual(DeduplicateSet(articleset=s.id, skip_medium=True, save_duplicates_to="dupes").run(),
+                             (3, False))
+        finally:
+            deduplicate_set.REMOVE_BATCH_SIZE = batch_size
+        self.assertEqual(set(s.articles.values_list("pk", flat=True)), {1, 3})
+        dupes = s.project.articlesets_set.get(name="dupes")
+        self.assertEqual(set(dupes.articles.values_list("pk", flat=True)), {2, 4, 5})
@@ -20,69 +20,222 @@ from __future__ import absolute_import
 """
 Module for running scrapers
 """
+import collections
 import json
 
+import billiard
 import logging
 
 log = logging.getLogger(__name__)
 stats_log = logging.getLogger("statistics:" + __name__)
 
 from collections import namedtuple
-from amcat.models import Article, Project
+from django.db import transaction
+from amcat.models import Article, Project, Medium
+from amcat.tools.progress import NullMonitor
 
 ScrapeError = namedtuple("ScrapeError", ["i", "unit", "error"])
 
+# Number of articles that are parsed before they are saved to the database and index
+CHUNK_SIZE = 1000
+
+# Number of units queued per worker process when parsing in parallel
+UNITS_PER_PROCESS = 4
+
+# The scraper used by the worker processes. It is set before the pool is created, so the
+# (forked) workers inherit it and only units and articles need to be pickled.
+_worker_scraper = None
+
+
+def _get_unsaved_medium(cls, medium_name):
+    """Medium.get_or_create in worker processes: the medium is looked up or created by the controller"""
+    return None if medium_name is None else cls(name=medium_name)
+
+
+def _init_worker():
+    """
+    Let parsers create unsaved media in worker processes instead of using the database: the
+    workers share the database connection (and possibly the transaction) of the parent process,
+    so only the parent may use it.
+    """
+    Medium.get_or_create = classmethod(_get_unsaved_medium)
+    Article._meta.get_field("medium").allow_unsaved_instance_assignment = True
+
+
+def _scrape_unit(unit):
+    """Parse a unit in a worker process, returning an (articles, exception) pair"""
+    try:
+        return list(_worker_scraper._scrape_unit(unit)), None
+    except Exception as e:
+        log.exception("scraper._scrape_unit failed")
+        return None, e
+
 
 class Controller(object):
-    def __init__(self):
+    def __init__(self, loader=None, chunk_size=CHUNK_SIZE, monitor=NullMonitor(), processes=None):
+        """
+        @param loader: optional loader (e.g. amcat.tools.copyloader.CopyLoader) used to save the
+                       articles instead of Article.create_articles
+        @param chunk_size: number of articles to save at a time. Units are parsed lazily, so
+                           at most one chunk of articles (plus one unit) is kept in memory.
+        @param monitor: ProgressMonitor that is updated after each chunk
+        @param processes: if given, parse units in this many worker processes. Units and
+                          articles should be picklable, and _scrape_unit should not depend on
+                          state set by other units or use the database, except for
+                          Medium.get_or_create: the media are looked up (or created) and the
+                          articles are saved by this process.
+        """
         self.errors = []
-        self.articles = []
+        self.saved_article_ids = set()
+        self.loader = loader
+        self.chunk_size = chunk_size
+        self.monitor = monitor
+        self.processes = processes
+        self.media = {}  # medium name -> Medium, for the articles parsed by worker processes
 
-    def run(self, scraper):
+    def _get_pool(self, scraper):
+        """
+        Return a pool of worker processes for the scraper. This uses billiard (celery's fork of
+        multiprocessing), which unlike multiprocessing allows celery workers to have children.
+        """
+        global _worker_scraper
+        _worker_scraper = scraper
+        return billiard.Pool(self.processes, initializer=_init_worker)
+
+    def _get_medium(self, name):
         try:
-            units = list(scraper._get_units())
-        except Exception as e:
-            self.errors.append(ScrapeError(None, None, e))
-            log.exception("scraper._get_units failed")
-            return self.articles
+            return self.media[name]
+        except KeyError:
+            medium = self.media[name] = Medium.get_or_create(name)
+            return medium
+
+    def _set_media(self, articles):
+        """Replace the unsaved media created by the worker processes by media from the database"""
+        for article in articles:
+            medium = getattr(article, "medium", None)
+            if medium is not None and medium.pk is None:
+                article.medium = self._get_medium(medium.name)
+
+    def _scrape_parallel(self, pool, units):
+        """Yield (i, unit, articles, exception) tuples in unit order, parsing in the pool"""
+        pending = collections.deque()
+
+        def get_result():
+            i, unit, result = pending.popleft()
+            try:
+                articles, e = result.get()
+            except Exception as e:
+                # e.g. the articles could not be pickled
+                articles = None
+            if articles is not None:
+                self._set_media(articles)
+            return i, unit, articles, e
+
+        try:
+            for i, unit in enumerate(units):
+                pending.append((i, unit, pool.apply_async(_scrape_unit, [unit])))
+                if len(pending) >= self.processes * UNITS_PER_PROCESS:
+                    yield get_result()
+            while pending:
+                yield get_result()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
+    def _scrape_sequential(self, scraper, units):
+        """Yield (i, unit, articles, exception) tuples in unit order"""
         for i, unit in enumerate(units):
             try:
-                articles = list(scraper._scrape_unit(unit))
+                articles, e = list(scraper._scrape_unit(unit)), None
             except Exception as e:
                 log.exception("scraper._scrape_unit failed")
-                self.errors.append(ScrapeError(i, unit, e))
-                continue
-            self.articles += articles
+                articles = None
+            yield i, unit, articles, e
+
+    def _scrape_units(self, scraper):
+        """Yield the articles of all units, adding ScrapeErrors for units that fail"""
+        pool = self._get_pool(scraper) if self.processes else None
+        try:
+            units = scraper._get_units()
+            if pool is None:
+                results = self._scrape_sequential(scraper, units)
+            else:
+                results = self._scrape_parallel(pool, units)
 
-        for article in self.articles:
+            for i, unit, articles, e in results:
+                if e is not None:
+                    self.errors.append(ScrapeError(i, unit, e))
+                    continue
+                for article in articles:
+                    yield article
+        except Exception as e:
+            self.errors.append(ScrapeError(None, None, e))
+            log.exception("scraper._get_units failed")
+
+    def _get_chunks(self, scraper):
+        chunk = []
+        for article in self._scrape_units(scraper):
+            chunk.append(article)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _save(self, articles, scraper):
+        """Save a chunk of articles, returning the ids of the new and duplicate articles"""
+        for article in articles:
             _set_default(article, 'project', scraper.project)
 
-        try:
-            articles, errors = Article.create_articles(self.articles, scraper.articleset)
-            self.saved_article_ids = {a.id for a in self.articles}
-            for e in errors:
+        if self.loader is not None:
+            _articles, errors = self.loader.load(articles, scraper.articleset)
+        else:
+            _articles, errors = Article.create_articles(articles, scraper.articleset)
+
+        for e in errors:
+            self.errors.append(ScrapeError(None, None, e))
+        return {a.id for a in articles if a.id is not None}
+
+    def run(self, scraper):
+        """
+        Parse the units of the scraper and save the resulting articles in chunks
+        @return: the set of ids of the saved (and duplicate) articles
+        """
+        extra_sets = getattr(scraper, "articlesets", ())
+
+        for i, chunk in enumerate(self._get_chunks(scraper)):
+            nerrors = len(self.errors)
+            try:
+                # Use a savepoint, so a database error only rolls back this chunk and does not
+                # leave an outer transaction unusable for the next chunks
+                with transaction.atomic():
+                    ids = self._save(chunk, scraper)
+
+                    # Do we need to save these id's to more sets?
+                    for aset in extra_sets:
+                        aset.add_articles(ids)
+            except Exception as e:
                 self.errors.append(ScrapeError(None, None, e))
+                log.exception("Saving articles failed")
+                continue
+
+            self.saved_article_ids |= ids
+            self.monitor.update(0, "Saved chunk {i}: {n} articles, {e} errors, {total} articles in total".format(
+                n=len(ids), e=len(self.errors) - nerrors, total=len(self.saved_article_ids), **locals()))
 
+        stats_log.info(json.dumps({
+            "action": "scraped_articles", "narticles": len(self.saved_article_ids),
+            "scraper": scraper.__class__.__name__
+        }))
+        for aset in extra_sets:
             stats_log.info(json.dumps({
-                "action": "scraped_articles", "narticles": len(self.saved_article_ids),
-                "scraper": scraper.__class__.__name__
+                "action": "add_scraped_articles", "articleset_id": aset.id,
+                "articleset__name": aset.name, "narticles": len(self.saved_article_ids),
+                "project_id": aset.project_id, "project__name": aset.project.name
             }))
-        except Exception as e:
-            self.errors.append(ScrapeError(None, None, e))
-            log.exception("scraper._get_units failed")
 
-        # Do we need to save these id's to more sets?
-        if hasattr(scraper, "articlesets") and hasattr(self, "saved_article_ids"):
-            for aset in scraper.articlesets:
-                stats_log.info(json.dumps({
-                    "action": "add_scraped_articles", "articleset_id": aset.id,
-                    "articleset__name": aset.name, "narticles": len(self.saved_article_ids),
-                    "project_id": aset.project_id, "project__name": aset.project.name
-                }))
-                aset.add_articles(self.saved_article_ids)
-
-        return getattr(self, "saved_article_ids", ())
+        return self.saved_article_ids
 
 
 def _set_default(obj, attr, val):
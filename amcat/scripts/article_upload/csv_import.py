@@ -25,6 +25,7 @@ from __future__ import unicode_literals, absolute_import
 
 import datetime
 import json
+import re
 
 from django import forms
 from django.db.models.fields import FieldDoesNotExist
@@ -61,6 +62,101 @@ def is_nullable(field_name):
         return True
 
 
+# Dates like 2001-01-01 or 2001-01-01T12:00:00, which are parsed without trying all formats of readDate
+ISO_DATE_RE = re.compile(r"^([1-9]\d{3})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d))?)?$")
+
+
+def read_iso_date(s):
+    """Parse a date like readDate, using ISO_DATE_RE if the date matches it"""
+    m = ISO_DATE_RE.match(s)
+    if m:
+        try:
+            return datetime.datetime(*(int(x) for x in m.groups(0)))
+        except ValueError:
+            pass  # e.g. 2001-31-01, let readDate figure it out
+    return readDate(s)
+
+
+class RowConverter(object):
+    """
+    Converts csv rows to article fields. The columns, parsers and nullability of the fields,
+    the medium and the date format are determined once for all rows with the same header, so
+    converting a row only requires looking up its values by index.
+    """
+
+    def __init__(self, options, column_names, medium=None):
+        """
+        @param options: the upload options, containing the column name for each field in FIELDS
+        @param column_names: the header of the csv file
+        @param medium: the Medium for all articles, or None if it is given by a column
+        @raises: KeyError if a field refers to a column that is not in the header (see CSV.explain_error)
+        """
+        self.column_names = column_names
+        self.medium = medium
+        self.media = {}  # medium name -> Medium
+        self.date_parser = None
+
+        # (field name, column index, parser, nullable) for each field in FIELDS with a column
+        self.fields = []
+        columns = set()
+        for fieldname in FIELDS:
+            column = options[fieldname]
+            if not column:
+                continue
+            if column not in column_names:
+                raise KeyError(column)
+            columns.add(column)
+            parser = PARSERS.get(fieldname)
+            if fieldname == "medium":
+                parser = self.get_medium
+            elif fieldname == "date":
+                parser = self.parse_date
+            self.fields.append((fieldname, column_names.index(column), parser, is_nullable(fieldname)))
+
+        # (column index, column name) of the columns that are stored in the metastring
+        self.meta = [(i, name) for (i, name) in enumerate(column_names) if name not in columns]
+
+    def get_medium(self, name):
+        try:
+            return self.media[name]
+        except KeyError:
+            medium = self.media[name] = Medium.get_or_create(name)
+            return medium
+
+    def parse_date(self, s):
+        """Parse a date, using the parser chosen for the first date for the dates of all rows"""
+        if self.date_parser is None:
+            self.date_parser = read_iso_date if ISO_DATE_RE.match(s) else readDate
+        return self.date_parser(s)
+
+    def convert(self, row):
+        """
+        Convert a row to a dict of article fields, including parent_url and parent_externalid.
+        Empty values are None for nullable fields, and the unmapped columns are stored as json
+        in the metastring.
+        """
+        get = tuple.__getitem__
+        kargs = {}
+        for fieldname, index, parser, nullable in self.fields:
+            val = get(row, index)
+            if fieldname == 'date' and isinstance(val, datetime.datetime):
+                pass  # no need to parse
+            elif val.strip():
+                if parser is not None:
+                    val = parser(val)
+            elif nullable:
+                val = None
+            else:
+                val = val.strip()
+            kargs[fieldname] = val
+
+        kargs["metastring"] = json.dumps({name: get(row, i) for (i, name) in self.meta})
+
+        if self.medium is not None:
+            kargs["medium"] = self.medium
+        return kargs
+
+
 class CSVForm(UploadScript.options_form, fileupload.CSVUploadForm):
     medium_name = forms.CharField(
         max_length=Article._meta.get_field_by_name('medium')[0].max_length,
@@ -172,35 +268,15 @@ class CSV(UploadScript):
 
         raise ValueError("No medium specified!")
 
-    def parse_document(self, row):
-        kargs = dict(medium=self._medium, metastring={})
-        csvfields = [(fieldname, self.options[fieldname]) for fieldname in FIELDS if self.options[fieldname]]
-        for fieldname, csvfield in csvfields:
-            val = row[csvfield]
-            if fieldname == 'date' and isinstance(val, datetime.datetime):
-                pass  # no need to parse
-            elif val.strip():
-                if fieldname in PARSERS:
-                    val = PARSERS[fieldname](val)
-            elif is_nullable(fieldname):
-                val = None
-            else:
-                val = val.strip()
-
-            kargs[fieldname] = val
+    def get_converter(self, row):
+        """Return the RowConverter for rows with the header of the given row"""
+        converter = getattr(self, "_converter", None)
+        if converter is None or converter.column_names is not row.column_names:
+            converter = self._converter = RowConverter(self.options, row.column_names, self._medium)
+        return converter
 
-        # Metadata to metastring
-        csvfields = [tup[1] for tup in csvfields]
-        for key, value in row.items():
-            if key not in csvfields:
-                kargs["metastring"][key] = value
-
-        kargs["metastring"] = json.dumps(kargs["metastring"])
-
-        # In case medium wasn't defined in csv
-        medium = self._medium
-        if medium is not None:
-            kargs["medium"] = medium
+    def parse_document(self, row):
+        kargs = self.get_converter(row).convert(row)
 
         if self.parent_field:
             doc_id = kargs.get(self.id_field)
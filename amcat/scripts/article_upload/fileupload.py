@@ -26,25 +26,157 @@ from django import forms
 import os.path
 import zipfile
 import chardet
+import codecs
 import csv
 import collections
-from contextlib import contextmanager
-from django.core.files import File
-import tempfile
-import shutil
-
-@contextmanager
-def TemporaryFolder(*args, **kargs):
-    tempdir = tempfile.mkdtemp(*args, **kargs)
-    try:
-        yield tempdir
-    finally:
-        shutil.rmtree(tempdir)
-        
+import mmap
+from itertools import chain
+
 
-DecodedFile = collections.namedtuple("File", ["name", "file", "bytes", "encoding", "text"])
 ENCODINGS = ["Autodetect", "ISO-8859-15", "UTF-8", "Latin-1"]
 
+# Number of bytes used to guess the encoding of a file
+ENCODING_SAMPLE_SIZE = 1024 * 1024
+
+# Encoding used for the rest of a file if it turns out not to be in the guessed encoding
+FALLBACK_ENCODING = "latin-1"
+
+# Number of bytes decoded at a time when streaming the text of a file
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+
+def map_file(f):
+    """
+    Return the contents of the file as a read-only memory map, or as a byte string if the
+    file is not on disk (e.g. small uploads, which are kept in memory)
+    """
+    try:
+        fileno = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        pass
+    else:
+        if os.fstat(fileno).st_size > 0:
+            return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    f.seek(0)
+    return f.read()
+
+
+def iter_chunks(data, chunk_size=DECODE_CHUNK_SIZE):
+    """Yield the contents of a byte string or memory map in chunks"""
+    for start in xrange(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+def iter_decode(chunks, encoding):
+    """Decode the given byte chunks incrementally, yielding the text in chunks"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def guess_encoding(sample):
+    """
+    Guess the encoding of a file from a sample of its first bytes: utf-8 if the sample
+    is valid utf-8 (except possibly for a character cut off at the end), otherwise chardet's guess
+    """
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return chardet.detect(sample)["encoding"]
+
+
+class DecodedFile(object):
+    """
+    An uploaded file and its encoding. The contents are memory mapped (see map_file), and can
+    be decoded incrementally with iter_text and iter_lines, so the whole text does not need
+    to be in memory. The bytes and text properties return the whole contents. Close the file
+    (or use it as a context manager) to release the memory map once it has been decoded.
+    """
+
+    def __init__(self, name, file, data, encoding, fallback_encoding=None):
+        """
+        @param file: the uploaded file, or None for a file in a zip archive
+        @param data: the contents of the file as a memory map or byte string
+        @param fallback_encoding: if the contents cannot be decoded with encoding, the rest of the
+                                  contents (from the first invalid byte) is decoded with this
+                                  encoding, which then becomes the encoding of the file
+        """
+        self.name = name
+        self.file = file
+        self.data = data
+        self.encoding = encoding
+        self.fallback_encoding = fallback_encoding
+
+    def close(self):
+        """Close the memory map of the contents, if any. The contents cannot be read afterwards."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def bytes(self):
+        return self.data[:]
+
+    @property
+    def text(self):
+        return u"".join(self.iter_text())
+
+    def iter_bytes(self, chunk_size=DECODE_CHUNK_SIZE):
+        return iter_chunks(self.data, chunk_size)
+
+    def iter_text(self, chunk_size=DECODE_CHUNK_SIZE):
+        """Yield the decoded contents in chunks of (at most) chunk_size bytes"""
+        if self.fallback_encoding is None:
+            return iter_decode(self.iter_bytes(chunk_size), self.encoding)
+        return self._iter_text_with_fallback(chunk_size)
+
+    def _iter_text_with_fallback(self, chunk_size):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        chunks = chain(((chunk, False) for chunk in self.iter_bytes(chunk_size)), [(b"", True)])
+        for chunk, final in chunks:
+            pending = decoder.getstate()[0]
+            try:
+                text = decoder.decode(chunk, final)
+            except UnicodeDecodeError as e:
+                if self.fallback_encoding is None:
+                    raise
+                data = pending + chunk
+                log.info("{self.name} is not {self.encoding} from byte {e.start} of chunk, using {self.fallback_encoding}"
+                         .format(**locals()))
+                text = data[:e.start].decode(self.encoding)
+                self.encoding, self.fallback_encoding = self.fallback_encoding, None
+                decoder = codecs.getincrementaldecoder(self.encoding)()
+                text += decoder.decode(data[e.start:], final)
+            if text:
+                yield text
+
+    def iter_lines(self, chunk_size=DECODE_CHUNK_SIZE):
+        """Yield the lines of the decoded contents, including their newline. Only "\\n" ends a line."""
+        pending = []  # start of the current line, which can span multiple chunks
+        for text in self.iter_text(chunk_size):
+            lines = text.split("\n")
+            if len(lines) > 1:
+                pending.append(lines[0])
+                yield u"".join(pending) + "\n"
+                for line in lines[1:-1]:
+                    yield line + "\n"
+                pending = []
+            if lines[-1]:
+                pending.append(lines[-1])
+        if pending:
+            yield u"".join(pending)
+
 
 class RawFileUploadForm(forms.Form):
     """Helper form to handle uploading a file"""
@@ -60,31 +192,30 @@ class FileUploadForm(RawFileUploadForm):
                                  help_text="Try to change this value when character issues arise.", )
 
     
-    def decode(self, bytes):
+    def get_encoding(self, data):
         """
-        Decode the given bytes using the encoding specified in the form.
-        If encoding is Autodetect, use (1) utf-8, (2) chardet, (3) latin-1.
-        Returns a tuple (encoding, text) where encoding is the actual encoding used.
+        Return the (encoding, fallback encoding) of the given bytes (or memory map) specified in
+        the form. If encoding is Autodetect, the encoding is guessed from the first
+        ENCODING_SAMPLE_SIZE bytes (see guess_encoding), and the rest of the data is decoded
+        as FALLBACK_ENCODING if it turns out not to be in that encoding (see DecodedFile).
         """
         enc = ENCODINGS[int(self.cleaned_data['encoding'] or 0)]
         if enc != 'Autodetect':
-            return enc, bytes.decode(enc)
-        try:
-            return "utf-8", bytes.decode('utf-8')
-        except UnicodeDecodeError:
-            pass
-        enc = chardet.detect(bytes)["encoding"]
-        if enc:
-            try:
-                return enc, bytes.decode(enc)
-            except UnicodeDecodeError:
-                pass
-        return 'latin-1', bytes.decode('latin-1')
+            return enc, None
+        return guess_encoding(data[:ENCODING_SAMPLE_SIZE]) or FALLBACK_ENCODING, FALLBACK_ENCODING
+
+    def decode(self, bytes):
+        """
+        Decode the given bytes using the encoding specified in the form, see get_encoding.
+        Returns a tuple (encoding, text) where encoding is the actual encoding used.
+        """
+        decoded = DecodedFile(None, None, bytes, *self.get_encoding(bytes))
+        text = decoded.text
+        return decoded.encoding, text
 
     def decode_file(self, f):
-        bytes = f.read()
-        enc, text = self.decode(bytes)
-        return DecodedFile(f.name, f, bytes, enc, text)
+        data = map_file(f)
+        return DecodedFile(f.name, f, data, *self.get_encoding(data))
 
     def get_uploaded_text(self):
         """Returns a DecodedFile object representing the file"""
@@ -112,7 +243,7 @@ def namedtuple_csv_reader(csv_file, encoding='utf-8', **kargs):
     @param kargs: Will be passed to csv.reader, e.g. dialect
     """
     if encoding.lower() in ('', 'autodetect'):
-        encoding = chardet.detect(csv_file.read(1024))["encoding"]
+        encoding = guess_encoding(csv_file.read(ENCODING_SAMPLE_SIZE))
         log.info("Guessed encoding: {encoding}".format(**locals()))
         csv_file.seek(0)
     
@@ -199,40 +330,31 @@ class ZipFileUploadForm(FileUploadForm):
         Returns a list of DecodedFile objects representing the zipped files,
         or just a [DecodedFile] if the uploaded file was not a .zip file.
         """
+        return list(self.iter_uploaded_texts())
+
+    def iter_uploaded_texts(self):
+        """
+        Like get_uploaded_texts, but yields the DecodedFile objects one at a time. The zipped
+        files are read from the archive when they are needed, so only one is kept in memory.
+        """
         f = self.files['file']
         extension = os.path.splitext(f.name)[1]
         if extension == ".zip":
-            return [self.decode_file(f) for f in self.iter_zip_file_contents(f)]
+            for name, data in self.iter_zip_file_contents(f):
+                yield DecodedFile(name, None, data, *self.get_encoding(data))
         else:
-            return [self.decode_file(f)]
+            yield self.decode_file(f)
 
     def get_entries(self):
-        return self.get_uploaded_texts()
+        return self.iter_uploaded_texts()
 
-    def iter_zip_file_contents(self, zip_file, *args, **kargs):
+    def iter_zip_file_contents(self, zip_file):
         """
-        Generator that unpacks and yields the zip entries as File objects. Skips folders.
+        Generator that yields the (name, bytes) of the zip entries, reading them from the
+        archive one at a time. Skips folders.
         @param zip_file: The zip file to iterate over.
-        @param args: Is passed to the `TemporaryFolder`
-        @param kargs: Is passed to the `TemporaryFolder`
         """
-        with TemporaryFolder(*args, **kargs) as tempdir:
-            with zipfile.ZipFile(zip_file) as zf:
-                files = []
-                for name in zf.namelist():
-                    if name.endswith("/"): continue # skip folders
-                    # using zipfile.extract(name, tempdir) gives an error if name contains non-ascii characters
-                    # this may be related to http://bugs.python.org/issue17656, but we are using 2.7.3
-                    # strange enough, the issue does not occur in 'runserver' mode, but file handling might be different?
-                    fn = os.path.basename(name.encode("ascii", "ignore"))
-                    # use mkstemp instead of temporary folder because we don't want it to be deleted
-                    # it will be deleted on __exit__ anyway since the whole tempdir will be deleted
-                    _handle, fn = tempfile.mkstemp(suffix="_"+fn, dir=tempdir)
-                    f = open(fn, 'w')
-                    shutil.copyfileobj(zf.open(name), f)
-                    f.close()
-                    with open(fn) as fh:
-                        yield File(fh, name=name)
-
-
-
+        with zipfile.ZipFile(zip_file) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith("/"): continue # skip folders
+                yield info.filename, zf.read(info)
@@ -178,6 +178,41 @@ def split_body(body):
     yield art.getvalue()
 
 
+def split_lines(lines):
+    """
+    Split a document into its header and articles, like split_header and split_body, but
+    given as a sequence of lines and without keeping the whole document in memory.
+
+    @param lines: lines (unicode) of the document, optionally ending with a newline
+    @return: a tuple of the (unicode) header and a generator yielding the (unicode) articles
+    """
+    lines = iter(lines)
+    header = []
+    for line in lines:
+        line = line[:-1] if line.endswith("\n") else line
+        if RES.DOCUMENT_COUNT.match(line):
+            break
+        header.append(line)
+    return "\n".join(header).strip(), _iter_articles(lines)
+
+
+def _iter_articles(lines):
+    """Yield the articles in the lines following the first document count line, see split_lines"""
+    art = []
+    for line in lines:
+        line = line[:-1] if line.endswith("\n") else line
+        if RES.DOCUMENT_COUNT.match(line):
+            yield "".join(art)
+            art = []
+        else:
+            art.append(line)
+            art.append("\n")
+
+    # like split_body, which gets a stripped body
+    last = "".join(art).rstrip()
+    yield last + "\n" if last else ""
+
+
 def _strip_article(art):
     """
     Remove prepending and "post"pending empty lines and remove
@@ -527,12 +562,11 @@ class LexisNexis(UploadScript):
         pass
 
     name = 'Lexis Nexis'
+    parallel_parsing = True
 
     def split_file(self, file):
-
-        header, body = split_header(file.text)
+        header, fragments = split_lines(file.iter_lines())
         self.ln_query = get_query(parse_header(header))
-        fragments = list(split_body(body))
         return fragments
 
     def get_provenance(self, file, articles):
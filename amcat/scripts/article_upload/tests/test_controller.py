@@ -0,0 +1,94 @@
+from django.db import connection, DatabaseError
+
+from amcat.models import Article, Medium
+from amcat.scripts.article_upload.controller import Controller
+from amcat.tools import amcattest
+
+
+class FakeScraper(object):
+    """Scraper with units 0..n-1 that each yield two articles, except unit 3 which fails"""
+    articleset = None
+
+    def __init__(self, project, n=6):
+        self.project = project
+        self.n = n
+        self.parsed = []
+
+    def _get_units(self):
+        return iter(range(self.n))
+
+    def _scrape_unit(self, unit):
+        self.parsed.append(unit)
+        if unit == 3:
+            raise ValueError("Cannot parse unit 3")
+        for i in range(2):
+            yield Article(headline="{}-{}".format(unit, i), medium=Medium.get_or_create("Medium {}".format(unit % 2)))
+
+
+class FakeLoader(object):
+    def __init__(self, scraper):
+        self.scraper = scraper
+        self.chunks = []
+        self.articles = []
+
+    def load(self, articles, articleset):
+        self.chunks.append(([a.headline for a in articles], list(self.scraper.parsed)))
+        self.articles += articles
+        for a in articles:
+            a.id = sum(len(headlines) for headlines, _ in self.chunks) * 10 + articles.index(a)
+        return articles, []
+
+
+class TestController(amcattest.AmCATTestCase):
+    def test_run(self):
+        """Are units parsed lazily and saved in chunks?"""
+        scraper = FakeScraper(amcattest.create_test_project())
+        loader = FakeLoader(scraper)
+        controller = Controller(loader=loader, chunk_size=3)
+        ids = controller.run(scraper)
+
+        self.assertEqual(len(ids), 10)
+        self.assertEqual([headlines for headlines, _ in loader.chunks],
+                         [["0-0", "0-1", "1-0"], ["1-1", "2-0", "2-1"], ["4-0", "4-1", "5-0"], ["5-1"]])
+        # Only the units needed for a chunk were parsed before it was saved
+        self.assertEqual([parsed for _, parsed in loader.chunks], [[0, 1], [0, 1, 2], [0, 1, 2, 3, 4, 5],
+                                                                   [0, 1, 2, 3, 4, 5]])
+        self.assertEqual([(e.i, e.unit) for e in controller.errors], [(3, 3)])
+
+    def test_save_error(self):
+        """Are the other chunks saved if saving a chunk fails with a database error?"""
+        scraper = FakeScraper(amcattest.create_test_project())
+        loader = FakeLoader(scraper)
+        load = loader.load
+
+        def failing_load(articles, articleset):
+            if len(loader.chunks) == 1 and not hasattr(loader, "failed"):
+                loader.failed = True
+                connection.cursor().execute("SELECT * FROM no_such_table")
+            Article.objects.count()  # fails if the transaction was aborted
+            return load(articles, articleset)
+        loader.load = failing_load
+
+        controller = Controller(loader=loader, chunk_size=3)
+        self.assertEqual(len(controller.run(scraper)), 7)
+        self.assertEqual([headlines for headlines, _ in loader.chunks],
+                         [["0-0", "0-1", "1-0"], ["4-0", "4-1", "5-0"], ["5-1"]])
+        self.assertEqual([e.i for e in controller.errors], [None, 3])
+        self.assertIsInstance(controller.errors[0].error, DatabaseError)
+
+    def test_parallel(self):
+        """Are unit order and error indices kept when parsing in worker processes (inside a transaction)?"""
+        scraper = FakeScraper(amcattest.create_test_project(), n=20)
+        loader = FakeLoader(scraper)
+        controller = Controller(loader=loader, chunk_size=7, processes=2)
+        self.assertEqual(len(controller.run(scraper)), 38)
+
+        self.assertEqual([a.headline for a in loader.articles],
+                         ["{}-{}".format(u, i) for u in range(20) if u != 3 for i in range(2)])
+        self.assertEqual([(e.i, e.unit) for e in controller.errors], [(3, 3)])
+        self.assertIsInstance(controller.errors[0].error, ValueError)
+        # The units were parsed by the workers, which create unsaved media for the controller to save
+        self.assertEqual(scraper.parsed, [])
+        self.assertEqual({a.medium for a in loader.articles},
+                         {Medium.objects.get(name="Medium 0"), Medium.objects.get(name="Medium 1")})
+        self.assertEqual({a.medium_id for a in loader.articles}, {m.id for m in controller.media.values()})
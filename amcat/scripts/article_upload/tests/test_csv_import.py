@@ -1,10 +1,29 @@
 from __future__ import unicode_literals
 
 import csv
+import datetime
+import json
 import unittest
+from tempfile import NamedTemporaryFile
+
 from amcat.models import Medium, ArticleSet
-from amcat.scripts.article_upload.csv_import import CSV
+from amcat.scripts.article_upload.csv_import import CSV, FIELDS, RowConverter, read_iso_date
+from amcat.scripts.article_upload.fileupload import namedtuples_from_reader
 from amcat.tools import amcattest
+from amcat.tools.toolkit import readDate
+
+
+def _options(**columns):
+    options = {field: None for field in FIELDS}
+    options.update(columns)
+    return options
+
+
+def _convert(converter, row):
+    """Convert the row, parsing the metastring so it can be compared"""
+    fields = converter.convert(row)
+    fields["metastring"] = json.loads(fields["metastring"])
+    return fields
 
 
 class TestCSV(amcattest.AmCATTestCase):
@@ -113,12 +132,54 @@ class TestCSV(amcattest.AmCATTestCase):
             a, = _run_test_csv(header, data, date="date", text="text")
             self.assertEqual(a.date.isoformat()[:10], expected)
 
+    def test_convert(self):
+        """Does RowConverter parse the mapped columns and store the other columns in the metastring?"""
+        header = ["kop", "datum", "tekst", "pagina", "bron", "extra"]
+        data = [["kop1", "2001-01-01", "text1", "12", "Bla", "x"],
+                ["kop2", "10 maart 1980", "", " ", "Bla", ""],
+                ["kop3", "2001-02-03T12:34", "text3", "", "Bla2", "y"],
+                ["kop4", "15/08/2008", "text4", "1", "Bla", "z"]]
+        dates = [datetime.datetime(2001, 1, 1), datetime.datetime(1980, 3, 10), datetime.datetime(2001, 2, 3, 12, 34)]
+        medium = amcattest.create_test_medium()
+        rows = list(namedtuples_from_reader(iter([header] + data)))
+
+        converter = RowConverter(_options(headline="kop", date="datum", text="tekst", pagenr="pagina"),
+                                 rows[0].column_names, medium)
+        self.assertEqual(_convert(converter, rows[0]),
+                         dict(headline="kop1", date=dates[0], text="text1", pagenr=12, medium=medium,
+                              metastring={"bron": "Bla", "extra": "x"}))
+        # empty values are None for nullable fields
+        self.assertEqual(_convert(converter, rows[1]),
+                         dict(headline="kop2", date=dates[1], text="", pagenr=None, medium=medium,
+                              metastring={"bron": "Bla", "extra": ""}))
+        self.assertEqual([converter.convert(row)["date"] for row in rows[:3]], dates)
+
+        converter = RowConverter(_options(headline="kop", date="datum", text="tekst", medium="bron"),
+                                 rows[0].column_names)
+        self.assertEqual(_convert(converter, rows[2]),
+                         dict(headline="kop3", date=dates[2], text="text3", medium=Medium.get_or_create("Bla2"),
+                              metastring={"pagina": "", "extra": "y"}))
+        self.assertEqual(converter.convert(rows[0])["medium"], Medium.get_or_create("Bla"))
+        self.assertEqual(set(converter.media), {"Bla", "Bla2"})
+
+        # dates are parsed with readDate if the first date is not an iso date
+        rows = list(namedtuples_from_reader(iter([header] + data[1:])))
+        converter = RowConverter(_options(date="datum"), rows[0].column_names)
+        self.assertEqual([converter.convert(row)["date"] for row in rows[:2]], dates[1:])
+        self.assertIs(converter.date_parser, readDate)
+
+        # Fields should refer to existing columns
+        self.assertRaises(KeyError, RowConverter, _options(date="date"), rows[0].column_names)
+
+    def test_read_iso_date(self):
+        for s in ["2001-01-01", "2001-01-01 10:20", "2001-01-01T10:20:30", "1999-12-31", "10/03/80"]:
+            self.assertEqual(read_iso_date(s), readDate(s), s)
+
 
 def _run_test_csv(header, rows, **options):
     project = amcattest.create_test_project()
     articleset = amcattest.create_test_set(project=project)
 
-    from tempfile import NamedTemporaryFile
     from django.core.files import File
 
     with NamedTemporaryFile(suffix=".txt") as f:
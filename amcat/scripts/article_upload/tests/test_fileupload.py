@@ -1,6 +1,10 @@
 import tempfile
+import zipfile
 from django.core.files import File
-from amcat.scripts.article_upload.fileupload import CSVUploadForm, namedtuple_csv_reader
+from django.core.files.uploadedfile import SimpleUploadedFile
+from amcat.scripts.article_upload import fileupload
+from amcat.scripts.article_upload.fileupload import CSVUploadForm, namedtuple_csv_reader, FileUploadForm, ENCODINGS, \
+    ZipFileUploadForm
 from amcat.tools import amcattest
 
 
@@ -48,4 +52,77 @@ class TestFileUpload(amcattest.AmCATTestCase):
 
         l1, l2 = namedtuple_csv_reader(csv, dialect='excel-tab')
         self.assertEqual(l1, ('1', None))
-        self.assertEqual(l2, ('', '2'))
\ No newline at end of file
+        self.assertEqual(l2, ('', '2'))
+
+    def _decode(self, bytes, encoding=0, in_memory=False):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(bytes)
+            f.flush()
+            file = SimpleUploadedFile("test.txt", bytes) if in_memory else File(open(f.name))
+            form = FileUploadForm(dict(encoding=encoding), dict(file=file))
+            self.assertTrue(form.is_valid(), form.errors)
+            return form.get_uploaded_text()
+
+    def test_decode_file(self):
+        text = u"h\xe9\u20ac\nsecond line\n\nlast"
+        for in_memory in (False, True):
+            f = self._decode(text.encode("utf-8"), in_memory=in_memory)
+            self.assertEqual(f.encoding, "utf-8")
+            self.assertEqual(f.bytes, text.encode("utf-8"))
+            self.assertEqual(f.text, text)
+            # multi byte characters that are split over chunks are decoded correctly
+            self.assertEqual(list(f.iter_text(chunk_size=2))[:2], [u"h", u"\xe9"])
+            self.assertEqual(list(f.iter_lines(chunk_size=3)), [u"h\xe9\u20ac\n", u"second line\n", u"\n", u"last"])
+
+            # the memory map is released when the file is closed
+            with f:
+                pass
+            if in_memory:
+                self.assertEqual(f.text, text)
+            else:
+                self.assertRaises(ValueError, lambda: f.bytes)
+
+        f = self._decode(text.encode("latin-1", "replace"), encoding=ENCODINGS.index("Latin-1"))
+        self.assertEqual(f.encoding, "Latin-1")
+        self.assertEqual(f.text, text.replace(u"\u20ac", u"?"))
+
+    def test_decode_autodetect(self):
+        """Is a file that is utf-8 in the sample decoded as utf-8 until it fails, and then as latin-1?"""
+        old_size = fileupload.ENCODING_SAMPLE_SIZE
+        fileupload.ENCODING_SAMPLE_SIZE = 10
+        try:
+            f = self._decode(b"a" * 20 + u"\xe9".encode("latin-1"))
+            self.assertEqual(f.encoding, "utf-8")
+            self.assertEqual(f.text, u"a" * 20 + u"\xe9")
+            self.assertEqual(f.encoding, "latin-1")
+
+            f = self._decode(u"\u20ac".encode("utf-8") + b"a" * 20 + u"\xe9b".encode("latin-1"))
+            self.assertEqual(u"".join(f.iter_text(chunk_size=2)), u"\u20ac" + u"a" * 20 + u"\xe9b")
+            self.assertEqual(f.encoding, "latin-1")
+
+            # chardet is used if the sample is not utf-8
+            f = self._decode(u"\xe9\xe9n twee drie".encode("latin-1"))
+            self.assertNotEqual(f.encoding, "utf-8")
+            self.assertEqual(f.text, u"\xe9\xe9n twee drie")
+        finally:
+            fileupload.ENCODING_SAMPLE_SIZE = old_size
+
+        f = self._decode(b"")
+        self.assertEqual((f.encoding, f.text, list(f.iter_lines())), ("utf-8", u"", []))
+
+    def test_zip(self):
+        with tempfile.NamedTemporaryFile(suffix=".zip") as f:
+            with zipfile.ZipFile(f, "w") as zf:
+                zf.writestr("dir/", "")
+                zf.writestr("dir/a.txt", u"\xe9\xe9n".encode("utf-8"))
+                zf.writestr("b.txt", b"twee")
+            f.flush()
+            form = ZipFileUploadForm(dict(encoding=0), dict(file=File(open(f.name), name="test.zip")))
+            self.assertTrue(form.is_valid(), form.errors)
+
+            entries = form.get_entries()
+            a = next(entries)
+            self.assertEqual((a.name, a.encoding, a.text), ("dir/a.txt", "utf-8", u"\xe9\xe9n"))
+            b, = list(entries)
+            self.assertEqual((b.name, b.text), ("b.txt", u"twee"))
+            self.assertEqual([e.name for e in form.get_uploaded_texts()], ["dir/a.txt", "b.txt"])
@@ -1,10 +1,11 @@
 from __future__ import print_function, unicode_literals
 
 import datetime
+import io
 import os.path
 from amcat.models import Medium, ArticleSet
 from amcat.scripts.article_upload.lexisnexis import split_header, split_body, parse_header, \
-    parse_article, body_to_article, get_query, LexisNexis
+    parse_article, body_to_article, get_query, LexisNexis, split_lines
 from amcat.tools import amcattest
 
 
@@ -37,6 +38,14 @@ class TestLexisNexis(amcattest.AmCATTestCase):
 
         self.assertEquals(n_found, n_sol + 1)  # +1 for 'defigured' article
 
+    def test_split_lines(self):
+        """Does splitting a stream of lines give the same result as splitting the whole document?"""
+        for text in (self.test_text, self.test_text2, self.test_text + "\n\n  \n"):
+            header, body = split_header(text)
+            lines_header, articles = split_lines(io.StringIO(text))
+            self.assertEqual(lines_header, header)
+            self.assertEqual(list(articles), list(split_body(body)))
+
     def test_parse_header(self):
         splitted = self.split()
 
@@ -78,7 +78,8 @@ def _convert_docx(file):
 
 def _convert_doc(file):
     with tempfile.NamedTemporaryFile(suffix=".doc") as f:
-        f.write(file.bytes)
+        for chunk in file.iter_bytes():
+            f.write(chunk)
         f.flush()
         text = subprocess.check_output(["antiword", f.name])
     if not text.strip():
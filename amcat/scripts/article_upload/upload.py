@@ -23,6 +23,7 @@ Base module for article upload scripts
 import os.path
 import datetime
 import logging
+import multiprocessing
 
 log = logging.getLogger(__name__)
 
@@ -31,7 +32,7 @@ from django.forms.widgets import HiddenInput
 
 from amcat.scripts import script
 from amcat.models import Article, Project, ArticleSet
-from amcat.scripts.article_upload.fileupload import RawFileUploadForm
+from amcat.scripts.article_upload.fileupload import RawFileUploadForm, DecodedFile
 from amcat.models.articleset import create_new_articleset
 
 class ParseError(Exception):
@@ -82,6 +83,11 @@ class UploadScript(script.Script):
     input_type = None
     options_form = UploadForm
 
+    # If True, units are parsed in parallel worker processes. This requires the units (and
+    # articles) to be picklable and parse_document to not depend on other units or use the
+    # database other than through Medium.get_or_create (see controller.Controller).
+    parallel_parsing = False
+
     def __init__(self, *args, **kargs):
         super(UploadScript, self).__init__(*args, **kargs)
         self.project = self.options['project']
@@ -153,7 +159,8 @@ class UploadScript(script.Script):
         log.info(u"Importing {self.__class__.__name__} from {filename} into {self.project}"
                  .format(**locals()))
         from amcat.scripts.article_upload.controller import Controller
-        self.controller = Controller()
+        processes = multiprocessing.cpu_count() if self.parallel_parsing else None
+        self.controller = Controller(processes=processes)
         arts = self.controller.run(self)
 
         if not arts:
@@ -182,11 +189,16 @@ class UploadScript(script.Script):
         """
         Upload form assumes that the form (!) has a get_entries method, which you get
         if you subclass you form from one of the fileupload forms. If not, please override
-        this method.
+        this method. Uploaded files are closed once they have been split (and, if the units
+        are parsed sequentially, parsed).
         """
         for entry in self.bound_form.get_entries():
-            for u in self.split_file(entry):
-                yield u
+            try:
+                for u in self.split_file(entry):
+                    yield u
+            finally:
+                if isinstance(entry, DecodedFile):
+                    entry.close()
 
     def _scrape_unit(self, document):
         result =  self.parse_document(document)
@@ -16,11 +16,13 @@
 # You should have received a copy of the GNU Affero General Public        #
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
+import csv
 import json
+import StringIO
 from datetime import datetime
 from time import mktime
 from django.core.exceptions import ValidationError, MultipleObjectsReturned
-from django.forms import ChoiceField, CharField, Select
+from django.forms import ChoiceField, CharField, Select, IntegerField
 from amcat.models import Medium, ArticleSet
 from amcat.scripts.query import QueryAction, QueryActionForm
 from amcat.tools.aggregate import get_relative
@@ -45,6 +47,24 @@ class AggregationEncoder(json.JSONEncoder):
         return super(AggregationEncoder, self).default(obj)
 
 
+def _get_csv_value(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, Medium) or isinstance(obj, ArticleSet):
+        return obj.name.encode("utf-8")
+    if isinstance(obj, SearchQuery):
+        return obj.label.encode("utf-8")
+    return unicode(obj).encode("utf-8")
+
+
+def _get_csv_row(key, value, columns):
+    """Return the CSV row of an x-axis value, with a count for every y-axis column"""
+    if columns is None:
+        return [_get_csv_value(key), value]
+    counts = dict(value)
+    return [_get_csv_value(key)] + [counts.get(column, 0) for column in columns]
+
+
 MEDIUM_ERR = "Could not find medium with id={column} or name={column}"
 
 
@@ -68,6 +88,8 @@ class AggregationActionForm(QueryActionForm):
     y_axis = ChoiceField(label="Y-axis (columns)", choices=Y_AXES, initial="medium")
     interval = ChoiceField(choices=INTERVALS, required=False, initial="day")
     relative_to = CharField(widget=Select, required=False)
+    top = IntegerField(required=False, min_value=1, label="Top N",
+                       help_text="Only show the N largest media or sets, and count the rest as 'other'")
 
     def __init__(self, *args, **kwargs):
         super(AggregationActionForm, self).__init__(*args, **kwargs)
@@ -80,6 +102,13 @@ class AggregationActionForm(QueryActionForm):
             "data-depends-label": "{label}",
         }
 
+    def clean_top(self):
+        top = self.cleaned_data['top']
+        axes = (self.cleaned_data.get('x_axis'), self.cleaned_data.get('y_axis'))
+        if top is not None and "medium" not in axes and "set" not in axes:
+            raise ValidationError("Top N can only be used when aggregating on medium or set.")
+        return top
+
     def clean_relative_to(self):
         column = self.cleaned_data['relative_to']
         y_axis = self.cleaned_data['y_axis']
@@ -128,10 +157,11 @@ class AggregationAction(QueryAction):
         self.monitor.update(10, "Found {narticles} articles. Aggregating..".format(**locals()))
 
         # Get aggregation
-        aggregation = selection.get_aggregate(
+        aggregation = selection.iter_aggregate(
             form.cleaned_data['x_axis'],
             form.cleaned_data['y_axis'],
-            form.cleaned_data['interval']
+            form.cleaned_data['interval'],
+            top=form.cleaned_data['top']
         )
 
         #
@@ -139,9 +169,27 @@ class AggregationAction(QueryAction):
         column = form.cleaned_data['relative_to']
 
         if column is not None:
-            aggregation = list(get_relative(aggregation, column))
+            aggregation = list(get_relative(list(aggregation), column))
 
         self.monitor.update(60, "Serialising..".format(**locals()))
+
+        if form.cleaned_data["output_type"] == "text/csv":
+            # Write every x-axis row as it is aggregated, so the aggregation is never held in
+            # full. The columns (y-axis values) are needed for the header, so they are
+            # aggregated first.
+            x_axis, y_axis = form.cleaned_data['x_axis'], form.cleaned_data['y_axis']
+            columns = None
+            if y_axis != "total":
+                top = form.cleaned_data['top'] if y_axis in ("medium", "set") else None
+                columns = [key for key, _ in selection.iter_aggregate(y_axis, "total", top=top)]
+
+            result = StringIO.StringIO()
+            csvf = csv.writer(result)
+            csvf.writerow([x_axis] + (["total"] if columns is None else map(_get_csv_value, columns)))
+            for key, value in aggregation:
+                csvf.writerow(_get_csv_row(key, value, columns))
+            return result.getvalue()
+
         return json.dumps(list(aggregation), cls=AggregationEncoder, check_circular=False)
 
 
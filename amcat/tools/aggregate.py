@@ -20,6 +20,7 @@
 import logging
 import itertools
 from amcat.models import ArticleSet, Medium
+from amcat.tools.amcates import OTHER_BUCKET
 
 log = logging.getLogger(__name__)
 
@@ -47,7 +48,7 @@ def get_relative(aggregation, column):
 def _get_ids(aggregation, group_by, id_type):
     ids = set()
     if group_by.pop(0) == id_type:
-        ids = set(medium_id for medium_id, _ in aggregation)
+        ids = set(medium_id for medium_id, _ in aggregation if medium_id != OTHER_BUCKET)
 
     if not group_by:
         return ids
@@ -65,7 +66,7 @@ def _get_objects(aggregation, group_by, id_type, objects):
     ntuple = aggregation[0].__class__
 
     if group_by.pop(0) == id_type:
-        aggregation = [(objects.get(int(id)), aggr) for id, aggr in aggregation]
+        aggregation = [(id if id == OTHER_BUCKET else objects.get(int(id)), aggr) for id, aggr in aggregation]
 
     if group_by:
         aggregation = [
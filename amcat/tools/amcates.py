@@ -18,11 +18,15 @@
 ###########################################################################
 
 from __future__ import unicode_literals, print_function, absolute_import
-from collections import namedtuple
-import json
+from collections import namedtuple, OrderedDict
+from itertools import chain
+from operator import attrgetter
+from Queue import Queue
 import logging
+import os
+import threading
+import time
 from types import NoneType
-from amcat.tools.djangotoolkit import get_model_field
 
 log = logging.getLogger(__name__)
 import re
@@ -32,13 +36,13 @@ from hashlib import sha224 as hash_class
 from json import dumps as serialize
 
 from amcat.tools import queryparser, toolkit
-from amcat.tools.toolkit import multidict, splitlist
-from elasticsearch import Elasticsearch, ImproperlyConfigured
+from amcat.tools.toolkit import multidict, splitlist, sorted_diff
+from elasticsearch import Elasticsearch, ImproperlyConfigured, TransportError
 from elasticsearch.client import indices, cluster
 from elasticsearch.helpers import scan
 
 from django.conf import settings
-from amcat.tools.caching import cached
+from amcat.tools.caching import cached, ResultCache
 from amcat.tools.progress import NullMonitor
 
 if settings.ES_USE_LEGACY_HASH_FUNCTION is None:
@@ -46,6 +50,20 @@ if settings.ES_USE_LEGACY_HASH_FUNCTION is None:
     raise ImproperlyConfigured(error_msg)
 
 
+def _get_result_cache():
+    backend = None
+    if settings.ES_RESULT_CACHE:
+        from django.core.cache import caches
+        backend = caches[settings.ES_RESULT_CACHE]
+    elif settings.ES_RESULT_CACHE_TIMEOUT:
+        log.warning("ES_RESULT_CACHE is not set, so writes by other processes do not invalidate cached results")
+    return ResultCache("amcates", timeout=settings.ES_RESULT_CACHE_TIMEOUT, backend=backend,
+                       max_entries=settings.ES_RESULT_CACHE_SIZE, settle_time=settings.ES_RESULT_CACHE_SETTLE_TIME)
+
+# Cache for counts and aggregations, see ES._cached
+RESULT_CACHE = _get_result_cache()
+
+
 ARTICLE_FIELDS = frozenset({
     "id", "date", "section", "pagenr", "headline",
     "byline", "length", "metastring", "url", "externalid",
@@ -87,21 +105,51 @@ _clean_re = re.compile('[\x00-\x08\x0B\x0C\x0E-\x1F]')
 def _clean(s):
     """Remove non-printalbe characters
     @type s: unicode | str | NoneType"""
-    if s is not None:
+    if s is not None and _clean_re.search(s):
         return _clean_re.sub(' ', s)
+    return s
+
+
+# (getter, elastic field name, clean) for all ARTICLE_FIELDS, see get_article_dict_from_model
+_ARTICLE_FIELD_GETTERS = [(attrgetter(field_name.replace("__", ".")), ARTICLE_FIELD_MAP.get(field_name, field_name),
+                           field_name in ARTICLE_CLEAN_FIELDS) for field_name in ARTICLE_FIELDS]
 
 
 def get_article_dict_from_model(article):
-    for field_name in ARTICLE_FIELDS:
-        value = get_model_field(article, field_name)
-        if field_name in ARTICLE_CLEAN_FIELDS:
-            value = _clean(value)
-        yield ARTICLE_FIELD_MAP.get(field_name, field_name), value
+    for getter, name, clean in _ARTICLE_FIELD_GETTERS:
+        value = getter(article)
+        yield name, (_clean(value) if clean else value)
+
+
+class ArticleDict(dict):
+    """
+    Article dict (see get_article_dict) that keeps the json encoding of its values, so large
+    fields such as the text are encoded only once for hashing and indexing.
+    """
+    def __init__(self, *args, **kargs):
+        super(ArticleDict, self).__init__(*args, **kargs)
+        self.encoded = {}  # field -> (value, json encoded value)
+
+    def get_encoded(self, field):
+        """Return serialize(self[field]), encoding the value only if it changed"""
+        value = self[field]
+        cached = self.encoded.get(field)
+        if cached is None or cached[0] is not value:
+            cached = self.encoded[field] = (value, serialize(value))
+        return cached[1]
+
+
+def serialize_article_dict(article_dict):
+    """Return serialize(article_dict), reusing the encoded values of an ArticleDict"""
+    if not isinstance(article_dict, ArticleDict):
+        return serialize(article_dict)
+    return b"{" + b", ".join(serialize(k) + b": " + article_dict.get_encoded(k) for k in article_dict) + b"}"
 
 
 def get_article_dict(article, sets=None):
     # Build article dict. We filter non-printable characters for fields in ARTICLE_CLEAN_FIELDS
-    article_dict = dict(get_article_dict_from_model(article))
+    article_dict = ArticleDict((name, _clean(getter(article)) if clean else getter(article))
+                               for (getter, name, clean) in _ARTICLE_FIELD_GETTERS)
 
     # Previous versions of get_article_dict() accepted strings as dates,
     # which current versions do not accept. Thus, explicitely assert type.
@@ -136,9 +184,25 @@ def _get_legacy_hash(article_dict):
     return c.hexdigest()
 
 
+# The json encoding of the (field, value) pairs hashed by _get_hash, up to the value
+_HASH_PREFIXES = [(("[" if i == 0 else ", ") + "[" + serialize(fn) + ", ").encode("ascii")
+                  for (i, fn) in enumerate(HASH_FIELDS)]
+
+
 def _get_hash(article):
-    article_dict = [(fn, article[fn]) for fn in HASH_FIELDS]
-    return hash_class(json.dumps(article_dict)).hexdigest()
+    """
+    Return the hash of the HASH_FIELDS of the article dict: the sha224 of the json encoded list of
+    (field, value) pairs. The list is fed to the hash piece by piece instead of encoding it as a
+    whole, and the encoded values of an ArticleDict are reused.
+    """
+    get_encoded = getattr(article, "get_encoded", None) or (lambda fn: serialize(article[fn]))
+    c = hash_class()
+    for prefix, fn in zip(_HASH_PREFIXES, HASH_FIELDS):
+        c.update(prefix)
+        c.update(get_encoded(fn))
+        c.update(b"]")
+    c.update(b"]")
+    return c.hexdigest()
 
 
 HIGHLIGHT_OPTIONS = {
@@ -151,6 +215,43 @@ HIGHLIGHT_OPTIONS = {
     }
 }
 
+HIGHLIGHT_FIELDS = ("text", "headline", "byline")
+HIGHLIGHT_PRE_TAG, HIGHLIGHT_POST_TAG = "<em>", "</em>"
+_highlight_tags_re = re.compile("({}|{})".format(re.escape(HIGHLIGHT_PRE_TAG), re.escape(HIGHLIGHT_POST_TAG)))
+
+# Plain text of a highlighted field with the (offset, length) pairs of the hits in it
+Highlight = namedtuple("Highlight", ["text", "offsets"])
+
+
+def parse_highlight(highlighted):
+    """
+    Parse a text highlighted by elastic into its plain text and hit offsets
+    @param highlighted: text with hits enclosed in HIGHLIGHT_PRE_TAG and HIGHLIGHT_POST_TAG
+    @return: a Highlight(text, [(offset, length), ...]) tuple
+    """
+    text, offsets = [], []
+    in_tag = False
+    offset = 0
+    for token in _highlight_tags_re.split(highlighted):
+        if token == HIGHLIGHT_PRE_TAG:
+            if in_tag:
+                raise ValueError("Encountered pre_tag while in tag")
+            in_tag = True
+        elif token == HIGHLIGHT_POST_TAG:
+            if not in_tag:
+                raise ValueError("Encountered post_tag while not in tag")
+            in_tag = False
+        elif token:
+            if in_tag:
+                offsets.append((offset, len(token)))
+            text.append(token)
+            offset += len(token)
+    return Highlight("".join(text), offsets)
+
+
+# Key of the bucket with the remaining articles when aggregating on the top buckets only
+OTHER_BUCKET = "other"
+
 # This assumes that the 'lead' script is installed in elastic, e.g.:
 # echo "if (_source['text']) _source['text'].replace('\r', '').split('\n\n')[0]" > $ES_CONF/scripts/lead.groovy
 LEAD_SCRIPT_FIELD = {"lead": {"script": "lead"}}
@@ -200,6 +301,61 @@ class SearchResult(object):
         """Return the results as fieldname : value dicts"""
         return [r.__dict__ for r in self]
 
+class ScrollSearchResult(object):
+    """
+    Iterable over all results of a query, which are fetched lazily using the scroll API.
+    Like SearchResult it has .total, .fields, .score, .body and .query, but since
+    a scroll cannot be rewound it can only be iterated once.
+    """
+    def __init__(self, es, first_page, scroll):
+        """
+        @param es: elasticsearch client
+        @param first_page: SearchResult of the search request that opened the scroll
+        @param scroll: time to keep the scroll context alive between requests, e.g. '5m'
+        """
+        self._es = es
+        self._first_page = first_page
+        self._scroll = scroll
+        self._consumed = False
+
+        self.total = first_page.total
+        self.fields = first_page.fields
+        self.score = first_page.score
+        self.body = first_page.body
+        self.query = first_page.query
+
+    def __len__(self):
+        return self.total
+
+    def iter_hits(self):
+        """Yield the raw elasticsearch hits"""
+        if self._consumed:
+            raise ValueError("ScrollSearchResult can only be iterated once")
+        self._consumed = True
+
+        hits = self._first_page.hits
+        scroll_id = self._first_page._results.get('_scroll_id')
+        try:
+            while hits:
+                for hit in hits:
+                    yield hit
+                if scroll_id is None:
+                    break
+                page = self._es.scroll(scroll_id=scroll_id, scroll=self._scroll)
+                scroll_id = page.get('_scroll_id', scroll_id)
+                hits = page['hits']['hits']
+        finally:
+            if scroll_id is not None:
+                try:
+                    self._es.clear_scroll(scroll_id=scroll_id)
+                except TransportError:
+                    log.warning("Could not clear scroll {scroll_id}".format(**locals()))
+
+    def __iter__(self):
+        for hit in self.iter_hits():
+            yield Result.from_hit(self, hit, self.fields, self.score)
+
+
 class Result(object):
     """Simple class to hold arbitrary values"""
 
@@ -256,46 +412,292 @@ class ElasticSearchError(Exception):
     pass
 
 
+# Statuses (of a bulk request or of a single item in it) indicating that elastic was
+# temporarily unable to process it, i.e. that it is safe and sensible to retry
+BULK_RETRY_STATUSES = frozenset({429, 503})
+
+
+class BulkIndexer(object):
+    """
+    Pipelined bulk indexer. Actions are collected in chunks that are bounded both in the
+    number of documents and in bytes. Full chunks are put on a bounded queue, from which
+    `concurrency` threads send bulk requests, so the caller can prepare the next chunk (e.g.
+    fetch it from the database) while elastic is processing the previous ones. If the queue
+    is full, adding actions blocks until a request has finished.
+
+    Items rejected by elastic because it is overloaded are retried individually. Items
+    that failed otherwise are collected and raised as one ElasticSearchError on close().
+
+    Usage:
+
+        with ES().bulk_indexer() as indexer:
+            for article_dict in article_dicts:
+                indexer.index(article_dict["id"], serialize_article_dict(article_dict))
+    """
+
+    def __init__(self, es, index, doc_type, concurrency=None, chunk_size=None,
+                 chunk_bytes=None, max_retries=None, queue_size=None, retry_wait=1.0):
+        """
+        @param es: elasticsearch client used to send bulk requests
+        @param concurrency: number of concurrent bulk requests. If 0, requests are sent
+                            synchronously from the calling thread.
+        @param chunk_size: maximum number of documents per bulk request
+        @param chunk_bytes: maximum size of the body of a bulk request
+        @param max_retries: number of times a rejected item (or request) is retried
+        @param queue_size: maximum number of chunks waiting to be sent
+        @param retry_wait: seconds to wait before the first retry, doubled on each retry
+        """
+        self.es = es
+        self.index = index
+        self.doc_type = doc_type
+
+        self.concurrency = settings.ES_BULK_CONCURRENCY if concurrency is None else concurrency
+        self.chunk_size = chunk_size or settings.ES_BULK_SIZE
+        self.chunk_bytes = chunk_bytes or settings.ES_BULK_BYTES
+        self.max_retries = settings.ES_BULK_RETRIES if max_retries is None else max_retries
+        self.retry_wait = retry_wait
+
+        self.queue = Queue(maxsize=queue_size or max(self.concurrency, 1) * 2)
+        self.failed = []
+        self.n_requests = 0
+        self.n_retried = 0
+
+        self._chunk = []
+        self._chunk_bytes = 0
+        self._errors = []
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't mask the original exception, but do clean up the worker threads
+            self._stop()
+
+    def add(self, action, doc_id, source):
+        """
+        Add a bulk action for the given document
+        @param action: bulk action, e.g. 'index' or 'update'
+        @param source: serialized document (or update body)
+        """
+        header = serialize({action: {'_id': doc_id}})
+        size = len(header) + len(source) + 2
+        if self._chunk and (len(self._chunk) >= self.chunk_size or
+                            self._chunk_bytes + size > self.chunk_bytes):
+            self._send_chunk()
+        self._chunk.append((header, source))
+        self._chunk_bytes += size
+
+    def index(self, doc_id, source):
+        self.add("index", doc_id, source)
+
+    def update(self, doc_id, source):
+        self.add("update", doc_id, source)
+
+    def flush(self):
+        """Send all pending actions and wait until all requests have finished"""
+        if self._chunk:
+            self._send_chunk()
+        self.queue.join()
+        self._raise_worker_errors()
+
+    def close(self):
+        """Flush the indexer and stop the worker threads. Raises an ElasticSearchError
+        if any of the items could not be processed."""
+        try:
+            self.flush()
+        finally:
+            self._stop()
+        if self.failed:
+            raise ElasticSearchError(self.failed)
+
+    def _stop(self):
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def _raise_worker_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def _send_chunk(self):
+        chunk, self._chunk, self._chunk_bytes = self._chunk, [], 0
+        self._raise_worker_errors()
+
+        if not self.concurrency:
+            self._bulk(chunk)
+            return
+
+        if not self._workers:
+            for _ in range(self.concurrency):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+        self.queue.put(chunk)
+
+    def _work(self):
+        while True:
+            chunk = self.queue.get()
+            try:
+                if chunk is None:
+                    return
+                self._bulk(chunk)
+            except Exception as e:
+                log.exception("Error on sending bulk request")
+                with self._lock:
+                    self._errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _wait(self, attempt):
+        time.sleep(self.retry_wait * 2 ** attempt)
+
+    def _bulk(self, chunk):
+        """Send the chunk, retrying rejected items until max_retries is reached"""
+        attempt = 0
+        while chunk:
+            body = "\n".join(chain.from_iterable(chunk)) + "\n"
+            try:
+                resp = self.es.bulk(body=body, index=self.index, doc_type=self.doc_type)
+            except TransportError as e:
+                if e.status_code not in BULK_RETRY_STATUSES or attempt >= self.max_retries:
+                    raise
+                log.warning("Bulk request rejected ({e.status_code}), retrying".format(**locals()))
+            else:
+                with self._lock:
+                    self.n_requests += 1
+                if not resp["errors"]:
+                    return
+                chunk = self._get_retries(chunk, resp["items"], attempt)
+
+            if chunk:
+                with self._lock:
+                    self.n_retried += len(chunk)
+                self._wait(attempt)
+                attempt += 1
+
+    def _get_retries(self, chunk, items, attempt):
+        """Return the actions in chunk that should be retried, recording failed items"""
+        retry, failed = [], []
+        for action, item in zip(chunk, items):
+            result, = item.values()
+            status = result.get("status", 200)
+            if status < 300:
+                continue
+            if status in BULK_RETRY_STATUSES and attempt < self.max_retries:
+                retry.append(action)
+            else:
+                failed.append(result)
+
+        if failed:
+            log.warning("{n} items in bulk request failed".format(n=len(failed)))
+            with self._lock:
+                self.failed += failed
+        return retry
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_pid = None
+
+
+def get_client(timeout=None, **options):
+    """
+    Return the Elasticsearch client for the given options, which is shared by all ES objects
+    in this process. Clients are thread safe and keep a pool of persistent connections, so
+    sharing them saves setting up connections (and sniffing) for every ES object.
+
+    @param timeout: request timeout in seconds, defaults to settings.ES_TIMEOUT
+    @param options: extra options for the Elasticsearch client
+    """
+    global _clients_pid
+    options = dict(timeout=settings.ES_TIMEOUT if timeout is None else timeout, **options)
+    key = tuple(sorted(options.items()))
+
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            # Connections cannot be shared with a forked parent (e.g. celery workers)
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        try:
+            return _clients[key]
+        except KeyError:
+            pass
+
+        if settings.ES_SNIFF:
+            options.setdefault("sniff_on_start", True)
+            options.setdefault("sniff_on_connection_fail", True)
+            options.setdefault("sniffer_timeout", settings.ES_SNIFF_INTERVAL)
+        options.setdefault("maxsize", settings.ES_POOL_SIZE)
+
+        hosts = [{"host": settings.ES_HOST, "port": settings.ES_PORT}]
+        client = _clients[key] = Elasticsearch(hosts=hosts, **options)
+        return client
+
+
 class ES(object):
-    def __init__(self, index=None, doc_type=None, timeout=300, **args):
-        elhost = {"host":settings.ES_HOST, "port":settings.ES_PORT}
-        self.es = Elasticsearch(hosts=[elhost, ], timeout=timeout, **args)
+    def __init__(self, index=None, doc_type=None, timeout=None, **args):
+        self.es = get_client(timeout=timeout, **args)
         self.index = settings.ES_INDEX if index is None else index
         self.doc_type = settings.ES_ARTICLE_DOCTYPE if doc_type is None else doc_type
 
     def flush(self):
         indices.IndicesClient(self.es).flush()
 
-    def highlight_article(self, aid, query):
-        query = queryparser.parse_to_terms(query).get_dsl()
-
+    def _get_highlight_body(self, article_ids, query, fields=HIGHLIGHT_FIELDS):
         highlight_opts = {
-            "highlight_query": query,
-            "number_of_fragments": 0
+            "highlight_query": queryparser.get_dsl(query),
+            "number_of_fragments": 0,
+            "pre_tags": [HIGHLIGHT_PRE_TAG],
+            "post_tags": [HIGHLIGHT_POST_TAG],
         }
-
-        body = {
-            'filter': build_filter(ids=aid),
-            'highlight': {
-                "fields": {
-                    "text": highlight_opts,
-                    "headline": highlight_opts,
-                    "byline": highlight_opts
-                }
-            }
+        return {
+            'filter': build_filter(ids=article_ids),
+            'highlight': {"fields": {f: highlight_opts for f in fields}}
         }
 
-        r = self.search(body, fields=[])
+    def highlight_article(self, aid, query):
+        """
+        Highlight a single article, returning a {field: highlighted_text} dict. Use
+        highlight_articles to highlight multiple articles and get parsed offsets.
+        """
+        r = self.search(self._get_highlight_body(aid, query), fields=[])
         try:
             hl = r['hits']['hits'][0]['highlight']
             return {f: hl[f][0] for f in hl}
-        except KeyError:
+        except (KeyError, IndexError):
             log.exception("Could not get highlights from {r!r}".format(**locals()))
 
+    def highlight_articles(self, article_ids, query, fields=HIGHLIGHT_FIELDS):
+        """
+        Highlight the query in the given articles using a single request
+        @param article_ids: sequence of article ids, e.g. a page of search results
+        @param fields: the fields to highlight
+        @return: a {article_id: {field: Highlight}} dict for the articles and fields with hits.
+                 The offsets index into Highlight.text, which is the unmarked field text.
+        """
+        article_ids = list(article_ids)
+        if not article_ids:
+            return {}
+        body = self._get_highlight_body(article_ids, query, fields)
+        r = self.search(body, fields=[], size=len(article_ids))
+        return {int(hit['_id']): {f: parse_highlight(hl[0]) for (f, hl) in hit['highlight'].items()}
+                for hit in r['hits']['hits'] if hit.get('highlight')}
+
     def clear_cache(self):
         indices.IndicesClient(self.es).clear_cache()
 
     def delete_index(self):
+        self.invalidate_cache()
         try:
             indices.IndicesClient(self.es).delete(self.index)
         except Exception, e:
@@ -367,19 +769,13 @@ class ES(object):
                       size=1000, fields=""):
             yield int(a['_id'])
 
-    def query(self, query=None, filters={}, highlight=False, lead=False, fields=[], score=True, **kwargs):
-        """
-        Execute a query for the given fields with the given query and filter
-        @param query: a elastic query string (i.e. lucene syntax, e.g. 'piet AND (ja* OR klaas)')
-        @param filter: field filter DSL query dict, defaults to build_filter(**filters)
-        @param kwargs: additional keyword arguments to pass to es.search, eg fields, sort, from_, etc
-        @return: a list of named tuples containing id, score, and the requested fields
-        """
+    def _get_query_body(self, query=None, filters={}, highlight=False, lead=False, score=True, sort=False):
+        """Build the search body for query(), see there for the parameters"""
         body = dict(build_body(query, filters, query_as_filter=(not (highlight or score))))
         if highlight and not score:
             body['query'] = {'constant_score': {'query': body['query']}}
 
-        if 'sort' in kwargs:
+        if sort:
             body['track_scores'] = True
 
         if highlight:
@@ -388,65 +784,197 @@ class ES(object):
             else:
                 body['highlight'] = HIGHLIGHT_OPTIONS
         if lead: body['script_fields'] = LEAD_SCRIPT_FIELD
+        return body
 
+    def query(self, query=None, filters={}, highlight=False, lead=False, fields=[], score=True, **kwargs):
+        """
+        Execute a query for the given fields with the given query and filter
+        @param query: a elastic query string (i.e. lucene syntax, e.g. 'piet AND (ja* OR klaas)')
+        @param filter: field filter DSL query dict, defaults to build_filter(**filters)
+        @param kwargs: additional keyword arguments to pass to es.search, eg fields, sort, from_, etc
+        @return: a list of named tuples containing id, score, and the requested fields
+        """
+        body = self._get_query_body(query, filters, highlight, lead, score, sort='sort' in kwargs)
         result = self.search(body, fields=fields, **kwargs)
         return SearchResult(result, fields, score, body, query=query)
 
+    def _multi_search(self, bodies, **header):
+        """
+        Execute the given search bodies in a single msearch request
+        @param header: search options for all bodies, e.g. search_type
+        @return: a list of raw results, in the order of bodies
+        """
+        header = serialize(header)
+        body = "".join("{}\n{}\n".format(header, serialize(b)) for b in bodies)
+        responses = self.es.msearch(body=body, index=self.index, doc_type=self.doc_type)["responses"]
+        for response in responses:
+            if "error" in response:
+                raise ElasticSearchError(response["error"])
+        return responses
+
+    def multi_query(self, queries, filters={}, highlight=False, lead=False, fields=[], score=True,
+                    size=10, sort=None):
+        """
+        Execute multiple queries with the same filters in a single (msearch) request
+
+        @param queries: SearchQuery objects or elastic query strings
+        @param size: maximum number of hits per query, or a sequence with a size per query
+        @return: a list of SearchResult objects, in the order of queries
+        """
+        queries = [getattr(q, "query", q) for q in queries]
+        if not queries:
+            return []
+
+        sizes = size if isinstance(size, (list, tuple)) else [size] * len(queries)
+        bodies = []
+        for query, n in zip(queries, sizes):
+            body = self._get_query_body(query, filters, highlight, lead, score, sort=bool(sort))
+            body.update(size=n, fields=fields)
+            if sort:
+                body["sort"] = sort
+            bodies.append(body)
+
+        responses = self._multi_search(bodies)
+        return [SearchResult(response, fields, score, body, query=query)
+                for (response, body, query) in zip(responses, bodies, queries)]
+
+    def multi_count(self, queries, filters={}):
+        """
+        Count the number of hits of multiple queries in a single (msearch) request
+        @param queries: SearchQuery objects or elastic query strings
+        @return: a list of counts, in the order of queries
+        """
+        queries = [getattr(q, "query", q) for q in queries]
+        if not queries:
+            return []
+
+        bodies = [{"query": {"constant_score": dict(build_body(q, filters, query_as_filter=True))}}
+                  for q in queries]
+        return [r["hits"]["total"] for r in self._multi_search(bodies, search_type="count")]
+
+    def multi_query_all(self, queries, max_size=None, **kargs):
+        """
+        Like multi_query, but return all hits of every query. The hits are counted in one
+        msearch request, and the queries with at most max_size hits are retrieved in a second
+        one. Queries with more hits (also if the count was stale) are scrolled using query_iter,
+        so their results can only be iterated once.
+
+        @param max_size: defaults to settings.ES_MULTI_QUERY_MAX_SIZE
+        """
+        max_size = settings.ES_MULTI_QUERY_MAX_SIZE if max_size is None else max_size
+        queries = list(queries)
+        counts = self.multi_count(queries, kargs.get("filters", {}))
+
+        small = [i for (i, n) in enumerate(counts) if n <= max_size]
+        results = [None] * len(queries)
+        responses = self.multi_query([queries[i] for i in small], size=[counts[i] for i in small], **kargs)
+        for i, result in zip(small, responses):
+            if result.total <= len(result):
+                results[i] = result
+
+        for i, query in enumerate(queries):
+            if results[i] is None:
+                results[i] = self.query_iter(getattr(query, "query", query), **kargs)
+        return results
+
+    def query_iter(self, *args, **kargs):
+        """
+        Execute a query like query(), but lazily yield all matching Result objects, fetching
+        them page by page (of `size` hits) using the scroll API. The returned
+        ScrollSearchResult has a .total, which is known as soon as the first page is fetched.
+
+        @param scroll: time to keep the scroll context alive between page requests
+        """
+        kargs.setdefault('size', 1000)
+        scroll = kargs.setdefault('scroll', '5m')
+        return ScrollSearchResult(self.es, self.query(*args, **kargs), scroll)
+
     def query_all(self, *args, **kargs):
-        kargs.update({"from_": 0})
-        size = kargs.setdefault('size', 10000)
-        result = self.query(*args, **kargs)
-        total = result.total
-        for offset in range(size, total, size):
-            kargs['from_'] = offset
-            result2 = self.query(*args, **kargs)
-            result.hits += result2.hits
+        """
+        Execute a query like query(), but return a SearchResult containing all hits
+        instead of a single page. Use query_iter() to avoid keeping all hits in memory.
+        """
+        result = self.query_iter(*args, **kargs)
+        hits = list(result.iter_hits())
+        return SearchResult({'hits': {'hits': hits, 'total': result.total}},
+                            result.fields, result.score, result.body, query=result.query)
 
-        return result
+    def bulk_indexer(self, **options):
+        """
+        Return a BulkIndexer on this index. See BulkIndexer for the available options.
+        """
+        return BulkIndexer(self.es, self.index, self.doc_type, **options)
 
     def add_articles(self, article_ids, batch_size=1000):
         """
         Add the given article_ids to the index. This is done in batches, so there
-        is no limit on the length of article_ids (which can be a generator).
+        is no limit on the length of article_ids (which can be a generator). Batches
+        are fetched from the database while the previous batches are being indexed.
+        If settings.ES_HASH_INDEX is set, the hashes are also stored (see amcat.tools.duplicates).
         """
-        if not article_ids: return
-        from amcat.models import Article, ArticleSetArticle
-
-        n = len(article_ids) / batch_size
-        for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
-            log.info("Adding batch {i}/{n}".format(**locals()))
-            all_sets = multidict((aa.article_id, aa.articleset_id)
-                                 for aa in ArticleSetArticle.objects.filter(article__in=batch))
-            dicts = (get_article_dict(article, list(all_sets.get(article.id, [])))
-                     for article in Article.objects.filter(pk__in=batch))
-            self.bulk_insert(dicts)
-
-    def remove_from_set(self, setid, article_ids, flush=True):
+        from amcat.tools.duplicates import HashIndex
+        hash_index = HashIndex() if settings.ES_HASH_INDEX else None
+        setids = set()
+        try:
+            with self.bulk_indexer() as indexer:
+                for i, batch in enumerate(splitlist(article_ids, itemsperbatch=batch_size)):
+                    log.info("Adding batch {i}".format(**locals()))
+                    hashes = {}
+                    for article_dict in get_article_dicts(batch):
+                        setids.update(article_dict["sets"] or ())
+                        hashes[article_dict["hash"]] = article_dict["id"]
+                        indexer.index(article_dict["id"], serialize_article_dict(article_dict))
+                    if hash_index is not None:
+                        hash_index.add(hashes)
+        finally:
+            self.invalidate_cache(setids)
+
+    def remove_from_set(self, setid, article_ids, flush=True, monitor=NullMonitor(), concurrency=None):
         """Remove the given articles from the given set. This is done in batches, so there
         is no limit on the length of article_ids (which can be a generator)."""
-        if not article_ids: return
-        for batch in splitlist(article_ids, itemsperbatch=1000):
-            self.bulk_update(batch, UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set': setid})
+        payload = serialize(dict(script=UPDATE_SCRIPT_REMOVE_FROM_SET, params={'set': setid}))
+        try:
+            self._bulk_update_sets(((aid, payload) for aid in article_ids), _len(article_ids),
+                                   monitor, "Removed from set", concurrency)
+        finally:
+            self.invalidate_cache([setid])
 
-    def add_to_set(self, setid, article_ids, monitor=NullMonitor()):
+    def add_to_set(self, setid, article_ids, monitor=NullMonitor(), concurrency=None):
         """Add the given articles to the given set. This is done in batches, so there
         is no limit on the length of article_ids (which can be a generator)."""
-        if not article_ids: return
-        batches = list(splitlist(article_ids, itemsperbatch=1000))
-        nbatches = len(batches)
-        for i, batch in enumerate(batches):
-            monitor.update(40/nbatches, "Added batch {iplus}/{nbatches}".format(iplus=i+1, **locals()))
-            self.bulk_update(article_ids, UPDATE_SCRIPT_ADD_TO_SET, params={'set' : setid})
+        payload = serialize(dict(script=UPDATE_SCRIPT_ADD_TO_SET, params={'set': setid}))
+        try:
+            self._bulk_update_sets(((aid, payload) for aid in article_ids), _len(article_ids),
+                                   monitor, "Added to set", concurrency)
+        finally:
+            self.invalidate_cache([setid])
 
-    def bulk_insert(self, dicts):
+    def _bulk_update_sets(self, payloads, total, monitor, message, concurrency, monitor_units=40):
         """
-        Add the given article dict objects to the index using a bulk insert call
+        Send the (article_id, payload) updates in bounded bulk requests, reporting progress
+        after every request. If total is known, monitor_units are spread over the articles.
         """
-        body = get_bulk_body({d["id"]: serialize(d) for d in dicts})
-        resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
+        n = 0
+        with self.bulk_indexer(concurrency=concurrency) as indexer:
+            for batch in splitlist(payloads, itemsperbatch=indexer.chunk_size):
+                for aid, payload in batch:
+                    indexer.update(aid, payload)
+                n += len(batch)
+                units = float(monitor_units) * len(batch) / total if total else 0
+                monitor.update(units, "{message} {n}/{total}".format(total=total or "?", **locals()))
 
-        if resp["errors"]:
-            raise ElasticSearchError(resp)
+    def bulk_insert(self, dicts):
+        """
+        Add the given article dict objects to the index using bulk insert calls
+        """
+        setids = set()
+        try:
+            with self.bulk_indexer() as indexer:
+                for d in dicts:
+                    setids.update(d.get("sets") or ())
+                    indexer.index(d["id"], serialize_article_dict(d))
+        finally:
+            self.invalidate_cache(setids)
 
     def update_values(self, article_id, values):
         """Update properties of existing article.
@@ -458,68 +986,115 @@ class ES(object):
     def bulk_update_values(self, articles):
         """Updates set of articles in bulk.
         """
-        body = get_bulk_body({aid: serialize({"doc": a}) for aid, a in articles.items()}, action="update")
-        resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
-
-        if resp["errors"]:
-            raise ElasticSearchError(resp)
+        try:
+            with self.bulk_indexer() as indexer:
+                for aid, a in articles.items():
+                    indexer.update(aid, serialize({"doc": a}))
+        finally:
+            self.invalidate_cache()
 
     def bulk_update(self, article_ids, script, params):
         """
         Execute a bulk update script with the given params on the given article ids.
         """
         payload = serialize(dict(script=script, params=params))
-        body = get_bulk_body({aid: payload for aid in article_ids}, action="update")
-        resp = self.es.bulk(body=body, index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE)
-
-        if resp["errors"]:
-            raise ElasticSearchError(resp)
+        try:
+            with self.bulk_indexer() as indexer:
+                for aid in article_ids:
+                    indexer.update(aid, payload)
+        finally:
+            self.invalidate_cache()
 
-    def synchronize_articleset(self, aset, full_refresh=False):
+    def synchronize_articleset(self, aset, full_refresh=False, incremental=False, batch_size=10000):
         """
         Make sure the given articleset is correctly stored in the index
+
+        The set is compared to the index by merging the sorted article ids from the database
+        and from the index, so memory use does not depend on the size of the set. After every
+        batch of batch_size articles a checkpoint is stored on the set, so an interrupted
+        synchronisation resumes where it left off. When done, the start time is stored as
+        the index_synced_until watermark of the set.
+
         @param full_refresh: if true, re-add all articles to the index. Use this
                              after changing properties of articles
+        @param incremental: if true and the set was synchronised before, only consider articles
+                            inserted after the watermark. This is much faster for routine syncs,
+                            but does not detect removed articles or existing articles that were
+                            added to the set without updating the index.
         """
+        from django.utils import timezone
         self.check_index()  # make sure index exists and is at least 'yellow'
+        started = timezone.now()
 
-        log.debug("Getting SOLR ids from set")
-        solr_set_ids = set(self.query_ids(filters=dict(sets=aset.id)))
-        log.debug("Getting DB ids")
-        db_ids = aset.get_article_ids()
-        log.debug("Getting SOLR ids")
-        solr_ids = set(self.in_index(db_ids))
-
-        to_remove = solr_set_ids - db_ids
-        if full_refresh:
-            to_add_docs = db_ids
-            to_add_set = set()
+        if incremental and not full_refresh and aset.index_synced_until is not None:
+            self._synchronize_new_articles(aset, batch_size)
         else:
-            to_add_docs = db_ids - solr_ids
-            to_add_set = (db_ids & solr_ids) - solr_set_ids
+            self._synchronize_all_articles(aset, full_refresh, batch_size)
+
+        self._set_sync_state(aset, index_synced_until=started, index_sync_checkpoint=None)
+        log.info("Flushing")
+        self.flush()
+
+    def _set_sync_state(self, aset, **state):
+        type(aset).objects.filter(pk=aset.pk).update(**state)
+        for field, value in state.items():
+            setattr(aset, field, value)
+
+    def _synchronize_all_articles(self, aset, full_refresh, batch_size):
+        checkpoint = aset.index_sync_checkpoint
+        if checkpoint is not None:
+            log.info("Resuming synchronisation of set {aset.id} after article {checkpoint}".format(**locals()))
+
+        db_ids = aset.iter_article_ids(after=checkpoint, batch_size=batch_size)
+        index_set_ids = self._iter_set_ids(aset.id, after=checkpoint, size=batch_size)
+
+        for batch in splitlist(sorted_diff(db_ids, index_set_ids), itemsperbatch=batch_size):
+            to_remove = [aid for (aid, in_db, in_set) in batch if not in_db]
+            if full_refresh:
+                self.add_articles([aid for (aid, in_db, in_set) in batch if in_db])
+            else:
+                self._add_missing(aset, [aid for (aid, in_db, in_set) in batch if in_db and not in_set])
+
+            log.info("Removing {} articles from set".format(len(to_remove)))
+            self.remove_from_set(aset.id, to_remove)
+            self._set_sync_state(aset, index_sync_checkpoint=batch[-1][0])
+
+    def _synchronize_new_articles(self, aset, batch_size):
+        new_ids = aset.iter_article_ids(inserted_since=aset.index_synced_until, batch_size=batch_size)
+        for batch in splitlist(new_ids, itemsperbatch=batch_size):
+            in_set = set(self.query_ids(filters={"ids": batch, "sets": aset.id}))
+            self._add_missing(aset, [aid for aid in batch if aid not in in_set])
 
-        log.warn("Refreshing index, full_refresh={full_refresh},"
-                 "|solr_set_ids|={nsolrset}, |db_set_ids|={ndb}, |solr_ids|={nsolr} "
-                 "|to_add| = {nta}, |to_add_set|={ntas}, |to_remove_set|={ntr}"
-                 .format(nsolr=len(solr_ids), nsolrset=len(solr_set_ids), ndb=len(db_ids),
-                         nta=len(to_add_docs), ntas=len(to_add_set), ntr=len(to_remove), **locals()))
+    def _add_missing(self, aset, article_ids):
+        """Add the given articles, which are not in the set in the index, to the set or index"""
+        in_index = set(self.in_index(article_ids))
+        to_add_set = [aid for aid in article_ids if aid in in_index]
+        to_add_docs = [aid for aid in article_ids if aid not in in_index]
 
-        log.info("Removing {} articles".format(len(to_remove)))
-        self.remove_from_set(aset.id, to_remove)
         log.info("Adding {} articles to set".format(len(to_add_set)))
         self.add_to_set(aset.id, to_add_set)
         log.info("Adding {} articles to index".format(len(to_add_docs)))
         self.add_articles(to_add_docs)
-        log.info("Flushing")
-        self.flush()
+
+    def _iter_set_ids(self, setid, after=None, size=10000, scroll="10m"):
+        """Yield the ids of the articles in the given set in ascending order"""
+        filters = list(get_filter_clauses(sets=setid))
+        if after is not None:
+            filters.append({"range": {"id": {"gt": after}}})
+        body = {"query": {"constant_score": {"filter": combine_filters(filters)}}}
+
+        first_page = SearchResult(self.search(body, fields=[], sort=["id"], size=size, scroll=scroll),
+                                  [], False, body)
+        for hit in ScrollSearchResult(self.es, first_page, scroll).iter_hits():
+            yield int(hit['_id'])
 
     def count(self, query=None, filters=None):
         """
         Compute the number of items matching the given query / filter
         """
-        filters = dict(build_body(query, filters, query_as_filter=True))
-        body = {"query": {"constant_score": filters}}
-        result = self.es.count(index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body=body)
+        body = {"query": {"constant_score": dict(build_body(query, filters, query_as_filter=True))}}
+        result = self._cached("count", body, filters, lambda: self.es.count(
+            index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body=body))
         return result["count"]
 
     def search_aggregate(self, aggregation, query=None, filters=None):
@@ -529,34 +1104,38 @@ class ES(object):
         """
         body = dict(query={"filtered": dict(build_body(query, filters, query_as_filter=True))},
                     aggregations={"aggregation": aggregation})
-        result = self.search(body, size=0, search_type="count")
+        result = self._cached("search_aggregate", body, filters,
+                              lambda: self.search(body, size=0, search_type="count"))
         return result['aggregations']['aggregation']
 
-    def _parse_terms_aggregate(self, aggregate, group_by, terms, sets):
+    def _parse_terms_aggregate(self, aggregate, group_by, terms, include):
         if not group_by:
             for term in terms:
                 yield term, aggregate[term.label]['doc_count']
         else:
             for term in terms:
-                yield term, self._parse_aggregate(aggregate[term.label], list(group_by), terms, sets)
+                yield term, self._parse_aggregate(aggregate[term.label], list(group_by), terms, include)
 
-    def _parse_other_aggregate(self, aggregate, group_by, group, terms, sets):
+    def _parse_other_aggregate(self, aggregate, group_by, group, terms, include):
         buckets = aggregate[group]["buckets"]
         if not group_by:
             return ((b['key'], b['doc_count']) for b in buckets)
-        return ((b['key'], self._parse_aggregate(b, list(group_by), terms, sets)) for b in buckets)
+        return ((b['key'], self._parse_aggregate(b, list(group_by), terms, include)) for b in buckets)
 
-    def _parse_aggregate(self, aggregate, group_by, terms, sets):
-        """Parse a aggregation result to (nested) namedtuples."""
+    def _parse_aggregate(self, aggregate, group_by, terms, include):
+        """
+        Parse a aggregation result to (nested) namedtuples.
+        @param include: {group: keys} dict to only return the given buckets of these groups
+        """
         group = group_by.pop(0)
 
         if group == "terms":
-            result = self._parse_terms_aggregate(aggregate, group_by, terms, sets)
+            result = self._parse_terms_aggregate(aggregate, group_by, terms, include)
         else:
-            result = self._parse_other_aggregate(aggregate, group_by, group, terms, sets)
-            if group == "sets" and sets is not None:
-                # Filter sets if 'sets' is given
-                result = ((aset_id, res) for aset_id, res in result if aset_id in set(sets))
+            result = self._parse_other_aggregate(aggregate, group_by, group, terms, include)
+            if group in include:
+                # Drop buckets that were not asked for, such as the other sets of articles
+                result = ((key, res) for key, res in result if key in include[group])
             elif group == "date":
                 # Parse timestamps as datetime objects
                 result = ((get_date(stamp), aggr) for stamp, aggr in result)
@@ -565,8 +1144,11 @@ class ES(object):
         ntuple = namedtuple("Aggr", [group, "buckets" if group_by else "count"])
         return [ntuple(*r) for r in result]
 
-    def _build_aggregate(self, group_by, date_interval, terms, sets):
-        """Build nested aggregation query for list of groups"""
+    def _build_aggregate(self, group_by, date_interval, terms, sets, sizes):
+        """
+        Build nested aggregation query for list of groups
+        @param sizes: {group: number of buckets} for the groups that are not 'date' or 'terms'
+        """
         group = group_by.pop(0)
 
         if group == 'date':
@@ -588,8 +1170,8 @@ class ES(object):
             aggregation = {
                 group: {
                     'terms': {
-                        # Default size is too small, we want to return all results
-                        'size': 999999,
+                        # Never use size 0, which asks elastic for all buckets of every shard
+                        'size': max(1, sizes[group]),
                         'field': group
                     }
                 }
@@ -598,13 +1180,61 @@ class ES(object):
         # We need to nest the other aggregations, see:
         # http://www.elasticsearch.org/guide/en/elasticsearch/reference/current/search-aggregations.html
         if group_by:
-            nested = self._build_aggregate(group_by, date_interval, terms, sets)
+            nested = self._build_aggregate(group_by, date_interval, terms, sets, sizes)
             for aggr in aggregation.values():
                 aggr["aggregations"] = nested
 
         return aggregation
 
-    def aggregate_query(self, query=None, filters=None, group_by=None, terms=None, sets=None, date_interval='month'):
+    def _get_aggregate_keys(self, group, query=None, filters=None, top=None, page_size=None):
+        """
+        Return the bucket keys of group in the selection, ordered by descending article count.
+        If top is given, return at most that many keys (plus one to show that there are more).
+        Otherwise, the keys are requested in order in pages of page_size buckets.
+        """
+        if top is not None:
+            aggregation = {"terms": {"field": group, "size": top + 1}}
+            return [b["key"] for b in self.search_aggregate(aggregation, query, filters)["buckets"]]
+
+        page_size = page_size or settings.ES_AGGREGATION_PAGE_SIZE
+        aggregation = {"terms": {"field": group, "size": page_size, "order": {"_term": "asc"}}}
+        selection = {"constant_score": dict(build_body(query, filters, query_as_filter=True))}
+        buckets, page_filter = [], None
+        while True:
+            body = {"query": selection, "aggregations": {"aggregation": aggregation}}
+            if page_filter is not None:
+                body["query"] = {"filtered": {"query": selection, "filter": page_filter}}
+            result = self._cached("search_aggregate", body, filters,
+                                  lambda: self.search(body, size=0, search_type="count"))
+            page = result["aggregations"]["aggregation"]["buckets"]
+            buckets += page
+            if len(page) < page_size:
+                break
+            page_filter = {"range": {group: {"gt": page[-1]["key"]}}}
+        buckets.sort(key=lambda b: -b["doc_count"])
+        return [b["key"] for b in buckets]
+
+    def _aggregate_page(self, query, filters, group_by, terms, date_interval, include, sizes, page_filter=None):
+        """
+        Compute the aggregation for the selection further restricted by page_filter.
+        @return: the parsed aggregation, or the number of articles if group_by is empty
+        """
+        body = {"constant_score": dict(build_body(query, filters, query_as_filter=True))}
+        if page_filter is not None:
+            body = {"filtered": {"query": body, "filter": page_filter}}
+        body = {"query": body}
+        if group_by:
+            body["aggregations"] = self._build_aggregate(list(group_by), date_interval, terms, None, sizes)
+
+        log.debug("es.search(body={body})".format(**locals()))
+        result = self._cached("aggregate_query", body, filters,
+                              lambda: self.search(body, size=0, search_type="count"))
+        if not group_by:
+            return result["hits"]["total"]
+        return self._parse_aggregate(result["aggregations"], list(group_by), terms, include)
+
+    def aggregate_query(self, query=None, filters=None, group_by=None, terms=None, sets=None, date_interval='month',
+                        top=None):
         """
         Compute an aggregate query, e.g. select count(*) where <filters> group by <group_by>. If
         date is used as a group_by variable, uses date_interval to bin it. It does support multiple
@@ -614,30 +1244,84 @@ class ES(object):
         supply terms as a parameter, which consists of a list of SearchQuery's. Query is then used
         as a global filter, while terms are 'local'.
 
+        See iter_aggregate for the top parameter and how large aggregations are computed.
+
         @param query: an elastic query string (i.e. lucene syntax, e.g. 'piet AND (ja* OR klaas)')
         @type group_by: list / tuple
         @type mediums: bool
         @param mediums: return Medium objects, instead of ids
         """
+        return list(self.iter_aggregate(query, filters, group_by, terms, sets, date_interval, top=top))
+
+    def iter_aggregate(self, query=None, filters=None, group_by=None, terms=None, sets=None, date_interval='month',
+                       top=None, page_size=None):
+        """
+        Compute an aggregate query like aggregate_query, but page through the buckets of the first
+        group that is not 'date' or 'terms' (e.g. mediumid or sets) instead of asking elastic for
+        all (nested) buckets in one request. If that group is the first in group_by, the results
+        are yielded page by page; otherwise the pages are merged before yielding.
+
+        @param top: only return the top buckets (by number of articles) of the paged group, and
+                    an OTHER_BUCKET counting the articles that are in none of them
+        @param page_size: buckets of the paged group per request (default ES_AGGREGATION_PAGE_SIZE)
+        """
         if isinstance(group_by, basestring):
             log.warning("Passing strings to aggregate_query(group_by) is deprecated.")
             group_by = [group_by]
+        group_by = list(group_by)
 
         if "terms" in group_by and terms is None:
             raise ValueError("You should pass a list of terms if aggregating on it.")
 
-        filters = dict(build_body(query, filters, query_as_filter=True))
-        aggregations = self._build_aggregate(list(group_by), date_interval, terms, sets)
+        include = {} if sets is None else {"sets": set(sets)}
+        paged = [i for (i, group) in enumerate(group_by) if group not in ("date", "terms")]
 
-        body = {
-            "query": {"constant_score": filters},
-            "aggregations": aggregations
-        }
+        if not paged:
+            if top is not None:
+                raise ValueError("Cannot use top without grouping on a field such as mediumid or sets")
+            for row in self._aggregate_page(query, filters, group_by, terms, date_interval, include, {}):
+                yield row
+            return
 
-        log.debug("es.search(body={body})".format(**locals()))
-        result = self.search(body)
-        result = self._parse_aggregate(result["aggregations"], list(group_by), terms, sets)
-        return result
+        depth = paged[0]
+        group = group_by[depth]
+        page_size = page_size or settings.ES_AGGREGATION_PAGE_SIZE
+        keys = self._get_aggregate_keys(group, query, filters, top=None if group in include else top,
+                                        page_size=page_size)
+        if group in include:
+            keys = [key for key in keys if key in include[group]]
+
+        other_keys = []
+        if top is not None:
+            keys, other_keys = keys[:top], keys[top:]
+
+        # Every bucket of a nested group can contain at most all keys of that group
+        sizes = {g: len(self._get_aggregate_keys(g, query, filters, page_size=page_size))
+                 for g in group_by[depth + 1:] if g not in ("date", "terms")}
+
+        pages = (self._aggregate_page(query, filters, group_by, terms, date_interval,
+                                      dict(include.items() + [(group, set(page_keys))]),
+                                      dict(sizes, **{group: len(page_keys)}), {"terms": {group: page_keys}})
+                 for page_keys in splitlist(keys, page_size))
+
+        if other_keys:
+            other_group_by = group_by[:depth] + group_by[depth + 1:]
+            other = self._aggregate_page(query, filters, other_group_by, terms, date_interval,
+                                         include, sizes, {"not": {"terms": {group: keys}}})
+            other = _insert_bucket(other, depth, group, OTHER_BUCKET, depth == len(group_by) - 1)
+            pages = chain(pages, [other])
+
+        if depth > 0:
+            # The rows of the outer groups contain buckets of every page, so merge each page as
+            # it arrives rather than keeping all pages and merging afterwards
+            merged = OrderedDict()
+            for page in pages:
+                _merge_page(merged, page, depth)
+            pages = [_merged_rows(merged, group_by)]
+
+        for page in pages:
+            for row in page:
+                yield row
 
     def statistics(self, query=None, filters=None):
         """Compute and return a Result object with n, start_date and end_date for the selection"""
@@ -652,7 +1336,8 @@ class ES(object):
             }
         }
 
-        stats = self.search(body, size=0)['facets']['stats']
+        result = self._cached("statistics", body, filters, lambda: self.search(body, size=0))
+        stats = result['facets']['stats']
         result = Result()
         result.n = stats['count']
         if result.n == 0:
@@ -706,35 +1391,107 @@ class ES(object):
         """
         if not isinstance(article, int):
             article = article.id
-        # get highlighted text
-        hl = self.highlight_article(article, query)
-        if not (hl and 'text' in hl):
+        hl = self.highlight_articles([article], query, fields=["text"]).get(article, {}).get("text")
+        if hl is None:
             return
-        text = hl['text']
-
-        # parse highlight to return offsets
-        pre_tag, post_tag = "<em>", "</em>"
-        in_tag = False
-        offset = 0
-        for token in re.split("({pre_tag}|{post_tag})".format(**locals()), text):
-            if token == pre_tag:
-                if in_tag:
-                    raise ValueError("Encountered pre_tag while in tag")
-                in_tag = True
-            elif token == post_tag:
-                if not in_tag:
-                    raise ValueError("Encountered post_tag while not in tag")
-                in_tag = False
-            else:
-                if in_tag:
-                    yield offset, token
-                offset += len(token)
-
+        for offset, length in hl.offsets:
+            yield offset, hl.text[offset:offset + length]
 
     def purge_orphans(self):
         """Remove all articles without set from the index"""
         query =  {"query": {"constant_score": {"filter": {"missing": {"field": "sets"}}}}}
         self.es.delete_by_query(index=self.index, doc_type=settings.ES_ARTICLE_DOCTYPE, body=query)
+        self.invalidate_cache()
+
+    def _cached(self, name, body, filters, func):
+        """
+        Return the result of func() for the given request body, using RESULT_CACHE. Results
+        are invalidated by writes to the sets in filters, or to any set if filters does not
+        filter on sets. Elastic only makes writes visible after a refresh, so results computed
+        shortly after a write are not cached (see settings.ES_RESULT_CACHE_SETTLE_TIME).
+        """
+        setids = _get_filter_sets(filters)
+        tags = ["all"] + (["set:{}".format(s) for s in setids] if setids is not None else ["any"])
+        tags = ["{}:{}".format(self.index, tag) for tag in tags]
+        return RESULT_CACHE.get(name, [self.index, self.doc_type, body], tags, func)
+
+    def invalidate_cache(self, setids=None):
+        """
+        Invalidate the cached results that depend on the given sets, or all cached
+        results of this index if setids is None.
+        """
+        tags = ["all"] if setids is None else ["any"] + ["set:{}".format(s) for s in setids]
+        RESULT_CACHE.invalidate(["{}:{}".format(self.index, tag) for tag in tags])
+
+    def cache_stats(self):
+        """Return the {call: {'hits': n, 'misses': n}} statistics of the result cache"""
+        return RESULT_CACHE.stats
+
+def _insert_bucket(aggregation, depth, group, key, leaf):
+    """
+    Insert a bucket for group with the given key at depth into an aggregation that was
+    computed without grouping on group
+    @param leaf: whether group is the last group, i.e. whether the bucket has a count
+    """
+    if depth == 0:
+        return [namedtuple("Aggr", [group, "count" if leaf else "buckets"])(key, aggregation)]
+    if not aggregation:
+        return []
+    ntuple = namedtuple("Aggr", [aggregation[0]._fields[0], "buckets"])
+    return [ntuple(k, _insert_bucket(buckets, depth - 1, group, key, leaf)) for (k, buckets) in aggregation]
+
+
+def _merge_page(merged, page, depth):
+    """
+    Add a page of the aggregation of buckets of the group at depth to merged, a tree of
+    {key: (namedtuple type, children)} dicts for the outer groups with lists of rows as leaves
+    """
+    if depth == 0:
+        merged.extend(page)
+        return
+    for row in page:
+        ntuple, children = merged.setdefault(row[0], (type(row), [] if depth == 1 else OrderedDict()))
+        _merge_page(children, row[1], depth - 1)
+
+
+def _merged_rows(merged, group_by):
+    """Return the aggregation rows of the pages merged by _merge_page"""
+    if isinstance(merged, list):
+        return merged
+    rows = [ntuple(key, _merged_rows(children, group_by[1:])) for (key, (ntuple, children)) in merged.items()]
+    if group_by[0] == "date":
+        # A page only contains the dates with articles in its buckets
+        rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def _get_filter_sets(filters):
+    """Return the sorted set ids filtered on in filters, or None if it does not filter on sets"""
+    filters = filters or {}
+    sets = filters.get("sets", filters.get("set"))
+    if sets is None:
+        return None
+    if isinstance(sets, (int, long, basestring)) or hasattr(sets, "pk"):
+        sets = [sets]
+    return sorted(int(getattr(s, "pk", s)) for s in sets)
+
+
+def _len(seq):
+    """Return the length of seq, or None if it is a generator or other iterator"""
+    return len(seq) if hasattr(seq, "__len__") else None
+
+
+def get_article_dicts(article_ids):
+    """
+    Yield the article dicts (including set membership) of the given articles,
+    using a single query for the articles and one for their sets.
+    """
+    from amcat.models import Article, ArticleSetArticle
+    all_sets = multidict(ArticleSetArticle.objects.filter(article__in=article_ids)
+                         .values_list("article_id", "articleset_id"))
+    for article in Article.objects.filter(pk__in=article_ids).select_related("medium"):
+        yield get_article_dict(article, list(all_sets.get(article.id, [])))
+
 
 def get_date(timestamp):
     d = datetime.datetime.fromtimestamp(timestamp / 1000)
@@ -823,11 +1580,10 @@ def build_body(query=None, filters={}, query_as_filter=False):
     """
     filters = list(get_filter_clauses(**filters))
     if query:
-        terms = queryparser.parse_to_terms(query)
         if query_as_filter:
-            filters.append(terms.get_filter_dsl())
+            filters.append(queryparser.get_dsl(query, filter=True))
         else:
-            yield ('query', terms.get_dsl())
+            yield ('query', queryparser.get_dsl(query))
 
     if filters:
         yield ('filter', combine_filters(filters))
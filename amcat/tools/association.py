@@ -129,22 +129,17 @@ class Association(object):
         if weighted:
             self.score_func = get_asymptotic_weight
 
-    def _get_query_arguments(self, query):
-        return {
-            "score": self.weighted,
-            "fields": self.fields,
-            "filters": self.filters,
-            "query": query.query
-        }
-
-    def _get_query(self, query):
-        return self.elastic_api.query_all(**self._get_query_arguments(query))
+    def _get_results(self):
+        """Return all hits per query, using a single (msearch) request for all queries"""
+        return self.elastic_api.multi_query_all(
+            self.queries, score=self.weighted, fields=self.fields, filters=self.filters
+        )
 
     def _get_scores(self):
         # Ideally, we would like to use elastic aggregations for the
         # intervals, but we need scores simultainiously so we can't.
-        for query in self.queries:
-            for a in self._get_query(query):
+        for query, result in zip(self.queries, self._get_results()):
+            for a in result:
                 interval = self.interval_func(getattr(a, "date", None))
                 yield ArticleScore(a.id, query, interval, self.score_func(a))
 
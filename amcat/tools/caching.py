@@ -30,7 +30,12 @@ Use reset and set_cache to manually clear and set the cache
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import hashlib
+import json
 import logging
+import threading
+import time
+from collections import OrderedDict, Counter
 
 log = logging.getLogger(__name__)
 from functools import wraps, partial
@@ -126,8 +131,6 @@ def set_cache(obj, name, value, cache_attr=""):
 ###########################################################################
 
 # Setup thread-local cache for codebooks
-import threading
-
 _object_cache = threading.local()
 
 
@@ -183,3 +186,154 @@ def clear_cache(model):
 def _get_cache_key(model, id):
     return ('%s:%s' % (model._meta.db_table, id)).replace(' ', '')
 
+
+
+###########################################################################
+#                       R E S U L T   C A C H I N G                       #
+###########################################################################
+
+class LRUCache(object):
+    """
+    Thread-safe local cache that holds at most max_entries values, discarding the least
+    recently used ones. Implements the subset of the django cache API used by ResultCache.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._values = OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._values.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._values[key] = (expires, value)
+            return value
+
+    def get_many(self, keys):
+        _missing = object()
+        values = ((key, self.get(key, _missing)) for key in keys)
+        return {key: value for (key, value) in values if value is not _missing}
+
+    def set(self, key, value, timeout=None):
+        expires = None if timeout is None else time.time() + timeout
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (expires, value)
+            while len(self._values) > self.max_entries:
+                self._values.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._values:
+                return False
+        self.set(key, value, timeout)
+        return True
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            try:
+                expires, value = self._values[key]
+            except KeyError:
+                raise ValueError("Key '{key}' not found".format(**locals()))
+            self._values[key] = (expires, value + delta)
+            return value + delta
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class ResultCache(object):
+    """
+    Cache for the results of expensive calls (e.g. elastic aggregations), keyed on a canonical
+    hash of the (json serializable) call arguments. Results are stored in the given django cache
+    backend, or in a local LRUCache if backend is None.
+
+    Each result depends on a number of tags (e.g. the articlesets it was computed on).
+    Invalidating a tag increases its generation number, which is part of the key, so all
+    results that depend on that tag are no longer found and will expire. Results that are
+    computed within settle_time seconds after one of their tags was invalidated are not cached,
+    since the write that caused the invalidation might not be visible yet (e.g. before an
+    elastic refresh).
+
+    Hits and misses are counted per call name, see stats.
+    """
+
+    def __init__(self, prefix, timeout=300, backend=None, max_entries=1000, settle_time=0):
+        """
+        @param timeout: seconds to keep a result; 0 disables the cache
+        @param backend: django cache backend (e.g. django.core.cache.caches['default'])
+        @param settle_time: seconds after invalidating a tag during which its results are not cached
+        """
+        self.prefix = prefix
+        self.timeout = timeout
+        self.settle_time = settle_time
+        self.backend = LRUCache(max_entries) if backend is None else backend
+        self._hits = Counter()
+        self._misses = Counter()
+        self._lock = threading.Lock()
+
+    def _get_tag_key(self, tag):
+        return "{self.prefix}:tag:{tag}".format(**locals())
+
+    def _get_settle_key(self, tag_key):
+        return "{tag_key}:settling".format(**locals())
+
+    def _get_key(self, name, key, tags):
+        """Return the cache key, and whether any of the tags was invalidated within settle_time"""
+        tag_keys = [self._get_tag_key(tag) for tag in sorted(tags)]
+        settle_keys = [self._get_settle_key(k) for k in tag_keys] if self.settle_time else []
+        values = self.backend.get_many(tag_keys + settle_keys)
+        key = [name, key, [(k, values.get(k, 0)) for k in tag_keys]]
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        settling = any(k in values for k in settle_keys)
+        return "{self.prefix}:{name}:{digest}".format(**locals()), settling
+
+    def get(self, name, key, tags, func):
+        """
+        Return the cached result of func() for the given name, key and tags, calling
+        func (and caching its result) if it is not in the cache.
+        """
+        if not self.timeout:
+            return func()
+
+        cache_key, settling = self._get_key(name, key, tags)
+        result = self.backend.get(cache_key)
+
+        with self._lock:
+            (self._misses if result is None else self._hits)[name] += 1
+
+        if result is None:
+            result = func()
+            if not settling:
+                self.backend.set(cache_key, result, self.timeout)
+        return result
+
+    def invalidate(self, tags):
+        """Invalidate all results that depend on any of the given tags"""
+        for tag in tags:
+            tag_key = self._get_tag_key(tag)
+            if self.settle_time:
+                self.backend.set(self._get_settle_key(tag_key), True, self.settle_time)
+            try:
+                self.backend.incr(tag_key)
+            except ValueError:
+                if not self.backend.add(tag_key, 1, None):
+                    self.backend.incr(tag_key)
+
+    @property
+    def stats(self):
+        """Return a {name: {'hits': n, 'misses': n}} dict of the calls since the last reset"""
+        with self._lock:
+            names = set(self._hits) | set(self._misses)
+            return {name: {"hits": self._hits[name], "misses": self._misses[name]} for name in names}
+
+    def reset_stats(self):
+        with self._lock:
+            self._hits.clear()
+            self._misses.clear()
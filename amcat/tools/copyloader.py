@@ -0,0 +1,255 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+High volume article loader. Articles are streamed into a temporary staging table with
+PostgreSQL COPY, and added to the articles and articlesets_articles tables from there with
+set-based SQL. The new articles are sent to the elastic bulk indexer as soon as their batch
+is committed.
+
+Like Article.create_articles, duplicates (by hash) are not saved, but are added to the set.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+import datetime
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction, DatabaseError
+
+from amcat.models import Article
+from amcat.models.article import check_article
+from amcat.models.articleset import ArticleSetArticle
+from amcat.models.coding.codedarticle import CodedArticle
+from amcat.tools import amcates
+from amcat.tools.amcates import serialize_article_dict
+from amcat.tools.duplicates import DuplicateFinder
+from amcat.tools.normalize import get_length, normalize_article
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
+
+COPY_BATCH_SIZE = 10000
+STAGING_TABLE = "articles_staging"
+
+
+def _copy_value(value):
+    """Format a database value for the COPY text format"""
+    if value is None:
+        return r"\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return (unicode(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+class RowFile(object):
+    """
+    Read-only file object over a sequence of rows, formatted as COPY text lines. This lets
+    cursor.copy_expert stream the rows without building the whole input in memory.
+    """
+
+    def __init__(self, rows):
+        self.lines = ("\t".join(map(_copy_value, row)) + "\n" for row in rows)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines).encode("utf-8")
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def readline(self, size=-1):
+        if b"\n" not in self.buffer:
+            self.buffer += next(self.lines, "").encode("utf-8")
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        result, self.buffer = self.buffer[:end], self.buffer[end:]
+        return result
+
+
+class CopyLoader(object):
+    """
+    Load (many) new articles into an articleset, see the module documentation. On databases
+    other than PostgreSQL, and for batches that cannot be copied (e.g. because of a constraint
+    violation), Article.create_articles is used instead.
+    """
+
+    def __init__(self, batch_size=COPY_BATCH_SIZE, check_duplicate=True, monitor=None):
+        """
+        @param batch_size: number of articles per COPY and transaction
+        @param check_duplicate: if True, duplicates (in the index or within the load) are not saved
+        @param monitor: optional ProgressMonitor, updated once per batch
+        """
+        self.batch_size = batch_size
+        self.check_duplicate = check_duplicate
+        self.monitor = monitor
+        self.es = amcates.ES()
+        self.finder = DuplicateFinder(self.es)
+        self.fields = [f for f in Article._meta.concrete_fields if not f.primary_key]
+        # hash -> article id of the articles saved during a load, which may not be searchable yet
+        self.hashes = {}
+        self.codingjobs = []
+
+    def load(self, articles, articleset):
+        """
+        Save, index and add the articles to the articleset (if not None). All articles (including duplicates
+        and existing articles) get their .id set and are added to the set.
+        @param articles: a sequence (which can be a generator) of unsaved Article objects
+        @return: a (saved_articles, errors) tuple like Article.create_articles
+        """
+        result, errors = [], []
+        if connection.vendor != "postgresql" or articleset is None:
+            return Article.create_articles(list(articles), articleset, check_duplicate=self.check_duplicate)
+
+        self.codingjobs = list(articleset.codingjob_set.all())
+        self.hashes = {}
+        try:
+            with self.es.bulk_indexer() as indexer:
+                for i, batch in enumerate(splitlist(articles, self.batch_size)):
+                    result += self._load_batch(batch, articleset, indexer, errors)
+                    if self.monitor is not None:
+                        self.monitor.update(1, "Loaded batch {i}: {n} articles saved".format(n=len(result), **locals()))
+        finally:
+            self.es.invalidate_cache([articleset.id])
+        return result, errors
+
+    def _prepare(self, article, articleset):
+        """Fill in the values Django would set on save and return the database row of the article"""
+        if article.length is None:
+            article.length = get_length(article)
+        if article.parent:
+            if article.parent.id is None:
+                raise ValidationError("The parent of an article should be saved before loading it")
+            article.parent_id = article.parent.id
+        row = [field.get_db_prep_save(field.pre_save(article, True), connection) for field in self.fields]
+        check_article(article)
+        normalize_article(article, sets=[articleset.id])
+        return row
+
+    def _get_duplicates(self, articles):
+        """Return a {hash: (id, sets)} dict of the articles in the index, or saved by this load (sets=None)"""
+        hashes = [a.es_dict['hash'] for a in articles]
+        dupes = {h: (self.hashes[h], None) for h in hashes if h in self.hashes}
+        dupes.update(self.finder.find(h for h in hashes if h not in dupes))
+        return dupes
+
+    def _load_batch(self, articles, articleset, indexer, errors):
+        new, rows, existing = [], [], set()
+        for a in articles:
+            if a.id:
+                existing.add(a.id)
+                continue
+            try:
+                rows.append(self._prepare(a, articleset))
+            except ValidationError as e:
+                log.warning(str(e))
+                errors.append(e)
+                continue
+            new.append(a)
+
+        dupes = self._get_duplicates(new) if self.check_duplicate else {}
+        todo, todo_rows, batch_hashes = [], [], {}
+        for a, row in zip(new, rows):
+            h = a.es_dict['hash']
+            a.duplicate = h in dupes or h in batch_hashes
+            if h in dupes:
+                a.id, sets = dupes[h]
+                if sets is not None and articleset.id not in sets:
+                    existing.add(a.id)
+            elif h in batch_hashes:
+                batch_hashes[h].append(a)
+            else:
+                if self.check_duplicate:
+                    batch_hashes[h] = []
+                todo.append(a)
+                todo_rows.append(row)
+
+        try:
+            ids = self._copy(todo_rows, articleset)
+        except DatabaseError as e:
+            log.warning("Could not copy batch of {} articles, creating them one by one: {}".format(len(todo), e))
+            saved, batch_errors = Article.create_articles(todo, articleset, check_duplicate=False)
+            errors += batch_errors
+        else:
+            saved = todo
+            for a, article_id in zip(todo, ids):
+                a.id = article_id
+                a._state.adding = False
+                a._state.db = connection.alias
+                a.es_dict["id"] = article_id
+                indexer.index(article_id, serialize_article_dict(a.es_dict))
+
+        self.finder.add(saved)
+        for a in saved:
+            for dupe in batch_hashes.get(a.es_dict['hash'], ()):
+                dupe.id = a.id
+            if self.check_duplicate:
+                self.hashes[a.es_dict['hash']] = a.id
+
+        if existing:
+            articleset.add_articles(existing, add_to_index=False)
+            self.es.add_to_set(articleset.id, existing)
+
+        log.info("Loaded {} articles: {} saved, {} duplicates or existing articles added to set"
+                 .format(len(articles), len(saved), len(existing)))
+        return saved
+
+    def _copy(self, rows, articleset):
+        """
+        Copy the rows into the staging table, and add them to the articles and articleset tables
+        @return: the ids of the new articles, in the order of rows
+        """
+        if not rows:
+            return []
+
+        qn = connection.ops.quote_name
+        pk = qn(Article._meta.pk.column)
+        columns = ", ".join(qn(f.column) for f in self.fields)
+        asa = ArticleSetArticle._meta
+        asa_articleset, asa_article = (asa.get_field(f).column for f in ("articleset", "article"))
+        staging, articles = qn(STAGING_TABLE), qn(Article._meta.db_table)
+
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute("DROP TABLE IF EXISTS {staging}".format(**locals()))
+            cursor.execute("CREATE TEMPORARY TABLE {staging} (LIKE {articles} INCLUDING DEFAULTS, ord integer) "
+                           "ON COMMIT DROP".format(**locals()))
+            rows = (row + [i] for (i, row) in enumerate(rows))
+            cursor.copy_expert("COPY {staging} ({columns}, ord) FROM STDIN".format(**locals()), RowFile(rows))
+
+            cursor.execute("SELECT {pk} FROM {staging} ORDER BY ord".format(**locals()))
+            ids = [article_id for (article_id,) in cursor.fetchall()]
+
+            cursor.execute("INSERT INTO {articles} ({pk}, {columns}) SELECT {pk}, {columns} FROM {staging}"
+                           .format(**locals()))
+            cursor.execute("INSERT INTO {table} ({asa_articleset}, {asa_article}) SELECT %s, {pk} FROM {staging}"
+                           .format(table=qn(asa.db_table), **locals()), [articleset.id])
+            if self.codingjobs:
+                CodedArticle.objects.bulk_create(CodedArticle(codingjob=c, article_id=aid)
+                                                 for c in self.codingjobs for aid in ids)
+            cursor.execute("DROP TABLE {staging}".format(**locals()))
+        return ids
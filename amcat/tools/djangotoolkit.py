@@ -82,9 +82,12 @@ def db_supports_distinct_on(db='default'):
     return connections[db].features.can_distinct_on_fields
 
 
-def bulk_insert_returning_ids(new_objects):
+def bulk_insert_returning_ids(new_objects, include_pk=False):
     """bulk_insert() does not set ids as per Django ticket #19527. However, postgres does
-    support this, so we implement this manually in this function."""
+    support this, so we implement this manually in this function.
+
+    @param include_pk: insert the primary keys of the objects instead of letting the database
+                       assign them (all objects should have a primary key)"""
     new_objects = list(new_objects)
 
     if not new_objects:
@@ -92,8 +95,9 @@ def bulk_insert_returning_ids(new_objects):
 
     if connection.vendor == "postgresql":
         model = new_objects[0].__class__
+        fields = model._meta.fields if include_pk else model._meta.fields[1:]
         query = sql.InsertQuery(model)
-        query.insert_values(model._meta.fields[1:], new_objects)
+        query.insert_values(fields, new_objects)
         raw_sql, params = query.sql_with_params()[0]
         returning = "RETURNING {pk.db_column} AS {pk.name}".format(pk=model._meta.pk)
         new_objects = list(model.objects.raw("%s %s" % (raw_sql, returning), params))
@@ -0,0 +1,141 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Duplicate detection for article imports. New articles are recognized as duplicates if an
+article with the same hash (see amcates.get_article_dict) is in the index.
+
+DuplicateFinder looks up hashes in bounded batches, sending a number of batches concurrently.
+If settings.ES_HASH_INDEX is set, the hashes of articles are also stored in the articles_hashes
+table (see ArticleHash) when they are imported or added to the index with ES.add_articles. Only
+hashes that are in that table are looked up in the index: importing new articles then costs one
+indexed query on that table per 500 articles, and no elastic requests at all. Use the
+fill_hash_index command to store the hashes of existing articles.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+from amcat.models import ArticleHash
+from amcat.tools import amcates
+from amcat.tools.toolkit import splitlist
+
+log = logging.getLogger(__name__)
+
+Duplicate = namedtuple("Duplicate", ["id", "sets"])
+
+class HashIndex(object):
+    """
+    The articles_hashes table. Hashes are looked up in the table (by its primary key) on every
+    import, so hashes stored by other processes are always seen.
+    """
+
+    def filter(self, hashes):
+        """Return the hashes that are in the table"""
+        found = set()
+        for batch in splitlist(hashes, itemsperbatch=500):
+            found.update(ArticleHash.objects.filter(hash__in=batch).values_list("hash", flat=True))
+        return [h for h in hashes if h in found]
+
+    def add(self, hashes):
+        """
+        Store the given hash -> article id pairs. Hashes that are already stored are ignored.
+        @type hashes: {hash: article_id} dict
+        """
+        qn = connection.ops.quote_name
+        table, hash_col = qn(ArticleHash._meta.db_table), qn(ArticleHash._meta.pk.column)
+        article_col = qn(ArticleHash._meta.get_field("article").column)
+
+        for batch in splitlist(list(hashes.items()), itemsperbatch=500):
+            try:
+                with transaction.atomic():
+                    if connection.vendor == "postgresql":
+                        values = ", ".join(["(%s, %s)"] * len(batch))
+                        sql = ("INSERT INTO {table} ({hash_col}, {article_col}) SELECT v.hash, v.article_id "
+                               "FROM (VALUES {values}) AS v(hash, article_id) WHERE NOT EXISTS "
+                               "(SELECT 1 FROM {table} t WHERE t.{hash_col} = v.hash)").format(**locals())
+                        connection.cursor().execute(sql, [x for pair in batch for x in pair])
+                    else:
+                        existing = set(ArticleHash.objects.filter(hash__in=[h for (h, _aid) in batch])
+                                       .values_list("hash", flat=True))
+                        ArticleHash.objects.bulk_create(ArticleHash(hash=h, article_id=aid)
+                                                        for (h, aid) in batch if h not in existing)
+            except IntegrityError:
+                # Another process stored (some of) these hashes concurrently
+                log.warning("Could not store {} hashes".format(len(batch)), exc_info=True)
+
+
+class DuplicateFinder(object):
+    """
+    Find articles in the index by hash, see the module documentation
+    """
+
+    def __init__(self, es=None, batch_size=None, concurrency=None, use_index=None):
+        """
+        @param batch_size: number of hashes per elastic request
+        @param concurrency: number of concurrent elastic requests
+        @param use_index: if True, use (and store hashes in) the articles_hashes table
+        Defaults are taken from settings.ES_DUPLICATE_BATCH_SIZE, ES_DUPLICATE_CONCURRENCY and ES_HASH_INDEX.
+        """
+        self.es = amcates.ES() if es is None else es
+        self.batch_size = settings.ES_DUPLICATE_BATCH_SIZE if batch_size is None else batch_size
+        self.concurrency = settings.ES_DUPLICATE_CONCURRENCY if concurrency is None else concurrency
+        use_index = settings.ES_HASH_INDEX if use_index is None else use_index
+        self.index = HashIndex() if use_index else None
+
+    def _lookup(self, hashes):
+        """Return the Duplicates of a batch of hashes"""
+        result = self.es.query(filters={'hashes': hashes}, fields=["hash", "sets"], score=False,
+                               size=len(hashes))
+        if result.total > len(result):
+            # The index contains articles with the same hash, get all of them
+            result = self.es.query_iter(filters={'hashes': hashes}, fields=["hash", "sets"], score=False)
+        return [(r.hash, Duplicate(r.id, r.sets or [])) for r in result]
+
+    def find(self, hashes):
+        """
+        Find the articles with the given hashes
+        @return: a {hash: Duplicate(id, sets)} dict for the hashes that are in the index
+        """
+        hashes = sorted(set(hashes))
+        if self.index is not None:
+            hashes = self.index.filter(hashes)
+        batches = list(splitlist(hashes, itemsperbatch=self.batch_size))
+        log.debug("Looking up {} hashes in {} batches".format(len(hashes), len(batches)))
+
+        if self.concurrency > 1 and len(batches) > 1:
+            pool = ThreadPool(min(self.concurrency, len(batches)))
+            try:
+                results = pool.map(self._lookup, batches)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = map(self._lookup, batches)
+        return {hash: dupe for result in results for (hash, dupe) in result}
+
+    def add(self, articles):
+        """Store the hashes of the given saved articles, if the hash index is used"""
+        if self.index is not None:
+            self.index.add({a.es_dict['hash']: a.id for a in articles})
@@ -0,0 +1,140 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Fuzzy deduplication of articles: articles are duplicates if the Levenshtein ratio of their
+headlines and/or texts is at least a given minimum.
+
+Comparing all pairs of articles is quadratic in the number of articles, and a Levenshtein
+ratio is quadratic in the length of the texts. FuzzyDeduplicator only computes the ratio if
+the lengths of the texts allow it to be high enough (which never skips a duplicate), and can
+use MinHash signatures of the texts to only compare articles that share a band of their
+signature (locality sensitive hashing). With LSH, duplicates with a low similarity can be
+missed, but the number of comparisons is roughly linear in the number of articles.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+from collections import defaultdict
+from operator import attrgetter, itemgetter
+import logging
+import random
+
+import Levenshtein
+
+log = logging.getLogger(__name__)
+
+# Length of the character shingles that are hashed for the MinHash signatures
+SHINGLE_SIZE = 3
+
+# The signatures consist of LSH_BANDS bands of LSH_BAND_SIZE hashes. Articles are compared if
+# any band of their signatures is equal. The probability of this is 1 - (1 - j^size)^bands for
+# texts with jaccard similarity j (of their shingles), i.e. 99.8% for j=0.5, 73% for j=0.3 and
+# 5% for j=0.1 with the defaults.
+LSH_BANDS = 48
+LSH_BAND_SIZE = 3
+
+
+def get_shingles(text, size=SHINGLE_SIZE):
+    """Return the set of substrings of the given size of the text"""
+    return {text[i:i + size] for i in range(max(1, len(text) - size + 1))}
+
+
+class MinHasher(object):
+    """
+    Computes MinHash signatures of texts. Shingles are hashed once, and the permutations are
+    taken by xor-ing the hashes with random masks.
+    """
+
+    def __init__(self, num_hashes, seed=1):
+        rnd = random.Random(seed)
+        self.masks = [rnd.getrandbits(64) for _ in range(num_hashes)]
+
+    def get_signature(self, text):
+        hashes = [hash(shingle) for shingle in get_shingles(text)]
+        return [min(map(mask.__xor__, hashes)) for mask in self.masks]
+
+
+class FuzzyDeduplicator(object):
+    """
+    Finds fuzzy duplicates among articles (or other objects with an id and the compared fields)
+    """
+
+    def __init__(self, ratios, use_lsh=False, bands=LSH_BANDS, band_size=LSH_BAND_SIZE):
+        """
+        @param ratios: {field: minimal ratio} dict, e.g. {"headline": 0.9, "text": 0.8}
+        @param use_lsh: only compare articles with similar MinHash signatures (see the module documentation)
+        """
+        self.ratios = sorted((field, ratio) for (field, ratio) in ratios.items() if ratio)
+        self.use_lsh = use_lsh
+        self.bands, self.band_size = bands, band_size
+
+    def is_duplicate(self, a, b):
+        """Are the Levenshtein ratios of all fields of the articles at least the minimal ratio?"""
+        for field, ratio in self.ratios:
+            x, y = getattr(a, field), getattr(b, field)
+            # The ratio is 2 * (length of longest common subsequence) / (sum of lengths)
+            lensum = len(x) + len(y)
+            if lensum and 2. * min(len(x), len(y)) / lensum < ratio:
+                return False
+            if Levenshtein.ratio(x, y) < ratio:
+                return False
+        return True
+
+    def get_buckets(self, articles):
+        """
+        Put the articles in a bucket for each band of the signature of the field with the highest
+        minimal ratio. Articles in the same bucket are candidate duplicates.
+        @return: a list with for every article the buckets (lists of article indices) it is in
+        """
+        field = max(self.ratios, key=itemgetter(1))[0]
+        minhasher = MinHasher(self.bands * self.band_size)
+
+        buckets = defaultdict(list)
+        article_buckets = []
+        for i, article in enumerate(articles):
+            signature = minhasher.get_signature(getattr(article, field))
+            keys = [(band,) + tuple(signature[band * self.band_size:(band + 1) * self.band_size])
+                    for band in range(self.bands)]
+            article_buckets.append([buckets[key] for key in keys])
+            for key in keys:
+                buckets[key].append(i)
+        return article_buckets
+
+    def deduplicate(self, articles):
+        """
+        Deduplicate the articles: the article with the lowest id is kept, and the remaining
+        articles that are duplicates of it are removed. This is repeated for the remaining articles.
+        @return: a sequence of (article, [duplicates]) pairs for the articles that have duplicates
+        """
+        articles = sorted(articles, key=attrgetter("id"))
+        article_buckets = self.get_buckets(articles) if self.use_lsh else None
+        log.debug("Deduplicating {} articles".format(len(articles)))
+
+        removed = set()
+        for i, a in enumerate(articles):
+            if i in removed:
+                continue
+            if article_buckets is None:
+                candidates = (j for j in xrange(i + 1, len(articles)) if j not in removed)
+            else:
+                candidates = sorted({j for bucket in article_buckets[i] for j in bucket
+                                     if j > i and j not in removed})
+            dupes = [j for j in candidates if self.is_duplicate(a, articles[j])]
+            if dupes:
+                removed.update(dupes)
+                yield a, [articles[j] for j in dupes]
@@ -36,7 +36,7 @@ from amcat.tools.aggregate import get_articlesets
 from amcat.tools.amcates import ES
 from amcat.tools.caching import cached
 from amcat.models import Label, Article, Medium
-from amcat.tools.toolkit import stripAccents
+from amcat.tools.toolkit import stripAccents, splitlist
 
 
 REFERENCE_RE = re.compile(r"<(?P<reference>.*?)(?P<recursive>\+?)>")
@@ -136,7 +136,12 @@ class SelectionSearch:
     def get_mediums(self):
         return Medium.objects.filter(id__in=self.get_medium_ids())
 
-    def get_aggregate(self, x_axis, y_axis, interval="month"):
+    def iter_aggregate(self, x_axis, y_axis, interval="month", top=None, page_size=100):
+        """
+        Yield the rows of the aggregation of x_axis by y_axis, replacing ids by mediums and
+        articlesets per page of page_size rows.
+        @param top: see ES.iter_aggregate
+        """
         x_axis = FIELD_MAP.get(x_axis, x_axis)
         y_axis = FIELD_MAP.get(y_axis, y_axis)
 
@@ -147,26 +152,33 @@ class SelectionSearch:
 
         query = None if "term" in (x_axis, y_axis) else self.get_query()
 
-        aggr = ES().aggregate_query(
+        aggr = self.es.iter_aggregate(
             query=query, terms=self.get_queries(),
             filters=self.get_filters(), group_by=group_by,
-            date_interval=interval, sets=map(attrgetter("id"), self.data.articlesets)
+            date_interval=interval, sets=map(attrgetter("id"), self.data.articlesets),
+            top=top
         )
 
-        aggr = get_mediums(aggr, list(group_by))
-        aggr = get_articlesets(aggr, list(group_by))
+        for rows in splitlist(aggr, page_size):
+            rows = get_mediums(rows, list(group_by))
+            rows = get_articlesets(rows, list(group_by))
+            for row in rows:
+                yield row
 
-        return aggr
+    def get_aggregate(self, x_axis, y_axis, interval="month", top=None):
+        return list(self.iter_aggregate(x_axis, y_axis, interval, top=top))
 
     def get_medium_ids(self):
         return self.es.list_media(self.get_query(), self.get_filters())
 
     def get_article_ids(self):
-        return ES().query_ids(self.get_query(), self.get_filters())
+        return self.es.query_ids(self.get_query(), self.get_filters())
 
     def _get_article_ids_per_query(self):
-        for q in self.get_queries():
-            yield q, list(ES().query_ids(q.query, self.get_filters()))
+        queries = self.get_queries()
+        results = self.es.multi_query_all(queries, filters=self.get_filters(), score=False, fields=[])
+        for q, result in zip(queries, results):
+            yield q, [r.id for r in result]
 
     def get_article_ids_per_query(self):
         return dict(self._get_article_ids_per_query())
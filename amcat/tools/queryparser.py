@@ -25,17 +25,26 @@ Also paves the way for more customization, i.e. allowing Lexis style queries
 """
 
 from __future__ import unicode_literals, print_function, absolute_import
+import copy
 import itertools
 import collections
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from pyparsing import ParserElement
 
+from amcat.tools.caching import ResultCache
 from amcat.tools.toolkit import stripAccents
 
 
 ParserElement.enablePackrat()
 
+# Parsed term trees and DSL per query string. Entries never become stale, so the timeout
+# only bounds the lifetime of unused entries in addition to the LRU size limit.
+QUERY_CACHE_SIZE = getattr(settings, "ES_QUERY_CACHE_SIZE", 1000)
+QUERY_CACHE = ResultCache("queryparser", timeout=86400 if QUERY_CACHE_SIZE else 0,
+                          max_entries=QUERY_CACHE_SIZE)
+
 
 def c(s):
     """Clean ('analyze') the provided string"""
@@ -354,7 +363,7 @@ class QueryParseError(ValidationError):
     pass
 
 
-def parse_to_terms(s, simplify_terms=True, strip_accents=True):
+def _parse_to_terms(s, simplify_terms, strip_accents):
     if strip_accents:
         s = stripAccents(s)
     try:
@@ -367,8 +376,33 @@ def parse_to_terms(s, simplify_terms=True, strip_accents=True):
     return terms
 
 
-def parse(s):
-    terms = parse_to_terms(s)
-    dsl = terms.get_dsl()
-    return dsl
+def parse_to_terms(s, simplify_terms=True, strip_accents=True):
+    """
+    Parse a lucene-style query string to a tree of terms. The trees are cached in
+    QUERY_CACHE, each caller gets its own copy (e.g. Span modifies its terms).
+    @raises: QueryParseError if the query cannot be parsed
+    """
+    terms = QUERY_CACHE.get("terms", [s, simplify_terms, strip_accents], [],
+                            lambda: _parse_to_terms(s, simplify_terms, strip_accents))
+    return copy.deepcopy(terms)
+
 
+def get_dsl(s, filter=False):
+    """
+    Return the elastic DSL for a lucene-style query string, using QUERY_CACHE
+    @param filter: if True, return the (non-scoring) filter DSL rather than the query DSL
+    """
+    def _get_dsl():
+        terms = parse_to_terms(s)
+        return terms.get_filter_dsl() if filter else terms.get_dsl()
+    dsl = QUERY_CACHE.get("filter_dsl" if filter else "dsl", s, [], _get_dsl)
+    return copy.deepcopy(dsl)
+
+
+def cache_stats():
+    """Return the {name: {'hits': n, 'misses': n}} statistics of QUERY_CACHE"""
+    return QUERY_CACHE.stats
+
+
+def parse(s):
+    return get_dsl(s)
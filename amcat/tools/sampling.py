@@ -0,0 +1,168 @@
+###########################################################################
+#          (C) Vrije Universiteit, Amsterdam (the Netherlands)            #
+#                                                                         #
+# This file is part of AmCAT - The Amsterdam Content Analysis Toolkit     #
+#                                                                         #
+# AmCAT is free software: you can redistribute it and/or modify it under  #
+# the terms of the GNU Affero General Public License as published by the  #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# AmCAT is distributed in the hope that it will be useful, but WITHOUT    #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public     #
+# License for more details.                                               #
+#                                                                         #
+# You should have received a copy of the GNU Affero General Public        #
+# License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+"""
+Random sampling of (the ids of) articles in a set.
+
+Samples are drawn from a stream of ids in a single pass, keeping only the sample in memory: every
+id gets a random key, and the ids with the lowest keys are kept (a reservoir sample). If a seed is
+given, the key of an id is computed from the seed and the id, so the sample does not depend on the
+order of the stream and is reproducible. Stratified samples draw a proportional number of ids from
+each stratum (e.g. medium or month), using an elastic aggregation to count the articles per stratum.
+
+For large percentages of (very) large sets, TABLESAMPLE can be used instead (PostgreSQL 9.5+).
+This is much faster, but the size of the sample is only approximately the requested percentage.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+from collections import defaultdict
+import datetime
+import heapq
+import logging
+import random
+
+from django.db import connection
+
+from amcat.models import ArticleSetArticle
+from amcat.tools import amcates
+
+log = logging.getLogger(__name__)
+
+STRATA = ("medium", "year", "month", "week")
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix(x):
+    """Scramble the bits of the 64 bit integer x (the splitmix64 finalizer)"""
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def get_key_function(seed=None):
+    """
+    Return a function that gives a random key to an id. If a seed is given, the key is
+    determined by the seed and the id.
+    """
+    if seed is None:
+        rnd = random.Random()
+        return lambda id: rnd.random()
+    seed = _mix(seed & _MASK64)
+    return lambda id: _mix((seed + id) & _MASK64)
+
+
+def sample(ids, k, seed=None):
+    """
+    Draw a random sample of k ids from the sequence of ids, keeping at most k ids in memory
+    @return: a list of the sampled ids
+    """
+    return heapq.nsmallest(k, ids, key=get_key_function(seed))
+
+
+def allocate(counts, k):
+    """
+    Divide a sample of size k over strata, proportional to their size, with the
+    remaining ids going to the strata with the largest remainders
+    @param counts: {stratum: number of articles} dict
+    @return: {stratum: sample size} dict
+    """
+    n = sum(counts.values())
+    if not n:
+        return {stratum: 0 for stratum in counts}
+    k = min(k, n)
+    quotas = {stratum: float(k) * count / n for (stratum, count) in counts.items()}
+    allocation = {stratum: int(quota) for (stratum, quota) in quotas.items()}
+    remainders = sorted(counts, key=lambda stratum: (allocation[stratum] - quotas[stratum], stratum))
+    for stratum in remainders[:k - sum(allocation.values())]:
+        allocation[stratum] += 1
+    return allocation
+
+
+def sample_strata(items, allocation, seed=None):
+    """
+    Draw a random sample from each stratum
+    @param items: a sequence of (stratum, id) pairs
+    @param allocation: {stratum: sample size} dict, see allocate
+    @return: a list of the sampled ids
+    """
+    key = get_key_function(seed)
+    heaps = defaultdict(list)  # stratum: heap of (-key, id) for the ids with the lowest keys
+    for stratum, id in items:
+        size = allocation.get(stratum, 0)
+        if not size:
+            continue
+        heap, item = heaps[stratum], (-key(id), id)
+        if len(heap) < size:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return [id for heap in heaps.values() for (_, id) in heap]
+
+
+def _get_date_stratum(date, interval):
+    """Return the start of the elastic date histogram bucket of the given interval containing the date"""
+    if interval == "year":
+        return datetime.datetime(date.year, 1, 1)
+    if interval == "month":
+        return datetime.datetime(date.year, date.month, 1)
+    day = datetime.datetime(date.year, date.month, date.day)
+    return day - datetime.timedelta(days=day.weekday())
+
+
+def sample_articleset(articleset, k, seed=None, stratify=None):
+    """
+    Draw a random sample of k articles from the given set
+    @param stratify: one of STRATA to draw proportional samples from each medium or date interval
+    @return: a list of article ids
+    """
+    if not stratify:
+        return sample(articleset.iter_article_ids(), k, seed)
+
+    es, filters = amcates.ES(), {"sets": articleset.id}
+    if stratify == "medium":
+        counts = dict(es.aggregate_query(filters=filters, group_by=["mediumid"]))
+        items = ((a.mediumid, a.id) for a in es.query_iter(filters=filters, fields=["mediumid"]))
+    else:
+        counts = dict(es.aggregate_query(filters=filters, group_by=["date"], date_interval=stratify))
+        items = ((_get_date_stratum(a.date, stratify), a.id) for a in es.query_iter(filters=filters, fields=["date"]))
+    allocation = allocate(counts, k)
+    log.info("Sampling {k} articles from {n} strata".format(n=len(allocation), **locals()))
+    return sample_strata(items, allocation, seed)
+
+
+def tablesample_articleset(articleset, fraction, seed=None):
+    """
+    Draw a random sample of approximately the given fraction of the articles in the set using
+    TABLESAMPLE BERNOULLI. This reads the articles of all sets, but avoids sorting them.
+    @return: a list of article ids
+    """
+    table = connection.ops.quote_name(ArticleSetArticle._meta.db_table)
+    article_col, set_col = [connection.ops.quote_name(ArticleSetArticle._meta.get_field(f).column)
+                            for f in ("article", "articleset")]
+    repeatable = "" if seed is None else "REPEATABLE (%s)"
+    sql = ("SELECT {article_col} FROM {table} TABLESAMPLE BERNOULLI (%s) {repeatable} "
+           "WHERE {set_col} = %s".format(**locals()))
+    params = [fraction * 100] + ([] if seed is None else [seed]) + [articleset.id]
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        return [aid for (aid,) in cursor.fetchall()]
+    finally:
+        cursor.close()
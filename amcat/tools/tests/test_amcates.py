@@ -19,12 +19,20 @@
 from __future__ import unicode_literals
 
 import datetime
+import hashlib
+import json
+import math
+import random
 from unittest import skip
-from amcat.models import Article
-from amcat.tools import amcattest
-from amcat.tools.amcates import ES, get_article_dict, HASH_FIELDS, _get_hash
+from amcat.models import Article, ArticleSet
+from amcat.tools import amcattest, amcates
+from amcat.tools.caching import ResultCache
+from amcat.tools.amcates import ES, get_article_dict, HASH_FIELDS, _get_hash, ArticleDict, serialize_article_dict
+from amcat.tools.amcates import BulkIndexer, ElasticSearchError, get_client, parse_highlight, OTHER_BUCKET
+from amcat.tools.progress import ProgressMonitor
 from amcat.tools.amcattest import create_test_medium, create_test_project, create_test_set
 from amcat.tools.keywordsearch import SearchQuery
+from django.conf import settings
 
 
 class TestAmcatES(amcattest.AmCATTestCase):
@@ -67,6 +75,23 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(set(ES().list_media(filters=dict(sets=s1.id))),
                          {m1.id, m2.id})
 
+    @amcattest.use_elastic
+    def test_result_cache(self):
+        """Are cached counts invalidated by changes to the set?"""
+        m1, m2, m3, s1, s2, a, b, c, d, e = self.setup()
+        es = ES()
+        old_cache, amcates.RESULT_CACHE = amcates.RESULT_CACHE, ResultCache("test", settle_time=1)
+        try:
+            self.assertEqual(es.count(filters=dict(sets=s1.id)), 4)
+            self.assertEqual(es.count(filters=dict(sets=s1.id)), 4)
+            self.assertEqual(es.cache_stats()["count"], {"hits": 1, "misses": 1})
+
+            es.remove_from_set(s1.id, [a.id])
+            es.flush()
+            self.assertEqual(es.count(filters=dict(sets=s1.id)), 3)
+        finally:
+            amcates.RESULT_CACHE = old_cache
+
     @amcattest.use_elastic
     def test_terms_aggregate(self):
         m1, m2, m3, s1, s2, a, b, c, d, e = self.setup()
@@ -82,6 +107,47 @@ class TestAmcatES(amcattest.AmCATTestCase):
         aggr = query(group_by=["terms"], terms=[q1, q2])
         self.assertEqual(set(aggr), {(q1, 3), (q2, 1)})
 
+    @amcattest.use_elastic
+    def test_multi_query(self):
+        m1, m2, m3, s1, s2, a, b, c, d, e = self.setup()
+        queries = [SearchQuery.from_string(q) for q in ["noot", "bla", "jet OR aap"]]
+        filters = {"sets": s1.id}
+
+        self.assertEqual(ES().multi_count(queries, filters), [3, 1, 2])
+        self.assertEqual(ES().multi_count([], filters), [])
+
+        results = ES().multi_query(queries, filters=filters, fields=["headline"], size=2)
+        self.assertEqual([r.total for r in results], [3, 1, 2])
+        self.assertEqual([len(r) for r in results], [2, 1, 2])
+        self.assertEqual({r.id for r in results[1]}, {c.id})
+
+        results = ES().multi_query_all(queries, filters=filters, score=False)
+        self.assertEqual([{r.id for r in result} for result in results],
+                         [{a.id, b.id, d.id}, {c.id}, {a.id, c.id}])
+
+        # Queries with more than max_size hits are scrolled
+        results = ES().multi_query_all(queries, filters=filters, score=False, max_size=1)
+        self.assertEqual([{r.id for r in result} for result in results],
+                         [{a.id, b.id, d.id}, {c.id}, {a.id, c.id}])
+
+    @amcattest.use_elastic
+    def test_iter_aggregate(self):
+        """Are pages of buckets streamed or merged, and can we ask for the top buckets?"""
+        m1, m2, m3, s1, s2, a, b, c, d, e = self.setup()
+        query = lambda **kw: list(ES().iter_aggregate(filters={"sets": s1.id}, page_size=1, **kw))
+        y2001, y2002 = datetime.datetime(2001, 1, 1), datetime.datetime(2002, 1, 1)
+
+        self.assertEqual(query(group_by=["mediumid"]), [(m2.id, 3), (m1.id, 1)])
+        self.assertEqual(query(group_by=["date", "mediumid"], date_interval="year"),
+                         [(y2001, [(m2.id, 2), (m1.id, 1)]), (y2002, [(m2.id, 1)])])
+
+        self.assertEqual(query(group_by=["mediumid"], top=1), [(m2.id, 3), (OTHER_BUCKET, 1)])
+        self.assertEqual(query(group_by=["mediumid", "date"], top=1, date_interval="year"),
+                         [(m2.id, [(y2001, 2), (y2002, 1)]), (OTHER_BUCKET, [(y2001, 1)])])
+        self.assertEqual(query(group_by=["date", "mediumid"], top=1, date_interval="year"),
+                         [(y2001, [(m2.id, 2), (OTHER_BUCKET, 1)]), (y2002, [(m2.id, 1)])])
+        self.assertRaises(ValueError, query, group_by=["date"], top=1)
+
     @amcattest.use_elastic
     def test_sets_aggregate(self):
         m1, m2, m3, s1, s2, a, b, c, d, e = self.setup()
@@ -130,6 +196,23 @@ class TestAmcatES(amcattest.AmCATTestCase):
 
         r = ES().query_all(filters=dict(sets=s.id), size=10)
         self.assertEqual(len(list(r)), len(arts))
+        self.assertEqual(r.total, len(arts))
+
+    @amcattest.use_elastic
+    def test_query_iter(self):
+        """Test that query_iter scrolls lazily over all results"""
+        from amcat.models import Article
+        arts = [amcattest.create_test_article(create=False) for _ in range(25)]
+        s = amcattest.create_test_set()
+        Article.create_articles(arts, articleset=s, check_duplicate=False, create_id=True)
+        ES().flush()
+
+        r = ES().query_iter(filters=dict(sets=s.id), fields=["headline"], size=10)
+        self.assertEqual(r.total, len(arts))
+        self.assertEqual({a.id for a in r}, {a.id for a in arts})
+
+        # A scroll cannot be rewound
+        self.assertRaises(ValueError, list, r)
 
 
     @amcattest.use_elastic
@@ -239,6 +322,44 @@ class TestAmcatES(amcattest.AmCATTestCase):
         arts[1].save()
 
 
+    @amcattest.use_elastic
+    def test_refresh_index_checkpoint(self):
+        """Does an interrupted synchronisation resume after the checkpoint?"""
+        from amcat.models import ArticleSetArticle
+        s = amcattest.create_test_set()
+        arts = sorted((amcattest.create_test_article() for _ in range(10)), key=lambda a: a.id)
+        for a in arts:
+            ArticleSetArticle.objects.create(articleset=s, article=a)
+
+        s.index_sync_checkpoint = arts[4].id
+        s.refresh_index()
+        self.assertEqual(set(ES().query_ids(filters=dict(sets=s.id))), {a.id for a in arts[5:]})
+        self.assertIsNone(s.index_sync_checkpoint)
+        self.assertIsNotNone(s.index_synced_until)
+
+        # A new synchronisation (in small batches) should add the other articles
+        ES().synchronize_articleset(s, batch_size=3)
+        self.assertEqual(set(ES().query_ids(filters=dict(sets=s.id))), {a.id for a in arts})
+        self.assertIsNone(ArticleSet.objects.get(pk=s.pk).index_sync_checkpoint)
+
+    @amcattest.use_elastic
+    def test_refresh_index_incremental(self):
+        """Does an incremental refresh only consider articles inserted after the last sync?"""
+        from amcat.models import ArticleSetArticle
+        old = amcattest.create_test_article()
+        s = amcattest.create_test_set()
+        s.refresh_index()
+
+        new = amcattest.create_test_article()
+        ArticleSetArticle.objects.create(articleset=s, article=old)
+        ArticleSetArticle.objects.create(articleset=s, article=new)
+
+        s.refresh_index(incremental=True)
+        self.assertEqual(set(ES().query_ids(filters=dict(sets=s.id))), {new.id})
+
+        s.refresh_index()
+        self.assertEqual(set(ES().query_ids(filters=dict(sets=s.id))), {old.id, new.id})
+
     @amcattest.use_elastic
     def test_full_refresh(self):
         """test full refresh, e.g. document content change"""
@@ -358,6 +479,37 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual({paul.id, adam.id}, q("* NOT eve"))
         self.assertEqual({eve.id}, q("NOT (NOT eve)"))
 
+    def test_parse_highlight(self):
+        self.assertEqual(parse_highlight("a <em>b</em> c <em>dd</em>"), ("a b c dd", [(2, 1), (6, 2)]))
+        self.assertEqual(parse_highlight("<p>x</p>"), ("<p>x</p>", []))
+        self.assertRaises(ValueError, parse_highlight, "<em>a<em>b</em>")
+        self.assertRaises(ValueError, parse_highlight, "a</em>")
+
+    @amcattest.use_elastic
+    def test_highlight_articles(self):
+        aset = amcattest.create_test_set()
+        a1 = amcattest.create_test_article(text="een test, nog een test", headline="kop", articleset=aset)
+        a2 = amcattest.create_test_article(text="geen hits", headline="test", articleset=aset)
+        a3 = amcattest.create_test_article(text="niets", headline="kop", articleset=aset)
+        ES().flush()
+
+        hl = ES().highlight_articles([a1.id, a2.id, a3.id], "test")
+        self.assertEqual(set(hl), {a1.id, a2.id})
+        self.assertEqual(set(hl[a1.id]), {"text"})
+        self.assertEqual(hl[a1.id]["text"], ("een test, nog een test", [(4, 4), (18, 4)]))
+        self.assertEqual(hl[a2.id]["headline"], ("test", [(0, 4)]))
+
+        self.assertEqual(list(ES().find_occurrences("test", a1)), [(4, "test"), (18, "test")])
+        self.assertEqual(list(ES().find_occurrences("test", a3)), [])
+        self.assertEqual(ES().highlight_articles([], "test"), {})
+
+    def test_get_client(self):
+        """ES objects should share their client, unless they need other options"""
+        self.assertIs(ES().es, ES().es)
+        self.assertIs(ES(index="other").es, get_client())
+        self.assertIsNot(ES(timeout=1).es, ES().es)
+        self.assertIs(ES(timeout=1).es, ES(timeout=1).es)
+
     @amcattest.use_elastic
     def test_elastic_hash(self):
         """Can we reproduce a hash from elastic data alone?"""
@@ -391,3 +543,130 @@ class TestAmcatES(amcattest.AmCATTestCase):
         self.assertEqual(article.id, es_article.id)
         self.assertEqual(hash, es_article.hash)
         self.assertEqual(_get_hash(es_article.to_dict()), hash)
+
+    def test_incremental_hash(self):
+        """Is the incremental hash identical to the hash of the json encoded fields?"""
+        chars = "ab \"\\/\n\t\x00\x1f\x7f\xe9\u20ac\U0001F600<>&'"
+        random.seed(1)
+
+        def value():
+            r = random.random()
+            if r < .2:
+                return None
+            if r < .4:
+                return random.randint(-2**40, 2**40)
+            text = "".join(random.choice(chars) for _ in range(random.randint(0, 40)))
+            return text.encode("utf-8") if r < .5 else text
+
+        for _ in range(2000):
+            article_dict = ArticleDict((fn, value()) for fn in HASH_FIELDS + ["id", "sets", "uuid"])
+            expected = hashlib.sha224(json.dumps([(fn, article_dict[fn]) for fn in HASH_FIELDS])).hexdigest()
+            self.assertEqual(_get_hash(article_dict), expected)
+            self.assertEqual(_get_hash(dict(article_dict)), expected)
+            self.assertEqual(serialize_article_dict(article_dict), json.dumps(article_dict))
+
+        # Changed values are encoded again
+        article_dict["text"] = "changed"
+        self.assertEqual(json.loads(serialize_article_dict(article_dict))["text"], "changed")
+
+
+class FakeBulkClient(object):
+    """Stand-in for an elasticsearch client that records bulk requests. Ids in `reject`
+    are rejected (429) the first time they are seen, ids in `fail` always fail."""
+    def __init__(self, reject=(), fail=()):
+        self.requests = []
+        self.sources = {}
+        self.reject = set(reject)
+        self.fail = set(fail)
+
+    def bulk(self, body, index, doc_type):
+        lines = body.strip().split("\n")
+        headers = [json.loads(line) for line in lines[::2]]
+        self.requests.append([h.values()[0]["_id"] for h in headers])
+        self.sources.update(zip(self.requests[-1], map(json.loads, lines[1::2])))
+
+        items = []
+        for header in headers:
+            (action, meta), = header.items()
+            status = 200
+            if meta["_id"] in self.reject:
+                self.reject.remove(meta["_id"])
+                status = 429
+            elif meta["_id"] in self.fail:
+                status = 400
+            items.append({action: dict(meta, status=status)})
+        return {"errors": any(i.values()[0]["status"] != 200 for i in items), "items": items}
+
+
+class TestBulkIndexer(amcattest.AmCATTestCase):
+    def index(self, client, ids, **kargs):
+        kargs.setdefault("concurrency", 0)
+        with BulkIndexer(client, "index", "doctype", retry_wait=0, **kargs) as indexer:
+            for i in ids:
+                indexer.index(i, json.dumps({"id": i, "text": "x" * 10}))
+        return indexer
+
+    def test_chunks(self):
+        client = FakeBulkClient()
+        self.index(client, range(10), chunk_size=4)
+        self.assertEqual(client.requests, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+        # Each action is 50-ish bytes, so at most two fit into 128 bytes
+        client = FakeBulkClient()
+        self.index(client, range(5), chunk_bytes=128)
+        self.assertEqual(client.requests, [[0, 1], [2, 3], [4]])
+
+    def test_retry(self):
+        client = FakeBulkClient(reject=[2, 3])
+        indexer = self.index(client, range(5))
+        self.assertEqual(client.requests, [[0, 1, 2, 3, 4], [2, 3]])
+        self.assertEqual(indexer.n_retried, 2)
+
+        # Give up after max_retries, and report rejected items as failed
+        client = FakeBulkClient(reject=[2])
+        self.assertRaises(ElasticSearchError, self.index, client, range(5), max_retries=0)
+
+    def test_failed(self):
+        client = FakeBulkClient(fail=[1])
+        try:
+            self.index(client, range(3))
+        except ElasticSearchError as e:
+            failed, = e.args
+            self.assertEqual([f["_id"] for f in failed], [1])
+        else:
+            self.fail("ElasticSearchError not raised")
+        self.assertEqual(client.requests, [[0, 1, 2]])
+
+    def test_concurrent(self):
+        client = FakeBulkClient(reject=[17])
+        self.index(client, range(100), chunk_size=10, concurrency=3)
+        sent = [i for request in client.requests for i in request]
+        self.assertEqual(len(client.requests), 11)
+        self.assertEqual(sorted(sent), sorted(range(100) + [17]))
+
+
+class TestSetUpdates(amcattest.AmCATTestCase):
+    def get_es(self):
+        es = ES()
+        es.es = FakeBulkClient()
+        return es
+
+    def test_requests_per_article(self):
+        """Set updates should send every article once, in as few requests as possible"""
+        n = 5 * settings.ES_BULK_SIZE + 1
+        max_requests = int(math.ceil(float(n) / settings.ES_BULK_SIZE))
+
+        for update in ["add_to_set", "remove_from_set"]:
+            es = self.get_es()
+            getattr(es, update)(123, (aid for aid in xrange(n)), concurrency=0)
+
+            updates_per_article = float(sum(map(len, es.es.requests))) / n
+            requests_per_article = float(len(es.es.requests)) / n
+            self.assertEqual(updates_per_article, 1.0)
+            self.assertLessEqual(requests_per_article, float(max_requests) / n)
+            self.assertEqual(es.es.sources[n - 1]["params"], {"set": 123})
+
+    def test_progress(self):
+        monitor = ProgressMonitor()
+        self.get_es().add_to_set(1, range(2500), monitor=monitor, concurrency=0)
+        self.assertAlmostEqual(monitor.worked, 40)
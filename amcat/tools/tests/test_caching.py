@@ -1,6 +1,6 @@
 from amcat.tools import amcattest
 from amcat.tools.caching import cached, invalidates, cached_named, invalidates_named, reset, \
-    set_cache, get_object, clear_cache, get_objects
+    set_cache, get_object, clear_cache, get_objects, ResultCache, LRUCache
 
 
 class TestCaching(amcattest.AmCATTestCase):
@@ -149,4 +149,58 @@ class TestCaching(amcattest.AmCATTestCase):
             ps = list(get_objects(Project, pids))
 
         with self.checkMaxQueries(0, "Get multiple cached projects one by one"):
-            ps = [get_objects(Project, pid) for pid in pids]
\ No newline at end of file
+            ps = [get_objects(Project, pid) for pid in pids]
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)  # b is least recently used
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+
+        # Expired values are not returned
+        cache.set("d", 4, timeout=-1)
+        self.assertIsNone(cache.get("d"))
+
+        self.assertRaises(ValueError, cache.incr, "x")
+        self.assertTrue(cache.add("x", 1))
+        self.assertFalse(cache.add("x", 5))
+        self.assertEqual(cache.incr("x"), 2)
+
+    def test_result_cache(self):
+        cache = ResultCache("test")
+        calls = []
+        def get(name, key, tags):
+            return cache.get(name, key, tags, lambda: calls.append(key) or len(calls))
+
+        self.assertEqual(get("count", {"a": [1, 2]}, ["set:1"]), 1)
+        self.assertEqual(get("count", {"a": [1, 2]}, ["set:1"]), 1)
+        self.assertEqual(get("count", {"a": [2, 1]}, ["set:1"]), 2)
+        self.assertEqual(get("other", {"a": [1, 2]}, ["set:1"]), 3)
+        self.assertEqual(cache.stats, {"count": {"hits": 1, "misses": 2},
+                                       "other": {"hits": 0, "misses": 1}})
+
+        # Invalidating an unrelated tag should not affect the result
+        cache.invalidate(["set:2"])
+        self.assertEqual(get("count", {"a": [1, 2]}, ["set:1"]), 1)
+        cache.invalidate(["set:1"])
+        self.assertEqual(get("count", {"a": [1, 2]}, ["set:1"]), 4)
+
+        cache.reset_stats()
+        self.assertEqual(cache.stats, {})
+
+        # Results are not cached within settle_time after an invalidation
+        cache = ResultCache("test", settle_time=60)
+        self.assertEqual(get("count", {}, ["set:1"]), 5)
+        self.assertEqual(get("count", {}, ["set:1"]), 5)
+        cache.invalidate(["set:1"])
+        self.assertEqual(get("count", {}, ["set:1"]), 6)
+        self.assertEqual(get("count", {}, ["set:1"]), 7)
+        self.assertEqual(get("count", {}, ["set:2"]), 8)
+        self.assertEqual(get("count", {}, ["set:2"]), 8)
+
+        # A timeout of 0 disables caching
+        cache = ResultCache("test", timeout=0)
+        self.assertEqual(get("count", {}, []), 9)
+        self.assertEqual(get("count", {}, []), 10)
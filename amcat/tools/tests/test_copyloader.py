@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+import datetime
+
+from amcat.models import Article
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+from amcat.tools.copyloader import CopyLoader, RowFile
+
+
+class TestCopyLoader(amcattest.AmCATTestCase):
+    def test_row_file(self):
+        rows = [[1, "a\tb", None], [True, datetime.date(2001, 1, 2), "x\\y\nz é"]]
+        expected = b"1\ta\\tb\t\\N\nt\t2001-01-02\tx\\\\y\\nz \xc3\xa9\n"
+        self.assertEqual(RowFile(rows).read(), expected)
+
+        f = RowFile(rows)
+        self.assertEqual(b"".join(iter(lambda: f.read(5), b"")), expected)
+        f = RowFile(rows)
+        self.assertEqual(f.readline(), expected.split(b"\n")[0] + b"\n")
+
+    @amcattest.use_elastic
+    def test_load(self):
+        aset = amcattest.create_test_set()
+        medium = amcattest.create_test_medium()
+        existing = amcattest.create_test_article(text="existing", medium=medium, articleset=amcattest.create_test_set())
+        ES().flush()
+
+        def article(text, **kargs):
+            return Article(project=aset.project, medium=medium, date=existing.date, headline=existing.headline,
+                           text=text, **kargs)
+
+        articles = [article("een"), article("twee"), article("een"), article("existing", byline=existing.byline),
+                    article("geen kop", headline=None)]
+        result, errors = CopyLoader(batch_size=2).load(articles, aset)
+
+        self.assertEqual(result, articles[:2])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(articles[2].id, articles[0].id)
+        self.assertTrue(articles[2].duplicate)
+        self.assertEqual(articles[3].id, existing.id)
+        self.assertEqual(Article.objects.get(pk=articles[1].id).text, "twee")
+
+        ES().flush()
+        self.assertEqual(set(aset.get_article_ids()), {articles[0].id, articles[1].id, existing.id})
+        self.assertEqual(set(ES().query_ids(filters={"sets": aset.id})), {articles[0].id, articles[1].id, existing.id})
@@ -0,0 +1,80 @@
+from __future__ import unicode_literals
+from hashlib import sha224
+
+from amcat.models import Article, ArticleHash
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+from amcat.tools.duplicates import DuplicateFinder, HashIndex
+
+
+def _hashes(prefix, n):
+    return [sha224("{}{}".format(prefix, i).encode("ascii")).hexdigest() for i in range(n)]
+
+
+class TestDuplicates(amcattest.AmCATTestCase):
+    def test_hash_index(self):
+        a = amcattest.create_test_article()
+        index = HashIndex()
+        self.assertEqual(index.filter(["ab" * 28]), [])
+
+        index.add({"ab" * 28: a.id})
+        index.add({"ab" * 28: a.id, "cd" * 28: a.id})
+        self.assertEqual(ArticleHash.objects.filter(article=a).count(), 2)
+        self.assertEqual(index.filter(["ef" * 28, "ab" * 28]), ["ab" * 28])
+
+        # rows stored or deleted by another process are seen
+        ArticleHash.objects.create(hash="ef" * 28, article=a)
+        ArticleHash.objects.filter(hash="cd" * 28).delete()
+        self.assertEqual(index.filter(["cd" * 28, "ef" * 28]), ["ef" * 28])
+
+    @amcattest.use_elastic
+    def test_find(self):
+        articles = [amcattest.create_test_article(text="text {}".format(i)) for i in range(5)]
+        ES().flush()
+        hashes = {a.id: ES().get(a.id)["hash"] for a in articles}
+        new = _hashes("new", 10)
+
+        finder = DuplicateFinder(batch_size=2, concurrency=3, use_index=False)
+        dupes = finder.find(list(hashes.values()) + new)
+        self.assertEqual({h: d.id for (h, d) in dupes.items()}, {h: aid for (aid, h) in hashes.items()})
+        self.assertTrue(all(d.sets for d in dupes.values()))
+
+        # With the hash index, only hashes in the table are looked up in elastic
+        finder = DuplicateFinder(batch_size=2, concurrency=3, use_index=True)
+        self.assertEqual(finder.find(list(hashes.values()) + new), {})
+
+        for a in articles:
+            a.es_dict = {"hash": hashes[a.id]}
+        finder.add(articles[:2])
+        dupes = finder.find(list(hashes.values()) + new)
+        self.assertEqual({h: d.id for (h, d) in dupes.items()}, {hashes[a.id]: a.id for a in articles[:2]})
+
+        lookups = []
+        finder._lookup = lambda hashes: lookups.append(hashes) or []
+        finder.find(new + [hashes[articles[0].id]])
+        self.assertEqual(lookups, [[hashes[articles[0].id]]])
+
+    @amcattest.use_elastic
+    def test_create_articles(self):
+        """Are the hashes of new articles stored if the hash index is used?"""
+        with self.settings(ES_HASH_INDEX=True):
+            a = amcattest.create_test_article(create=False)
+            Article.create_articles([a], create_id=True)
+            self.assertEqual(list(ArticleHash.objects.filter(article=a).values_list("hash", flat=True)),
+                             [a.es_dict["hash"]])
+
+            b = amcattest.create_test_article(create=False, **{f: getattr(a, f) for f in
+                                                                ("headline", "text", "date", "medium", "project")})
+            Article.create_articles([b], create_id=True)
+            self.assertTrue(b.duplicate)
+            self.assertEqual(b.id, a.id)
+
+    @amcattest.use_elastic
+    def test_add_articles(self):
+        """Are the hashes of articles added to the index stored if the hash index is used?"""
+        a = amcattest.create_test_article()
+        with self.settings(ES_HASH_INDEX=True):
+            ES().add_articles([a.id])
+        ES().flush()
+        self.assertEqual(list(ArticleHash.objects.filter(article=a).values_list("hash", flat=True)),
+                         [ES().get(a.id)["hash"]])
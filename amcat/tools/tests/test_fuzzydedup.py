@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+from collections import namedtuple
+import random
+
+import Levenshtein
+
+from amcat.tools import amcattest
+from amcat.tools.fuzzydedup import FuzzyDeduplicator, get_shingles
+
+Doc = namedtuple("Doc", ["id", "headline", "text"])
+
+
+def _pairwise_fuzzy_dedup(arts, ratios):
+    """Deduplicate by comparing every remaining pair of articles"""
+    def is_fuzzy_dupe(a, b):
+        for field, ratio in ratios.items():
+            if Levenshtein.ratio(getattr(a, field), getattr(b, field)) < ratio:
+                return False
+        return True
+    arts = sorted(arts, key=lambda a: a.id)
+    while len(arts) > 1:
+        a = arts.pop(0)
+        dupes = [b for b in arts if is_fuzzy_dupe(a, b)]
+        if dupes:
+            arts = [b for b in arts if b not in dupes]
+            yield a, dupes
+
+
+def _mutate(text, n, chars="abcde "):
+    """Randomly insert, delete or replace n characters"""
+    text = list(text)
+    for _ in range(n):
+        i = random.randint(0, len(text))
+        op = random.choice(["insert", "delete", "replace"])
+        if op == "insert" or not text:
+            text.insert(i, random.choice(chars))
+        elif op == "delete":
+            del text[min(i, len(text) - 1)]
+        else:
+            text[min(i, len(text) - 1)] = random.choice(chars)
+    return "".join(text)
+
+
+def _wire_stories(nstories, ncopies, nwords=200):
+    """Create ncopies slightly edited copies of nstories synthetic stories"""
+    words = [_mutate("", random.randint(2, 8), chars="abcdefghijklmnoprstuvwz") for _ in range(1000)]
+    stories = [" ".join(random.choice(words) for _ in range(nwords)) for _ in range(nstories)]
+    return [Doc(i, "headline", _mutate(stories[i % nstories], random.randint(0, 20)))
+            for i in range(nstories * ncopies)]
+
+
+def _ids(result):
+    return [(a.id, [b.id for b in dupes]) for (a, dupes) in result]
+
+
+class TestFuzzyDedup(amcattest.AmCATTestCase):
+    def test_shingles(self):
+        self.assertEqual(get_shingles("abcab", size=2), {"ab", "bc", "ca"})
+        self.assertEqual(get_shingles("a", size=2), {"a"})
+
+    def test_keepers(self):
+        """Is the article with the lowest id kept, and are the duplicates of removed articles ignored?"""
+        docs = [Doc(3, "x", "aaaaaaaaab"), Doc(1, "x", "aaaaaaaaaa"), Doc(7, "x", "bbbbbbbbbb"),
+                Doc(5, "x", "aaaaaaaabb"), Doc(9, "x", "bbbbbbbbbc"), Doc(8, "x", "cccccccccc")]
+        dedup = FuzzyDeduplicator({"text": .85})
+        self.assertEqual(_ids(dedup.deduplicate(docs)), [(1, [3]), (7, [9])])
+        self.assertEqual(_ids(_pairwise_fuzzy_dedup(docs, {"text": .85})), [(1, [3]), (7, [9])])
+
+    def test_deduplicate(self):
+        """Are the results the same as those of comparing every pair of articles?"""
+        random.seed(1)
+        for _ in range(200):
+            base = [_mutate("", random.randint(0, 15)) for _ in range(3)]
+            docs = [Doc(random.randint(0, 10 ** 6), _mutate(random.choice(base), random.randint(0, 3)),
+                        _mutate(random.choice(base), random.randint(0, 5))) for _ in range(random.randint(0, 12))]
+            ratios = random.choice([{"headline": .8}, {"text": .7}, {"headline": .5, "text": .9}])
+            self.assertEqual(_ids(FuzzyDeduplicator(ratios).deduplicate(docs)),
+                             _ids(_pairwise_fuzzy_dedup(docs, ratios)))
+
+    def test_lsh(self):
+        random.seed(1)
+        docs = _wire_stories(20, 10)
+        expected = _ids(_pairwise_fuzzy_dedup(docs, {"text": .8}))
+        self.assertEqual(len(expected), 20)
+        self.assertEqual(_ids(FuzzyDeduplicator({"text": .8}, use_lsh=True).deduplicate(docs)), expected)
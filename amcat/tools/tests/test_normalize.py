@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+import datetime
+import random
+import re
+
+from django.conf import settings
+
+from amcat.tools import amcattest, amcates
+from amcat.tools.djangotoolkit import get_model_field
+from amcat.tools.normalize import word_len, normalize_articles, WORD_RE
+
+# Characters that are treated specially by word_len or amcates._clean
+SPECIAL = "{}LN \t\n\r\x0b\x0c\x1c\x1f\x85\xa0 　\x00\x08ab\xe9"
+
+
+def _legacy_word_len(txt):
+    if not txt: return 0
+    return len(re.sub(WORD_RE, ' ', txt).split())
+
+
+def _legacy_get_article_dict(article, sets=None):
+    """The es dict as computed before the normalization stage, see amcates.get_article_dict"""
+    article_dict = {}
+    for field_name in amcates.ARTICLE_FIELDS:
+        value = get_model_field(article, field_name)
+        if field_name in amcates.ARTICLE_CLEAN_FIELDS and value is not None:
+            value = amcates._clean_re.sub(' ', value)
+        article_dict[amcates.ARTICLE_FIELD_MAP.get(field_name, field_name)] = value
+    date = article_dict["date"]
+    article_dict["date"] = datetime.datetime(date.year, date.month, date.day).isoformat()
+    article_dict["uuid"] = str(article_dict["uuid"])
+    article_dict["sets"] = sets
+    get_hash = amcates._get_legacy_hash if settings.ES_USE_LEGACY_HASH_FUNCTION else amcates._get_hash
+    article_dict["hash"] = get_hash(article_dict)
+    return article_dict
+
+
+def _random_text(n, chars=SPECIAL):
+    return "".join(random.choice(chars) for _ in range(n))
+
+
+class TestNormalize(amcattest.AmCATTestCase):
+    def test_word_len(self):
+        random.seed(1)
+        for _ in range(5000):
+            txt = _random_text(random.randint(0, 20))
+            self.assertEqual(word_len(txt), _legacy_word_len(txt), repr(txt))
+        self.assertEqual(word_len(b"Kim {did} not say"), 4)
+        self.assertEqual(word_len(None), 0)
+
+    def test_normalize_articles(self):
+        random.seed(1)
+        medium = amcattest.create_test_medium()
+        articles = [amcattest.create_test_article(create=False, medium=medium, headline=_random_text(10),
+                                                  byline=_random_text(10) or None, text=_random_text(100))
+                    for _ in range(50)]
+        articles[0].length = 123
+        es_dicts = normalize_articles(articles, sets=[1])
+
+        self.assertEqual(articles[0].length, 123)
+        for a, es_dict in zip(articles, es_dicts):
+            self.assertIs(a.es_dict, es_dict)
+            self.assertEqual(a.length, 123 if a is articles[0] else sum(
+                _legacy_word_len(getattr(a, f)) for f in ("text", "headline", "byline")))
+            self.assertEqual(es_dict, _legacy_get_article_dict(a, sets=[1]))
@@ -1,5 +1,6 @@
 from amcat.tools import amcattest
-from amcat.tools.queryparser import parse_to_terms, QueryParseError, parse
+from amcat.tools import queryparser
+from amcat.tools.queryparser import parse_to_terms, QueryParseError, parse, get_dsl
 
 
 class TestQueryParser(amcattest.AmCATTestCase):
@@ -71,4 +72,31 @@ class TestQueryParser(amcattest.AmCATTestCase):
             ], u'slop': u'10'}}
         ]}}
 
-        self.assertEqual(q('a W/10 (b c)'), expected)
\ No newline at end of file
+        self.assertEqual(q('a W/10 (b c)'), expected)
+
+    def test_cache(self):
+        queryparser.QUERY_CACHE.reset_stats()
+        query = 'cached AND (query OR "some quote")'
+        self.assertEqual(unicode(parse_to_terms(query)), unicode(parse_to_terms(query)))
+        self.assertEqual(queryparser.cache_stats()["terms"], {"hits": 1, "misses": 1})
+
+        # DSL is cached, but each caller gets its own copy
+        dsl = get_dsl(query)
+        dsl["bool"]["must"].append("modified")
+        self.assertEqual(get_dsl(query), parse_to_terms(query).get_dsl())
+        self.assertEqual(queryparser.cache_stats()["dsl"], {"hits": 1, "misses": 1})
+        self.assertEqual(get_dsl(query, filter=True), parse_to_terms(query).get_filter_dsl())
+
+        # Parse errors are not cached
+        self.assertRaises(QueryParseError, get_dsl, 'a W/10 (b AND c)')
+        self.assertRaises(QueryParseError, get_dsl, 'a W/10 (b AND c)')
+
+    def test_cache_span(self):
+        """Span queries should not modify the cached terms of their quote"""
+        queryparser.QUERY_CACHE.backend.clear()
+        get_dsl('"headline:aap noot"~5')
+        dsl = get_dsl('mies OR "headline:aap noot"~5')
+        self.assertIn({u'span_term': {u'headline': u'aap'}}, dsl["bool"]["should"][1]["span_near"]["clauses"])
+
+        queryparser.QUERY_CACHE.backend.clear()
+        self.assertEqual(get_dsl('mies OR "headline:aap noot"~5'), dsl)
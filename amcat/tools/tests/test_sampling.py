@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+from collections import Counter
+import random
+
+from amcat.scripts.actions.sample_articleset import SampleSet
+from amcat.tools import amcattest
+from amcat.tools.amcates import ES
+from amcat.tools.sampling import sample, allocate, sample_strata, sample_articleset
+
+
+class TestSampling(amcattest.AmCATTestCase):
+    def test_sample(self):
+        ids = range(1000)
+        self.assertEqual(len(set(sample(iter(ids), 100))), 100)
+        self.assertEqual(sorted(sample(iter(ids), 2000)), ids)
+
+        # Seeded samples do not depend on the order of the ids
+        shuffled = list(ids)
+        random.shuffle(shuffled)
+        self.assertEqual(sorted(sample(ids, 100, seed=12)), sorted(sample(shuffled, 100, seed=12)))
+        self.assertNotEqual(sorted(sample(ids, 100, seed=12)), sorted(sample(ids, 100, seed=13)))
+
+        # Every id should be sampled about equally often
+        counts = Counter(id for seed in range(1000) for id in sample(range(10), 3, seed=seed))
+        self.assertEqual(set(counts), set(range(10)))
+        self.assertTrue(all(200 < n < 400 for n in counts.values()), counts)
+
+    def test_allocate(self):
+        self.assertEqual(allocate({"a": 50, "b": 30, "c": 20}, 10), {"a": 5, "b": 3, "c": 2})
+        self.assertEqual(allocate({"a": 2, "b": 1, "c": 1}, 3), {"a": 1, "b": 1, "c": 1})
+        self.assertEqual(allocate({"a": 5, "b": 3, "c": 2}, 5), {"a": 3, "b": 1, "c": 1})
+        self.assertEqual(allocate({"a": 2, "b": 1}, 10), {"a": 2, "b": 1})
+        self.assertEqual(allocate({}, 10), {})
+
+    def test_sample_strata(self):
+        items = [("a", id) for id in range(100)] + [("b", id) for id in range(100, 110)]
+        ids = sample_strata(items, {"a": 10, "b": 2}, seed=1)
+        self.assertEqual(len([id for id in ids if id < 100]), 10)
+        self.assertEqual(len([id for id in ids if id >= 100]), 2)
+        self.assertEqual(sorted(ids), sorted(sample_strata(reversed(items), {"a": 10, "b": 2}, seed=1)))
+
+    @amcattest.use_elastic
+    def test_sample_articleset(self):
+        s = amcattest.create_test_set()
+        m1, m2 = [amcattest.create_test_medium() for _x in range(2)]
+        articles = [amcattest.create_test_article(articleset=s, medium=m1, date="2001-01-01") for _x in range(6)]
+        articles += [amcattest.create_test_article(articleset=s, medium=m2, date="2001-02-01") for _x in range(3)]
+        ES().flush()
+        ids = {a.id for a in articles}
+
+        self.assertTrue(set(sample_articleset(s, 4)) < ids)
+        self.assertEqual(set(sample_articleset(s, 20)), ids)
+        self.assertEqual(sample_articleset(s, 4, seed=1), sample_articleset(s, 4, seed=1))
+
+        for stratify in ("medium", "month"):
+            media = Counter(aid in {a.id for a in articles[:6]} for aid in sample_articleset(s, 3, stratify=stratify))
+            self.assertEqual(media, {True: 2, False: 1})
+
+        target = SampleSet(articleset=s.id, sample="50%", target_articleset_name="sample", seed=1).run()
+        ES().flush()
+        self.assertEqual(target.articles.count(), 5)
+        self.assertEqual(ES().count(filters={"sets": target.id}), 5)
@@ -17,7 +17,7 @@
 # License along with AmCAT.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 from amcat.tools import amcattest
-from amcat.tools.toolkit import splitlist
+from amcat.tools.toolkit import splitlist, sorted_diff
 
 
 class TestToolkit(amcattest.AmCATTestCase):
@@ -36,3 +36,13 @@ class TestToolkit(amcattest.AmCATTestCase):
 
         # Does it work for all iterables?
         self.assertEqual(list(splitlist(iter(seq), 3)), [[1, 2, 3], [4]])
+
+    def test_sorted_diff(self):
+        diff = lambda a, b: list(sorted_diff(a, b))
+        self.assertEqual(diff([], []), [])
+        self.assertEqual(diff([1, 2], []), [(1, True, False), (2, True, False)])
+        self.assertEqual(diff([], [1]), [(1, False, True)])
+        self.assertEqual(diff(iter([1, 3, 4, 7]), iter([2, 3, 7, 8])), [
+            (1, True, False), (2, False, True), (3, True, True),
+            (4, True, False), (7, True, True), (8, False, True)
+        ])
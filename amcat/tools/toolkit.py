@@ -197,6 +197,26 @@ def splitlist(iterable, itemsperbatch=100):
         yield [e for e in group if e is not _fillvalue]
 
 
+def sorted_diff(left, right):
+    """
+    Compare two sorted iterables (without duplicates) in a single pass, using constant
+    memory. Yields (value, in_left, in_right) tuples in sorted order.
+    """
+    _end = object()
+    left, right = iter(left), iter(right)
+    l, r = next(left, _end), next(right, _end)
+    while l is not _end or r is not _end:
+        if r is _end or (l is not _end and l < r):
+            yield l, True, False
+            l = next(left, _end)
+        elif l is _end or r < l:
+            yield r, False, True
+            r = next(right, _end)
+        else:
+            yield l, True, True
+            l, r = next(left, _end), next(right, _end)
+
+
 ###########################################################################
 ##                      Mapping functions                                ##
 ###########################################################################
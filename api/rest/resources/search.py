@@ -94,8 +94,9 @@ class LazyES(object):
             result_dict = {r.id : add_hits_column(r) for r in result}
             filters = {'ids': list(result_dict)}
 
-            for q in self.queries:
-                for hit in self.es.query_all(q.query, filters=filters, fields=[]):
+            results = self.es.multi_query(self.queries, filters=filters, size=len(result_dict))
+            for q, hits in zip(self.queries, results):
+                for hit in hits:
                     result_dict[hit.id].hits[q.label] = hit.score
 
         return result
@@ -29,6 +29,53 @@ ES_PORT = os.environ.get("AMCAT_ES_PORT", 9200)
 ES_INDEX = os.environ.get('AMCAT_ES_INDEX', 'amcat')
 ES_ARTICLE_DOCTYPE = 'article'
 
+# Elastic clients are shared within a process (see amcates.get_client). Each client keeps
+# up to ES_POOL_SIZE persistent connections per node. If ES_SNIFF is set, the client discovers
+# the other nodes of the cluster on start, on connection failure and every ES_SNIFF_INTERVAL
+# seconds. ES_TIMEOUT is the default request timeout in seconds.
+ES_POOL_SIZE = int(os.environ.get("AMCAT_ES_POOL_SIZE", 10))
+ES_SNIFF = os.environ.get("AMCAT_ES_SNIFF", "N").strip() in ("1", "Y", "ON")
+ES_SNIFF_INTERVAL = int(os.environ.get("AMCAT_ES_SNIFF_INTERVAL", 300))
+ES_TIMEOUT = int(os.environ.get("AMCAT_ES_TIMEOUT", 300))
+
+# Bulk indexing: number of concurrent bulk requests, maximum number of documents and bytes
+# per request, and number of times items rejected by an overloaded cluster are retried
+ES_BULK_CONCURRENCY = int(os.environ.get("AMCAT_ES_BULK_CONCURRENCY", 2))
+ES_BULK_SIZE = int(os.environ.get("AMCAT_ES_BULK_SIZE", 1000))
+ES_BULK_BYTES = int(os.environ.get("AMCAT_ES_BULK_BYTES", 10 * 1024 * 1024))
+ES_BULK_RETRIES = int(os.environ.get("AMCAT_ES_BULK_RETRIES", 3))
+
+# Queries with more hits than this are not retrieved in a single msearch request, but scrolled
+# one by one, see ES.multi_query_all
+ES_MULTI_QUERY_MAX_SIZE = int(os.environ.get("AMCAT_ES_MULTI_QUERY_MAX_SIZE", 10000))
+
+# Results of counts and aggregations can be cached for ES_RESULT_CACHE_TIMEOUT seconds (0, the
+# default, disables the cache). Writes invalidate the cached results of the affected sets, so
+# ES_RESULT_CACHE should name one of the CACHES that is shared by all processes that write
+# articles (web and celery workers, management commands). Without it, a local LRU cache of
+# ES_RESULT_CACHE_SIZE entries is used, which only sees the writes of its own process.
+# Results computed within ES_RESULT_CACHE_SETTLE_TIME seconds after a write to one of their
+# sets are not cached, since the write might not be visible until the next elastic refresh.
+ES_RESULT_CACHE_TIMEOUT = int(os.environ.get("AMCAT_ES_RESULT_CACHE_TIMEOUT", 0))
+ES_RESULT_CACHE = os.environ.get("AMCAT_ES_RESULT_CACHE", None)
+ES_RESULT_CACHE_SIZE = int(os.environ.get("AMCAT_ES_RESULT_CACHE_SIZE", 1000))
+ES_RESULT_CACHE_SETTLE_TIME = int(os.environ.get("AMCAT_ES_RESULT_CACHE_SETTLE_TIME", 5))
+
+# Number of parsed query strings (and their DSL) kept by amcat.tools.queryparser, 0 to disable
+ES_QUERY_CACHE_SIZE = int(os.environ.get("AMCAT_ES_QUERY_CACHE_SIZE", 1000))
+
+# Number of buckets (e.g. media or sets) per request when aggregating, see ES.iter_aggregate
+ES_AGGREGATION_PAGE_SIZE = int(os.environ.get("AMCAT_ES_AGGREGATION_PAGE_SIZE", 100))
+
+# Duplicate detection on import (see amcat.tools.duplicates): number of hashes per lookup request
+# and number of concurrent lookup requests. If ES_HASH_INDEX is set, the hashes of new articles
+# are also stored in the articles_hashes table, so that new articles are recognized without
+# querying elastic. Run the fill_hash_index management command when enabling it on an existing
+# database.
+ES_DUPLICATE_BATCH_SIZE = int(os.environ.get("AMCAT_ES_DUPLICATE_BATCH_SIZE", 1000))
+ES_DUPLICATE_CONCURRENCY = int(os.environ.get("AMCAT_ES_DUPLICATE_CONCURRENCY", 4))
+ES_HASH_INDEX = os.environ.get("AMCAT_ES_HASH_INDEX", "N").strip() in ("1", "Y", "ON")
+
 ES_MAPPING_STRING_OPTIONS = {
     "type": "string",
     "omit_norms": True